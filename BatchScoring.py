@@ -0,0 +1,56 @@
+# Imports
+import numpy as np
+
+from scipy.sparse import csr_matrix
+from errors import *
+
+
+def incidence_matrix(hash_arrays: list, vocabulary: np.ndarray) -> csr_matrix:
+    """
+    Builds the document x n-gram incidence matrix of a block of documents.
+    :param hash_arrays: A list with the sorted and deduplicated n-gram hashes of every document.
+    :param vocabulary: A sorted uint64 numpy array containing every hash in hash_arrays.
+    :return: A CSR matrix with a row per document and a column per hash of the vocabulary.
+    """
+    indptr = np.zeros(len(hash_arrays) + 1, dtype=np.int64)
+    np.cumsum([len(h) for h in hash_arrays], out=indptr[1:])
+
+    if indptr[-1]:
+        indices = np.searchsorted(vocabulary, np.concatenate(hash_arrays))
+    else:
+        indices = np.empty(0, dtype=np.int64)
+
+    return csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr),
+                      shape=(len(hash_arrays), len(vocabulary)))
+
+
+def similarity_matrix(sus_hashes: list, src_hashes: list, coef_type: str = "jaccard") -> np.ndarray:
+    """
+    Computes the similarity between every sus and src document of a block with one sparse matrix product.
+    It gives the same values as NGram.similarity called from the sus side.
+    :param sus_hashes: A list with the sorted and deduplicated n-gram hashes of every sus document.
+    :param src_hashes: A list with the sorted and deduplicated n-gram hashes of every src document.
+    :param coef_type: A string, "jaccard" or "containment".
+    :return: A dense numpy array of shape (len(sus_hashes), len(src_hashes)).
+    """
+    if coef_type not in ["jaccard", "containment"]:
+        raise NGramUnknownCoefficient
+
+    # Shared vocabulary of the block
+    arrays = [np.asarray(h, dtype=np.uint64) for h in sus_hashes + src_hashes]
+    vocabulary = np.unique(np.concatenate(arrays)) if arrays else np.empty(0, dtype=np.uint64)
+
+    sus_matrix = incidence_matrix(arrays[:len(sus_hashes)], vocabulary)
+    src_matrix = incidence_matrix(arrays[len(sus_hashes):], vocabulary)
+
+    intersection = (sus_matrix @ src_matrix.T).toarray().astype(np.float64)
+    sus_card = np.diff(sus_matrix.indptr).astype(np.float64)[:, None]
+    src_card = np.diff(src_matrix.indptr).astype(np.float64)[None, :]
+
+    if coef_type == "jaccard":
+        denominator = sus_card + src_card - intersection
+    else:
+        denominator = np.broadcast_to(sus_card, intersection.shape)
+
+    # Empty documents get a 0 instead of a division by zero
+    return np.divide(intersection, denominator, out=np.zeros_like(intersection), where=denominator > 0)
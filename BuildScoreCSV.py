@@ -1,17 +1,46 @@
+import heapq
+import os
+import pickle
+import tempfile
+import numpy as np
+
 from pathlib import Path, PurePath
 from NGram import *
 from DependencyRelations import *
+from NGramIndex import NGramIndex
+from MinHash import MinHash, LSHIndex
+from BatchScoring import similarity_matrix
+from SimilarityJoin import similarity_join
+from ScoresSink import open_sink
+from Sharding import shard_blocks, job_fingerprint, ShardManifest
+from Detection import DetectionSink
+from FeatureCache import FeatureCache
+from FeatureArena import FeatureArena, shared_memory_free
 from errors import *
-from istarmap import *
-from multiprocessing import Manager, Pool, cpu_count
+from Profiling import profiled, stage, timed_iter
+import Profiling
+from Executor import Executor, available_memory
+from os import getpid
 from tqdm import tqdm
-from PlagiarismDataHandler import PlagiarismFile
+from CorpusIndex import CorpusIndex
+
+# Features cache of every worker process, set by __init_worker
+_feature_cache = None
+# Shared memory n-grams of the src and sus files and the job the ids refer to, set by __init_worker
+_arenas = None
+# Last src tile loaded by the worker (id and features) and his tile loads (misses) and reuses (hits)
+_last_tile = None
+_tile_stats = {"hits": 0, "misses": 0}
+# Estimated bytes of a scores row while a tile is computed
+_TILE_ROW_BYTES = 256
 
 
-def __get_tmp_folders(tmp_folder):
+def __get_tmp_folders(tmp_folder, dep=False):
     """
     Private function used to gather the names of the preprocessed features folders
     :param tmp_folder: A Path object with the path of the preprocessed folder's features.
+    :param dep: A bool, if True the dependency relations (source-dep and suspicious-dep folders) are added as the
+    "dep" feature, they must exist.
     :return: A dictionary containing the name of the feature as the key and the
     his folder's path as the value.
     """
@@ -19,54 +48,89 @@ def __get_tmp_folders(tmp_folder):
     if not isinstance(tmp_folder, PurePath):
         raise NotPurePathError("tmp_folder arg is not PurePath object")
 
-    # Get the corresponding folders
-    # They must have the same order
-    src_ngrams = list(tmp_folder.glob("source-*-ngram"))
-    sus_ngrams = list(tmp_folder.glob("suspicious-*-ngram"))
+    # Get the corresponding folders, matched by feature name
+    src_ngrams = {path.stem.replace("source-", "", 1): path for path in tmp_folder.glob("source-*-ngram")}
+    sus_ngrams = {path.stem.replace("suspicious-", "", 1): path for path in tmp_folder.glob("suspicious-*-ngram")}
 
-    if len(src_ngrams) != len(sus_ngrams):
+    if src_ngrams.keys() != sus_ngrams.keys():
         raise TmpDirectoryError
 
     # Classify ngram types and dep types
     processed = {}
-    for src_ngram, sus_ngram in zip(src_ngrams, sus_ngrams):
-        processed[src_ngram.stem.replace("source-", "")] = (src_ngram, sus_ngram)
+    for key in sorted(src_ngrams):
+        processed[key] = (src_ngrams[key], sus_ngrams[key])
+
+    # Only scored when asked, a dep folder next to the n-grams doesn't change the scores columns
+    if dep:
+        if not ((tmp_folder / "source-dep").exists() and (tmp_folder / "suspicious-dep").exists()):
+            raise TmpDirectoryError
+        processed["dep"] = (tmp_folder / "source-dep", tmp_folder / "suspicious-dep")
 
     return processed
 
 
-def __write(q, output, header):
+def __ngram_folders(folders):
+    # The candidate retrieval (inverted index, LSH and similarity join) only works with n-grams
+    return {key: value for key, value in folders.items() if key.endswith("ngram")}
+
+
+def __suffix(key):
+    return ".dep" if key == "dep" else ".NGram"
+
+
+def __score_key(key):
+    # The dependency relations score is the containment of the sus relations in the src ones, not a jaccard
+    return key + ("-containment" if key == "dep" else "-jaccard")
+
+
+def __init_worker(cache_bytes, arenas=None):
     """
-    Private worker function used to write the distances
-    to the output files.
-    :param q: Manager().Queue() object
-    :param output: Path object where the output file will be located
-    :param header: List of strings containing the name for every var in the CSV
+    Private function used as the pool initializer, creates the features cache of the worker.
+    :param cache_bytes: An int, maximum size of the cache in bytes.
+    :param arenas: A dict with the layouts of the src and sus FeatureArena, the src and sus files (the ids are
+    their positions) and the features folders. The worker attaches to the arenas when given.
     :return: Nothing
     """
+    global _feature_cache, _arenas
+    _feature_cache = FeatureCache(cache_bytes)
 
-    if not isinstance(output, PurePath):
-        raise NotPurePathError("output arg is not PurePath object")
+    if arenas is not None:
+        _arenas = (FeatureArena.attach(arenas["src_layout"]), FeatureArena.attach(arenas["sus_layout"]), arenas)
 
-    with open(output, "a+") as f:
-        f.write(",".join(header) + "\n")
-        while True:
-            m = q.get()
 
-            if m == "kill":
-                break
+def __load_ngram(path):
+    """
+    Private function used to load a .NGram or .dep file into the cache, the set used by similarity is built
+    beforehand so it's accounted in the cached size.
+    :param path: A Path object with the location of the .NGram or .dep file.
+    :return: A NGram or DependencyRelations object.
+    """
+    with stage("load", 1, path.stat().st_size if Profiling.is_enabled() else 0):
+        if path.suffix == ".dep":
+            return DependencyRelations.from_dep_file(path)
+
+        ngram = NGram.from_ngram_file(path)
+        if not ngram.compact:
+            ngram.as_set()
+
+        return ngram
 
-            f.write(",".join([str(x) for x in list(m.values())]) + "\n")
-            f.flush()
 
+def __get_ngram(path, feature):
+    if _feature_cache is None:
+        return __load_ngram(path)
 
-def __calc_distance(q, pair, is_training=False):
+    return _feature_cache.get(path, feature, __load_ngram)
+
+
+def __calc_distance(pair, src_refs=None, exact=True):
     """
     Private function used to calculate the preprocessed features similarities in bulk.
-    :param q: Manager().Queue() object
     :param pair: A dict containing the the paths of the src and sus files as well as his preprocessed features.
-    :param is_training: A bool indicating if the CSV formed is for training a model, the corresponding .xml file
-    must be in the same folder as the sus file.
+    :param src_refs: A frozenset with the names of the sources plagiarized by the sus file, given when the CSV
+    formed is for training a model.
+    :param exact: A bool, if False the jaccard is estimated from the MinHash signatures stored
+    next to the .NGram files.
     :return: a dict containing the similarity for every feature.
     """
     distances = {"src": pair["src"].name, "sus": pair["sus"].name}
@@ -75,46 +139,501 @@ def __calc_distance(q, pair, is_training=False):
         src = value[0]
         sus = value[1]
 
-        src_ngram = NGram.from_ngram_file(src)
-        sus_ngram = NGram.from_ngram_file(sus)
-        distances[key + "-jaccard"] = sus_ngram.similarity(src_ngram)
+        if key == "dep":
+            # Share of the sus relations found in the src, repeated relations included
+            distances[__score_key(key)] = __get_ngram(sus, key).similarity(__get_ngram(src, key), multiset=True)
+        elif exact:
+            src_ngram = __get_ngram(src, key)
+            sus_ngram = __get_ngram(sus, key)
+            distances[key + "-jaccard"] = sus_ngram.similarity(src_ngram)
+        else:
+            src_minhash = MinHash.from_minhash_file(src.with_suffix(MinHash.SUFFIX))
+            sus_minhash = MinHash.from_minhash_file(sus.with_suffix(MinHash.SUFFIX))
+            distances[key + "-jaccard"] = sus_minhash.jaccard(src_minhash)
         # Not much use in computing the containment as well
         # distances[key + "-containment"] = sus_ngram.similarity(src_ngram, "containment")
 
-    if is_training:
-        src_refs = [xml["source_file"] for xml in PlagiarismFile(pair["sus"].with_suffix(".xml")).plagiarized_refs]
+    if src_refs is not None:
         distances["plagiarized"] = 1 if pair["src"].name in src_refs else 0
 
-    q.put(distances)
     return distances
 
 
-def writeCSV(tmp_folder, src_files, sus_files, output, is_training=False):
+@profiled
+def __calc_batch(batch, src_refs=None, top_k=None, rank_by=None):
+    """
+    Private function used to calculate the distances of a batch of pairs sharing the same sus file,
+    so his features are loaded once and kept in the worker's cache.
+    :param batch: A list of tuples with the pair dict and the exact flag as expected by __calc_distance.
+    :param src_refs: A frozenset with the names of the sources plagiarized by the sus file, if training.
+    :param top_k: An int, if given only the top_k pairs with the highest rank_by score are returned.
+    :param rank_by: A string, the distances key used to rank the pairs when top_k is given.
+    :return: A tuple with the number of pairs computed, the rows to write, the worker's pid and his cache stats.
+    """
+    rows = (__calc_distance(pair, src_refs, exact) for pair, exact in batch)
+    return __batch_result(len(batch), rows, top_k, rank_by)
+
+
+def __arena_distance(sus_id, src_id, src_refs=None):
+    """
+    Private function used to calculate the features similarities of a pair of files of the worker's arenas,
+    the n-grams are read from shared memory and the dependency relations from the cache.
+    :param sus_id: An int, id of the sus file.
+    :param src_id: An int, id of the src file.
+    :param src_refs: A frozenset with the names of the sources plagiarized by the sus file, if training.
+    :return: a dict containing the similarity for every feature, as __calc_distance.
+    """
+    src_arena, sus_arena, job = _arenas
+    src, sus = job["src"][src_id], job["sus"][sus_id]
+    distances = {"src": src.name, "sus": sus.name}
+
+    for key, (src_folder, sus_folder) in job["folders"].items():
+        if key == "dep":
+            src_dep = __get_ngram(src_folder / (src.stem + ".dep"), key)
+            distances[__score_key(key)] = __get_ngram(sus_folder / (sus.stem + ".dep"), key).similarity(
+                src_dep, multiset=True)
+        else:
+            distances[key + "-jaccard"] = sus_arena.jaccard(key, sus_id, src_arena, src_id)
+
+    if src_refs is not None:
+        distances["plagiarized"] = 1 if src.name in src_refs else 0
+
+    return distances
+
+
+@profiled
+def __calc_arena_batch(sus_id, src_ids, src_refs=None, top_k=None, rank_by=None):
+    """
+    Private function used to calculate the distances of a sus file against a batch of src files when the
+    features are shared, the task only carries their ids.
+    :param sus_id: An int, id of the sus file.
+    :param src_ids: A numpy int32 array with the ids of the src files.
+    :return: A tuple as returned by __calc_batch.
+    """
+    rows = (__arena_distance(sus_id, int(src_id), src_refs) for src_id in src_ids)
+    return __batch_result(len(src_ids), rows, top_k, rank_by)
+
+
+def __batch_result(n, rows, top_k, rank_by):
+    # nlargest keeps a heap bounded to top_k rows
+    if top_k is not None:
+        rows = heapq.nlargest(top_k, rows, key=lambda distances: distances[rank_by])
+
+    rows = [list(distances.values()) for distances in rows]
+
+    stats = _feature_cache.stats() if _feature_cache is not None else None
+    return n, rows, getpid(), stats
+
+
+def __load_features(files, folders, side, loader):
+    """
+    Private function used to load the features of a block of files.
+    :param files: A list of Path objects with the src or the sus files.
+    :param folders: A dict as returned by __get_tmp_folders.
+    :param side: An int, 0 for the src files and 1 for the sus files.
+    :param loader: A function called with the path and the feature name, e.g. __get_ngram.
+    :return: A dict with the list of hashes (or DependencyRelations objects for dep) of every feature.
+    """
+    features = {}
+    for key, value in folders.items():
+        suffix = __suffix(key)
+        if key == "dep":
+            features[key] = [loader(value[side] / (path.stem + suffix), key) for path in files]
+            continue
+
+        # Every document is hashed as it's read, only one parsed NGram is alive at a time
+        features[key] = [loader(value[side] / (path.stem + suffix), key).hashes() for path in files]
+
+    return features
+
+
+def __block_rows(sus_block, src_block, sus_features, src_features, labels=None):
+    """
+    Private function used to calculate the rows of every pair of a block of sus and src files from their
+    loaded features, with a sparse matrix product per n-gram feature.
+    :param sus_features: A dict as returned by __load_features for the sus files.
+    :param src_features: A dict as returned by __load_features for the src files.
+    :param labels: A dict with the frozenset of plagiarized sources of every sus file of the block, if training.
+    :return: A list with the rows to write.
+    """
+    scores = {}
+    for key in sus_features:
+        if key == "dep":
+            scores[__score_key(key)] = [[sus.similarity(src, multiset=True) for src in src_features[key]]
+                                        for sus in sus_features[key]]
+            continue
+
+        with stage("similarity matrix", len(sus_block) * len(src_block)):
+            scores[key + "-jaccard"] = similarity_matrix(sus_features[key], src_features[key])
+
+    rows = []
+    for i, sus in enumerate(sus_block):
+        for j, src in enumerate(src_block):
+            row = [src.name, sus.name] + [float(matrix[i][j]) for matrix in scores.values()]
+
+            if labels is not None:
+                row.append(1 if src.name in labels[sus.name] else 0)
+
+            rows.append(row)
+
+    return rows
+
+
+@profiled
+def __calc_block(sus_block, src_block, folders, labels=None):
+    """
+    Private function used to calculate the distances of every pair of a block of sus and src files
+    at once, with a sparse matrix product per feature.
+    :param sus_block: A list of Path objects with the sus files.
+    :param src_block: A list of Path objects with the src files.
+    :param folders: A dict as returned by __get_tmp_folders.
+    :param labels: A dict with the frozenset of plagiarized sources of every sus file of the block, if training.
+    :return: A tuple with the number of pairs computed, the rows to write, the worker's pid and his cache stats.
+    """
+    rows = __block_rows(sus_block, src_block, __load_features(sus_block, folders, 1, __get_ngram),
+                        __load_features(src_block, folders, 0, __get_ngram), labels)
+
+    stats = _feature_cache.stats() if _feature_cache is not None else None
+    return len(rows), rows, getpid(), stats
+
+
+def __read_feature(path, feature):
+    # Loads a feature file without the cache, the tiles are sized to fit the memory budget on their own
+    if path.suffix == ".dep":
+        return DependencyRelations.from_dep_file(path)
+
+    return NGram.from_ngram_file(path)
+
+
+def __load_tile(files, folders, side):
+    with stage("tile load", len(files), sum((value[side] / (path.stem + __suffix(key))).stat().st_size
+                                            for path in files for key, value in folders.items())
+               if Profiling.is_enabled() else 0):
+        return __load_features(files, folders, side, __read_feature)
+
+
+def __feature_bytes(path, folders, side):
+    """
+    Private function used to estimate the memory of the features of a file once loaded as a tile, without
+    loading them. The n-grams are kept as hashes, 8 bytes each, counted from the headers of the .NGram files.
+    :param path: A Path object with the src or sus file.
+    :param folders: A dict as returned by __get_tmp_folders.
+    :param side: An int, 0 for the src files and 1 for the sus files.
+    :return: An int, estimated bytes.
+    """
+    size = 0
+    for key, value in folders.items():
+        feature_path = value[side] / (path.stem + __suffix(key))
+        size += dep_file_nbytes(feature_path) if key == "dep" else 8 * ngram_file_cardinality(feature_path)
+
+    return size
+
+
+@profiled
+def __calc_tile_row(sus_tile, src_tiles, folders, labels, spill_folder):
+    """
+    Private function used by the tiled backend to score a tile of sus files against every src tile. The sus
+    features are loaded once and stay resident while the src tiles are loaded one at a time. The src tiles
+    are walked from the end where the last tile loaded by the worker is, so it's reused (serpentine order).
+    The rows are spilled to a file tile by tile, they're never all in memory.
+    :param sus_tile: A list of Path objects with the sus files.
+    :param src_tiles: A list of tuples with the id and the Path objects of every src tile.
+    :param folders: A dict as returned by __get_tmp_folders.
+    :param labels: A dict with the frozenset of plagiarized sources of every sus file of the tile, if training.
+    :param spill_folder: A string with the folder of the spill files.
+    :return: A tuple with the number of pairs computed, the spill file, the worker's pid and his tile stats.
+    """
+    global _last_tile
+    sus_features = __load_tile(sus_tile, folders, 1)
+
+    if _last_tile is not None and src_tiles and _last_tile[0] == src_tiles[-1][0]:
+        src_tiles = src_tiles[::-1]
+
+    n = 0
+    fd, spill = tempfile.mkstemp(suffix=".rows", dir=spill_folder)
+    with os.fdopen(fd, "wb") as f:
+        for tile_id, src_tile in src_tiles:
+            if _last_tile is not None and _last_tile[0] == tile_id:
+                _tile_stats["hits"] += 1
+            else:
+                # The previous tile is released before the next one is loaded
+                _last_tile = None
+                _last_tile = (tile_id, __load_tile(src_tile, folders, 0))
+                _tile_stats["misses"] += 1
+
+            rows = __block_rows(sus_tile, src_tile, sus_features, _last_tile[1], labels)
+            with stage("spill", len(rows)):
+                pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+            n += len(rows)
+
+    return n, spill, getpid(), dict(_tile_stats)
+
+
+def __read_spill(spill):
+    """
+    Private function used to read back the rows spilled by __calc_tile_row, the file is removed afterwards.
+    :param spill: A string with the spill file.
+    :return: A generator with the rows of every tile.
+    """
+    try:
+        with open(spill, "rb") as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
+    finally:
+        os.unlink(spill)
+
+
+def __plan_tiles(files, folders, side, max_bytes, max_files):
+    """
+    Private function used to split a list of files into consecutive tiles whose features fit in max_bytes,
+    estimated with __feature_bytes. A file bigger than max_bytes makes a tile on his own.
+    :param files: A list of Path objects.
+    :param folders: A dict as returned by __get_tmp_folders.
+    :param side: An int, 0 for the src files and 1 for the sus files.
+    :param max_bytes: An int, maximum bytes of features of a tile.
+    :param max_files: An int, maximum files of a tile.
+    :return: A list of lists of Path objects.
+    """
+    tiles = []
+    current, size = [], 0
+    for path in files:
+        nbytes = __feature_bytes(path, folders, side)
+        if current and (size + nbytes > max_bytes or len(current) >= max_files):
+            tiles.append(current)
+            current, size = [], 0
+        current.append(path)
+        size += nbytes
+
+    if current:
+        tiles.append(current)
+    return tiles
+
+
+def __candidate_sources(folders, indexes, src_files, sus, min_shared):
+    """
+    Private function used to retrieve the source files worth scoring against a sus file.
+    :param folders: A dict as returned by __get_tmp_folders.
+    :param indexes: A dict with the name of the feature as the key and the NGramIndex of his source folder as the value.
+    :param src_files: A list of Path objects with the source files.
+    :param sus: A Path object with the sus file.
+    :param min_shared: Minimum number of distinct n-grams a source must share with the sus file
+    in any of the features.
+    :return: A list with the Path objects of the candidate source files.
+    """
+    names = set()
+    for key, (src_folder, sus_folder) in __ngram_folders(folders).items():
+        sus_ngram = NGram.from_ngram_file(sus_folder / (sus.stem + ".NGram"))
+        names.update(indexes[key].candidates(sus_ngram, min_shared))
+
+    return [src for src in src_files if src.stem in names]
+
+
+def __lsh_candidates(folders, lsh_indexes, sus):
+    """
+    Private function used to retrieve the names of the source files whose signatures collide
+    with the ones of a sus file in some feature.
+    :param folders: A dict as returned by __get_tmp_folders.
+    :param lsh_indexes: A dict with the name of the feature as the key and the LSHIndex of his source folder as the value.
+    :param sus: A Path object with the sus file.
+    :return: A set with the stems of the candidate source files.
+    """
+    names = set()
+    for key, (src_folder, sus_folder) in __ngram_folders(folders).items():
+        names.update(lsh_indexes[key].query(MinHash.from_minhash_file(sus_folder / (sus.stem + MinHash.SUFFIX))))
+
+    return names
+
+
+def __join_candidates(folders, src_files, sus_files, min_jaccard):
+    """
+    Private function used to retrieve, with an exact similarity join, the pairs reaching a minimum jaccard.
+    :param folders: A dict as returned by __get_tmp_folders.
+    :param src_files: A list of Path objects with the source files.
+    :param sus_files: A list of Path objects with the sus files.
+    :param min_jaccard: A float, minimum jaccard in any of the features.
+    :return: A dict with the stem of every sus file as the key and a set with the stems of his candidates
+    as the value.
+    """
+    suffix = ".NGram"
+    candidates = {sus.stem: set() for sus in sus_files}
+    for key, (src_folder, sus_folder) in __ngram_folders(folders).items():
+        # Only the uint64 hashes of every document are kept for the join, read into memory (binary files aren't
+        # memory mapped) so no file stays open. The NGram objects are dropped as soon as they're hashed
+        src_sets = {src.stem: NGram.from_ngram_file(src_folder / (src.stem + suffix)).hashes() for src in src_files}
+        sus_sets = {sus.stem: NGram.from_ngram_file(sus_folder / (sus.stem + suffix)).hashes() for sus in sus_files}
+
+        for sus, src, _ in similarity_join(sus_sets, src_sets, min_jaccard):
+            candidates[sus].add(src)
+
+    return candidates
+
+
+def __make_batches(folders, blocks, labels, min_shared, approximate, bands, min_jaccard, top_k, rank_by,
+                   ids=None):
+    """
+    Private function used to build the tasks of the pool backend, a batch of pairs per sus file.
+    :param blocks: A list of tuples with the sus and src files of every block, as returned by shard_blocks.
+    :param ids: A tuple with the dicts of the src and sus files ids in the arenas, if given the tasks are
+    __calc_arena_batch args instead.
+    :return: A tuple with the list of __calc_batch (or __calc_arena_batch) args, the total number of pairs and
+    the estimated cost of every batch (the bytes of text compared).
+    """
+    # A shard may hold several src blocks of the same sus block, they're scored in the same batch
+    grouped = {}
+    for sus_block, src_block in blocks:
+        grouped.setdefault(tuple(sus_block), []).extend(src_block)
+
+    sus_files = [sus for sus_block in grouped for sus in sus_block]
+    src_files = list({src: None for sources in grouped.values() for src in sources})
+    sources_of = {sus: sources for sus_block, sources in grouped.items() for sus in sus_block}
+    sizes = {path: path.stat().st_size for path in sus_files + src_files}
+
+    batches = []
+    costs = []
+    pairs = 0
+    if min_jaccard is not None:
+        joined = __join_candidates(folders, src_files, sus_files, min_jaccard)
+    if min_shared is not None:
+        indexes = {key: NGramIndex.for_folder(value[0]) for key, value in __ngram_folders(folders).items()}
+    if approximate:
+        lsh_indexes = {key: LSHIndex.from_minhash_folder(value[0], bands)
+                       for key, value in __ngram_folders(folders).items()}
+
+    for sus in tqdm(sus_files, desc="Retrieving candidates...",
+                    disable=min_shared is None and not approximate):
+        candidates = sources_of[sus]
+        if min_jaccard is not None:
+            candidates = [src for src in candidates if src.stem in joined[sus.stem]]
+        if min_shared is not None:
+            candidates = __candidate_sources(folders, indexes, candidates, sus, min_shared)
+        lsh_candidates = __lsh_candidates(folders, lsh_indexes, sus) if approximate else None
+
+        if not candidates:
+            continue
+
+        pairs += len(candidates)
+        costs.append(len(candidates) * sizes[sus] + sum(sizes[src] for src in candidates))
+        src_refs = labels.get(sus.name, frozenset()) if labels is not None else None
+        if ids is not None:
+            src_ids = np.fromiter((ids[0][src] for src in candidates), dtype=np.int32, count=len(candidates))
+            batches.append((ids[1][sus], src_ids, src_refs, top_k, rank_by))
+            continue
+
+        batch = []
+        for src in candidates:
+            pair = {"sus": sus, "src": src}
+            for key, value in folders.items():
+                suffix = __suffix(key)
+                pair[key] = (value[0] / (src.stem + suffix),
+                             value[1] / (sus.stem + suffix))
+            batch.append((pair, lsh_candidates is None or src.stem in lsh_candidates))
+
+        batches.append((batch, src_refs, top_k, rank_by))
+
+    return batches, pairs, costs
+
+
+def __plan_tile_rows(folders, blocks, labels, memory_budget, workers, spill_folder):
+    """
+    Private function used to split the blocks into the tasks of the tiled backend, a row of tiles per task. The
+    budget of every worker is split in half for his sus tile, a quarter for the src tile streamed past it and a
+    quarter for the rows of a tile. The sus tiles are also capped so every worker gets one.
+    :param folders: A dict as returned by __get_tmp_folders.
+    :param blocks: A list of tuples with the sus files and the src files of every block, sorted by name.
+    :param labels: A dict with the frozenset of plagiarized sources of every sus file, if training.
+    :param memory_budget: An int, bytes held at once by all the workers.
+    :param workers: An int, number of workers.
+    :param spill_folder: A string with the folder of the spill files.
+    :return: A tuple with the args and the cost of every task and the number of src tiles.
+    """
+    worker_budget = max(memory_budget // workers, 1)
+    args, costs = [], []
+    src_tile_count = 0
+    for sus_block, src_block in blocks:
+        sus_tiles = __plan_tiles(sus_block, folders, 1, worker_budget // 2, -(-len(sus_block) // workers))
+        max_rows = worker_budget // 4 // (_TILE_ROW_BYTES + 8 * len(folders))
+        src_tiles = __plan_tiles(src_block, folders, 0, worker_budget // 4,
+                                 max(max_rows // max(len(tile) for tile in sus_tiles), 1) if sus_tiles else 1)
+
+        # Ids are unique across the blocks, a worker only reuses the same tile
+        src_tiles = [(src_tile_count + i, src_tile) for i, src_tile in enumerate(src_tiles)]
+        src_tile_count += len(src_tiles)
+
+        for sus_tile in sus_tiles:
+            args.append((sus_tile, src_tiles, folders,
+                         {sus.name: labels.get(sus.name, frozenset()) for sus in sus_tile}
+                         if labels is not None else None, spill_folder))
+            costs.append(len(sus_tile) * len(src_block))
+
+    return args, costs, src_tile_count
+
+
+def writeCSV(tmp_folder, src_files, sus_files, output, is_training=False, min_shared=None, approximate=False,
+             bands=32, cache_size=256 * 2 ** 20, backend="pool", block_size=512, min_jaccard=None, top_k=None,
+             rank_by=None, fmt=None, model=None, shard=None, arena=True, workers=None, worker_memory=None,
+             memory_budget=None, dep=False):
     """
     Functions used to generate as CSV with the similarity scores between a set of src and sus documents.
     :param tmp_folder: A Path object containing the folder where the preprocessed features are located
     :param src_files: A Path object containing the folder where the source files are located.
     :param sus_files: A Path object containing the folder where de suspicious files are located.
-    :param output: A path object containing the CSV output location
+    :param output: A path object containing the CSV output location (or Parquet/Arrow IPC, see fmt)
     :param is_training: A bool indicating if the CSV is for training (a columns indicating if its plagiarized will be
     added). The corresponding .xml files must be in the same folder as the sus files.
+    :param min_shared: An int, if given an inverted index of the source features is used and only the pairs
+    sharing at least min_shared n-grams in some feature are scored. The rest of the pairs are left out of the CSV.
+    :param approximate: A bool, if True the jaccard of every pair is estimated from the MinHash signatures (the
+    features must be preprocessed with them) and only the LSH candidate pairs are computed exactly.
+    :param bands: An int, number of bands of the LSH index used when approximate is True.
+    :param cache_size: An int, size in bytes of the features cache of every worker.
+    :param backend: A string, "pool" scores the pairs one by one and "sparse" scores blocks of block_size sus
+    and src files with sparse matrix products. "tiled" scores tiles sized to fit memory_budget, every sus tile
+    is loaded once by a worker and the src tiles are streamed past it. The "sparse" and "tiled" backends always
+    score every pair.
+    :param block_size: An int, number of files per block of the (sus x src) pair space. The "sparse" backend
+    scores a block at a time, shard deals the blocks between the shards and the "tiled" backend tiles every block
+    of a shard.
+    :param min_jaccard: A float, if given only the pairs with a jaccard >= min_jaccard in some feature are scored,
+    found with an exact similarity join (every pair at or above it is kept).
+    :param top_k: An int, if given only the top_k sources with the highest score are written for every sus file.
+    :param rank_by: A string, name of the feature used to rank the sources with top_k (the first one by default).
+    :param fmt: A string, "csv", "parquet" or "arrow". If not given it's inferred from the output suffix.
+    :param model: A fitted classifier, if given the rows are classified as they arrive and only the flagged pairs
+    are written to output (a CSV with the src, sus and prob columns), the scores aren't kept.
+    :param shard: A tuple as returned by parse_shard, if given only the blocks (of block_size sus and src files)
+    of that shard are scored and a ShardManifest is written next to output, see merge_shards.
+    :param arena: A bool, if True the pool backend loads the n-grams once into a shared memory FeatureArena and
+    the workers get the ids of the files. Not used with approximate, where most features are never loaded, nor
+    when the arena doesn't fit in the free shared memory (or the available memory).
+    :param workers: An int, number of worker processes, cpu_count() + 2 by default.
+    :param worker_memory: An int, estimated bytes used by every worker (his features cache included), caps the
+    workers to the available memory.
+    :param memory_budget: An int, bytes of features and rows held at once by all the workers with the "tiled"
+    backend, half of the available memory by default.
+    :param dep: A bool, if True the dependency relations are also scored, as the containment of the relations of
+    the sus file in the ones of the src file (the "dep" column). The dep folders must have been preprocessed.
     :return: Nothing
     """
-    # Def queue and pool with saturated threads
-    manager = Manager()
-    q = manager.Queue()
-    pool = mpp.Pool(cpu_count() + 2)
-
-    # Make list of pairs
-    pairs = []
-    folders = __get_tmp_folders(tmp_folder)
-    for sus in sus_files:
-        for src in src_files:
-            pairs.append({"sus": sus, "src": src})
-            for key, value in folders.items():
-                suffix = ".NGram"
-                pairs[-1][key] = (value[0] / (src.stem + suffix),
-                                  value[1] / (sus.stem + suffix))
+    if backend not in ["pool", "sparse", "tiled"]:
+        raise UnknownOption(f"{backend} is not a known backend")
+
+    if backend != "pool" and (min_shared is not None or approximate or min_jaccard is not None or top_k is not None):
+        raise UnknownOption("min_shared, min_jaccard, approximate and top_k are only available with the pool backend")
+
+    if shard is not None and model is not None:
+        raise UnknownOption("The flagged pairs can't be sharded, detect the merged scores instead")
+
+    folders = __get_tmp_folders(tmp_folder, dep)
+    if not folders:
+        raise TmpDirectoryError(f"No preprocessed features found in {tmp_folder}")
+
+    if rank_by is None:
+        rank_by = next(iter(folders), None)
+    if top_k is not None and rank_by not in folders:
+        raise UnknownOption(f"{rank_by} is not a known feature")
 
     # Def header to identify scores
     header = ["src", "sus"] + list(folders.keys())
@@ -126,19 +645,126 @@ def writeCSV(tmp_folder, src_files, sus_files, output, is_training=False):
             header[i + 1] += "-jaccard"
     """
 
+    labels = None
     if is_training:
         header += ["plagiarized"]
 
-    # Start listener
-    receiver = pool.apply_async(__write, (q, output, header))
+        # The references come from the corpus index, the .xml files aren't parsed per pair
+        sus_folders = sorted(set(Path(sus).parent for sus in sus_files))
+        index = CorpusIndex.for_folders(*sus_folders)
+        labels = {}
+        for folder in sus_folders:
+            labels.update(index.labels(folder))
+        index.close()
+
+    # Make list of blocks, only the ones of the shard if given
+    blocks = shard_blocks(src_files, sus_files, block_size, shard)
+
+    # Everything created from here is released in the finally, the shared memory segments included
+    arenas = None
+    arena_bytes = None
+    spill_folder = None
+    cache_stats = {}
+    try:
+        # The n-grams of the files to score are loaded once and shared with the workers
+        if backend == "pool" and arena and not approximate:
+            src_list = list({src: None for _, src_block in blocks for src in src_block})
+            sus_list = list({sus: None for sus_block, _ in blocks for sus in sus_block})
+            ngram_folders = __ngram_folders(folders)
+            sides = [({key: value[side] for key, value in ngram_folders.items()}, [path.stem for path in files])
+                     for side, files in enumerate([src_list, sus_list])]
+
+            # Without room for the segments the workers load their own copy through the cache instead
+            needed = sum(FeatureArena.estimate_nbytes(*side) for side in sides)
+            free = [x for x in [shared_memory_free(), available_memory()] if x is not None]
+            if free and needed > min(free):
+                print(f"The features arena needs {needed / 2 ** 20:.1f} MB of shared memory but only "
+                      f"{min(free) / 2 ** 20:.1f} MB are free, every worker loads the features instead")
+            else:
+                arenas = ()
+                for side in sides:
+                    arenas += (FeatureArena.create(*side),)
+                arena_bytes = sum(feature_arena.nbytes for feature_arena in arenas)
+                ids = ({src: i for i, src in enumerate(src_list)}, {sus: i for i, sus in enumerate(sus_list)})
+
+        # Def pool with saturated threads, the batches are sent longest first
+        executor = Executor(workers, worker_memory, __init_worker,
+                            (cache_size, None if arenas is None else {"src_layout": arenas[0].layout,
+                                                                      "sus_layout": arenas[1].layout,
+                                                                      "src": src_list, "sus": sus_list,
+                                                                      "folders": folders}))
+
+        if backend == "tiled":
+            if memory_budget is None:
+                memory_budget = (available_memory() or 2 ** 31) // 2
+
+            # Without shards the whole pair space is a single block
+            tile_blocks = blocks if shard is not None else [(sorted(sus_files, key=lambda path: path.name),
+                                                             sorted(src_files, key=lambda path: path.name))]
+            spill_folder = tempfile.TemporaryDirectory(prefix=".tiles-", dir=Path(output).resolve().parent)
+            func = __calc_tile_row
+            args, costs, src_tile_count = __plan_tile_rows(folders, tile_blocks, labels, memory_budget,
+                                                           executor.workers, spill_folder.name)
+            total = sum(costs)
+        elif backend == "sparse":
+            func = __calc_block
+            args = [(sus_block, src_block, folders,
+                     {sus.name: labels.get(sus.name, frozenset()) for sus in sus_block}
+                     if labels is not None else None) for sus_block, src_block in blocks]
+            costs = [len(sus_block) * len(src_block) for sus_block, src_block in blocks]
+            total = sum(costs)
+        else:
+            func = __calc_batch if arenas is None else __calc_arena_batch
+            args, total, costs = __make_batches(folders, blocks, labels, min_shared, approximate, bands,
+                                                min_jaccard, top_k, __score_key(rank_by),
+                                                ids if arenas is not None else None)
+
+        # Start workers, the rows are written from here as the batches arrive
+        sink = open_sink(output, header, fmt) if model is None else DetectionSink(output, header, model)
+        with executor, sink, tqdm(total=total, desc="Calculating distances...") as pbar:
+            # A task per chunk, the rows of every batch are written as soon as it's done instead of being held
+            # by the worker until the rest of his chunk is
+            results = executor.starmap(func, args, costs, max_chunk_tasks=1)
+            for _, (n, rows, pid, stats) in timed_iter("wait pairs", results, lambda result: result[1][0]):
+                with stage("write", n):
+                    # The tiled backend sends the spill file of the rows
+                    for chunk in (__read_spill(rows) if backend == "tiled" else [rows]):
+                        sink.write_rows(chunk)
+                lookups = stats["hits"] + stats["misses"]
+                if lookups > cache_stats.get(pid, {"lookups": -1})["lookups"]:
+                    cache_stats[pid] = dict(stats, lookups=lookups)
+                pbar.update(n)
+    finally:
+        if arenas is not None:
+            for feature_arena in arenas:
+                feature_arena.close()
+        if spill_folder is not None:
+            spill_folder.cleanup()
+
+    if shard is not None:
+        params = {"backend": backend, "block_size": block_size, "min_shared": min_shared, "approximate": approximate,
+                  "bands": bands, "min_jaccard": min_jaccard, "top_k": top_k,
+                  "rank_by": rank_by if top_k is not None else None}
+        ShardManifest(Path(output), shard[0], shard[1], job_fingerprint(src_files, sus_files, header, params),
+                      header, params, sink.rows_written, fmt=fmt).save()
+        print(f"Shard {shard[0] + 1}/{shard[1]}: {len(blocks)} blocks, {sink.rows_written} rows written to {output}")
+
+    if model is not None:
+        print(f"{sink.flagged} plagiarized pairs written to {output}")
 
-    # Start workers
-    args = list(zip([q] * len(pairs), pairs, [is_training] * len(pairs)))
-    workers = list(tqdm(pool.istarmap(__calc_distance, args),
-                        total=len(args),
-                        desc="Calculating distances..."))
+    if Profiling.is_enabled():
+        Profiling.add("write", bytes_written=Path(output).stat().st_size, calls=0)
 
-    # Break condition
-    q.put("kill")
-    pool.close()
-    pool.join()
+    # Stats are cumulative, so the last ones of every worker are summed
+    hits = sum(stats["hits"] for stats in cache_stats.values())
+    misses = sum(stats["misses"] for stats in cache_stats.values())
+    if backend == "tiled":
+        print(f"Tiles: {len(args)} sus tiles, {src_tile_count} src tiles, {misses} src tile loads and {hits} reuses"
+              f" over {len(cache_stats)} workers ({memory_budget / 2 ** 20:.0f} MB budget)")
+    else:
+        # The arenas hold the n-grams, only the dependency relations go through the cache then
+        if arena_bytes is not None:
+            print(f"Features arena: {arena_bytes / 2 ** 20:.1f} MB of n-grams shared by {len(cache_stats)} workers")
+        if arena_bytes is None or hits + misses:
+            print(f"Features cache: {hits} hits, {misses} misses"
+                  f" ({hits / max(hits + misses, 1):.1%} hit rate over {len(cache_stats)} workers)")
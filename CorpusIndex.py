@@ -0,0 +1,148 @@
+# Imports
+import json
+import os
+import pathlib
+import sqlite3
+
+from errors import *
+from errno import ENOENT
+from os import strerror
+
+
+class CorpusIndex:
+    """
+    Persisted metadata of the corpus folders in a SQLite database: path, size and mtime of every .txt and .xml
+    file and the plagiarism references of the suspicious .xml files. Refreshing only stats the files, the .xml
+    files are parsed again only when they change.
+    """
+    FILENAME = ".corpus-index.sqlite"
+    VERSION = 1
+
+    def __init__(self, db_path):
+        """
+        :param db_path: A Path object with the location of the database, or ":memory:".
+        """
+        self.db_path = db_path
+        self.__db = sqlite3.connect(str(db_path))
+        self.__db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS files (folder TEXT, name TEXT, size INTEGER, mtime REAL,
+                                              PRIMARY KEY (folder, name));
+            CREATE TABLE IF NOT EXISTS refs (folder TEXT, sus TEXT, source_file TEXT, props TEXT);
+            CREATE INDEX IF NOT EXISTS refs_sus ON refs (folder, sus);
+        """)
+
+        # Indexes from other versions are emptied, everything is refreshed
+        version = self.__db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version is None or int(version[0]) != self.VERSION:
+            self.__db.executescript("DELETE FROM files; DELETE FROM refs;")
+            self.__db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(self.VERSION),))
+            self.__db.commit()
+
+    def __repr__(self):
+        count = self.__db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        return "CorpusIndex of {} with {} files".format(self.db_path, count)
+
+    def close(self):
+        self.__db.close()
+
+    @classmethod
+    def for_folders(cls, *folders):
+        """
+        Opens the index next to the corpus folders (in the parent of the first one) and refreshes them. An in
+        memory index is used when that location isn't writable.
+        :param folders: Path objects with the folders of the .txt and .xml files.
+        :return: A CorpusIndex object.
+        """
+        folders = [pathlib.Path(folder).resolve() for folder in folders]
+        for folder in folders:
+            if not folder.is_dir():
+                raise FileNotFoundError(ENOENT, strerror(ENOENT), folder)
+
+        try:
+            index = cls(folders[0].parent / cls.FILENAME)
+        except sqlite3.OperationalError:
+            index = cls(":memory:")
+
+        for folder in folders:
+            index.refresh(folder)
+
+        return index
+
+    def refresh(self, folder: pathlib.PurePath) -> int:
+        """
+        Brings the metadata of a folder up to date: new or changed .xml files are parsed, removed files are dropped.
+        :param folder: A Path object with the folder.
+        :return: The number of new, changed or removed files.
+        """
+        if not isinstance(folder, pathlib.PurePath):
+            raise NotPurePathError("folder arg is not PurePath object")
+
+        # Imported here, PlagiarismDataHandler imports this module
+        from PlagiarismDataHandler import PlagiarismFile
+
+        key = str(pathlib.Path(folder).resolve())
+        known = {name: (size, mtime) for name, size, mtime in
+                 self.__db.execute("SELECT name, size, mtime FROM files WHERE folder = ?", (key,))}
+
+        current = {}
+        with os.scandir(key) as entries:
+            for entry in entries:
+                if entry.name.endswith((".txt", ".xml")) and entry.is_file():
+                    stat = entry.stat()
+                    current[entry.name] = (stat.st_size, stat.st_mtime)
+
+        changed = [name for name, meta in current.items() if known.get(name) != meta]
+        removed = [name for name in known if name not in current]
+
+        for name in removed + changed:
+            self.__db.execute("DELETE FROM files WHERE folder = ? AND name = ?", (key, name))
+            if name.endswith(".xml"):
+                self.__db.execute("DELETE FROM refs WHERE folder = ? AND sus = ?", (key, name[:-4] + ".txt"))
+
+        for name in changed:
+            self.__db.execute("INSERT INTO files VALUES (?, ?, ?, ?)", (key, name) + current[name])
+            if name.endswith(".xml"):
+                for ref in PlagiarismFile(pathlib.Path(key) / name).plagiarized_refs:
+                    self.__db.execute("INSERT INTO refs VALUES (?, ?, ?, ?)",
+                                      (key, name[:-4] + ".txt", ref["source_file"], json.dumps(ref)))
+
+        self.__db.commit()
+        return len(changed) + len(removed)
+
+    def paths(self, folder: pathlib.PurePath, suffix: str) -> list:
+        """
+        :param folder: A Path object with an indexed folder.
+        :param suffix: A string, ".txt" or ".xml".
+        :return: A list of Path objects sorted by name.
+        """
+        key = str(pathlib.Path(folder).resolve())
+        rows = self.__db.execute("SELECT name FROM files WHERE folder = ? AND name LIKE ? ORDER BY name",
+                                 (key, "%" + suffix))
+        return [pathlib.Path(folder) / name for name, in rows]
+
+    def plagiarized_refs(self, folder: pathlib.PurePath) -> dict:
+        """
+        :param folder: A Path object with an indexed suspicious folder.
+        :return: A dict with the name of every suspicious .txt file with plagiarism as the key and the list of his
+        references (as parsed by PlagiarismFile) as the value.
+        """
+        key = str(pathlib.Path(folder).resolve())
+        refs = {}
+        for sus, props in self.__db.execute("SELECT sus, props FROM refs WHERE folder = ? ORDER BY rowid", (key,)):
+            refs.setdefault(sus, []).append(json.loads(props))
+
+        return refs
+
+    def labels(self, folder: pathlib.PurePath) -> dict:
+        """
+        :param folder: A Path object with an indexed suspicious folder.
+        :return: A dict with the name of every suspicious .txt file with plagiarism as the key and a frozenset with
+        the names of his source files as the value.
+        """
+        key = str(pathlib.Path(folder).resolve())
+        labels = {}
+        for sus, source_file in self.__db.execute("SELECT sus, source_file FROM refs WHERE folder = ?", (key,)):
+            labels.setdefault(sus, set()).add(source_file)
+
+        return {sus: frozenset(sources) for sus, sources in labels.items()}
@@ -0,0 +1,214 @@
+# Imports
+import json
+import pathlib
+import numpy as np
+
+from contextlib import nullcontext
+from errors import *
+from errno import ENOENT
+from os import strerror
+from nltk.tokenize import word_tokenize
+from nltk.util import ngrams
+from PreprocessText import get_preprocessor
+from Executor import Executor
+from Profiling import profiled
+from Manifest import Manifest
+from NGram import NGram
+import tqdm
+
+
+# Worker function, needs to be at the top to be pickled
+@profiled
+def tokenize_protected(path: pathlib.PurePath):
+    with open(path, "r", encoding="utf-8-sig") as f:
+        return word_tokenize(f.read())
+
+
+class CorpusStore:
+    """
+    Tokenize-once store of a corpus: every document is kept as an int32 array of token ids in one packed file,
+    along with the vocabulary and per token lemma, lowercase, alpha and stopword tables. N-grams of any order and
+    set of transformations are derived from it with array operations, without running NLTK again. The lemma,
+    lowercase and stopword tables are only built for the transformations asked when the store is built.
+    """
+    VERSION = 1
+    # Transformations that need a table of their own, alpha is always kept
+    TABLES = ["lem", "lower", "stop"]
+
+    def __init__(self, folder: pathlib.PurePath):
+        # Check if we have a PurePath object
+        if not isinstance(folder, pathlib.PurePath):
+            raise NotPurePathError("folder arg is not PurePath object")
+
+        # Check if path exists, if not raise exception
+        if not (folder / "meta.json").exists():
+            raise FileNotFoundError(ENOENT, strerror(ENOENT), folder / "meta.json")
+
+        self.folder = folder
+        with open(folder / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(folder / "vocab.json", "r", encoding="utf-8") as f:
+            self.vocab = json.load(f)
+
+        self.lang = meta["lang"]
+        self.documents = meta["documents"]
+        # Stores written before the tables were optional have all of them
+        self.tables = meta.get("tables", self.TABLES)
+
+        # The tokens are memory mapped, the tables are small
+        self.tokens = np.load(folder / "tokens.npy", mmap_mode="r")
+        self.offsets = np.load(folder / "offsets.npy")
+        self.lemma = np.load(folder / "lemma.npy") if "lem" in self.tables else None
+        self.lower = np.load(folder / "lower.npy") if "lower" in self.tables else None
+        self.alpha = np.load(folder / "alpha.npy")
+        self.stop = np.load(folder / "stop.npy") if "stop" in self.tables else None
+
+    def __repr__(self):
+        return "CorpusStore with {} documents, {} tokens and {} types".format(len(self.documents),
+                                                                              len(self.tokens), len(self.vocab))
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __contains__(self, stem):
+        return stem in self.documents
+
+    @classmethod
+    def build(cls, paths: list, folder: pathlib.PurePath, lang: str = "english", executor: Executor = None,
+              transformations: list = None):
+        """
+        Tokenizes every document and writes the store.
+        :param paths: A list of Path objects with the .txt files, their stems must be unique.
+        :param folder: A Path object with the folder where the store is written.
+        :param lang: A string, which language to use for the stopwords.
+        :param executor: An Executor object used to tokenize, a new one is used if not given.
+        :param transformations: A list of strings with the transformations the store is used with, only their
+        tables are built (WordNet and the stopwords are only needed for lem and stop). Every table if not given.
+        :return: A CorpusStore object.
+        """
+        tables = [x for x in cls.TABLES if transformations is None or x in transformations]
+        if not isinstance(folder, pathlib.PurePath):
+            raise NotPurePathError("folder arg is not PurePath object")
+
+        folder.mkdir(parents=True, exist_ok=True)
+        vocab = {}
+        arrays = []
+
+        # The token ids depend on the order the documents are added, so the results are taken in order
+        with Executor() if executor is None else nullcontext(executor) as runner:
+            for _, word_tokens in tqdm.tqdm(runner.starmap(tokenize_protected, [(path,) for path in paths],
+                                                           [path.stat().st_size for path in paths], ordered=True),
+                                            total=len(paths),
+                                            desc="Tokenizing corpus"):
+                arrays.append(np.fromiter((vocab.setdefault(w, len(vocab)) for w in word_tokens), dtype=np.int32))
+
+        # Lemmas of the raw tokens, every distinct token is lemmatized once
+        raw_size = len(vocab)
+        preprocessor = get_preprocessor(lang)
+        if "lem" in tables:
+            lemma = np.array([vocab.setdefault(preprocessor.lemmatize(w), len(vocab)) for w in list(vocab)],
+                             dtype=np.int32)
+
+        # Lowercase of the raw tokens and the lemmas
+        if "lower" in tables:
+            lower = np.array([vocab.setdefault(w.lower(), len(vocab)) for w in list(vocab)], dtype=np.int32)
+        words = list(vocab)
+
+        # Tables cover the whole vocabulary, lemma and lower are the identity for the derived types
+        if "lem" in tables:
+            np.save(folder / "lemma.npy", np.concatenate([lemma, np.arange(raw_size, len(words), dtype=np.int32)]))
+        if "lower" in tables:
+            np.save(folder / "lower.npy", np.concatenate([lower, np.arange(len(lower), len(words), dtype=np.int32)]))
+        if "stop" in tables:
+            stop_words = preprocessor.stop_words
+            np.save(folder / "stop.npy", np.array([w in stop_words for w in words], dtype=bool))
+        alpha = np.array([w.isalpha() for w in words], dtype=bool)
+
+        # Tables of a previous build that aren't built now would be stale
+        for name, file_name in [("lem", "lemma.npy"), ("lower", "lower.npy"), ("stop", "stop.npy")]:
+            if name not in tables and (folder / file_name).exists():
+                (folder / file_name).unlink()
+
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+        tokens = np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int32)
+
+        np.save(folder / "tokens.npy", tokens)
+        np.save(folder / "offsets.npy", offsets)
+        np.save(folder / "alpha.npy", alpha)
+        with open(folder / "vocab.json", "w", encoding="utf-8") as f:
+            json.dump(words, f, ensure_ascii=False)
+
+        # Meta is written last, a store without it is incomplete
+        documents = {path.stem: {"index": i, "hash": Manifest.file_hash(path)} for i, path in enumerate(paths)}
+        with open(folder / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"version": cls.VERSION, "lang": lang, "tables": tables, "documents": documents}, f)
+
+        return cls(folder)
+
+    @classmethod
+    def for_files(cls, paths: list, folder: pathlib.PurePath, lang: str = "english", executor: Executor = None,
+                  transformations: list = None):
+        """
+        Loads the store of a folder, rebuilding it when it's missing, the documents have changed or it lacks the
+        table of a transformation.
+        :param paths: A list of Path objects with the .txt files.
+        :param folder: A Path object with the folder of the store.
+        :param lang: A string, which language to use for the stopwords.
+        :param executor: An Executor object used to tokenize when the store is rebuilt.
+        :param transformations: A list of strings with the transformations the store is used with, every one if
+        not given.
+        :return: A CorpusStore object.
+        """
+        needed = [x for x in cls.TABLES if transformations is None or x in transformations]
+        if (folder / "meta.json").exists():
+            store = cls(folder)
+            with open(folder / "meta.json", "r", encoding="utf-8") as f:
+                version = json.load(f).get("version")
+
+            current = {stem: doc["hash"] for stem, doc in store.documents.items()}
+            if version == cls.VERSION and store.lang == lang and \
+                    current == {path.stem: Manifest.file_hash(path) for path in paths}:
+                if set(needed) <= set(store.tables):
+                    return store
+
+                # The tables already built are kept, so alternating pipelines don't rebuild it every time
+                needed = [x for x in cls.TABLES if x in needed or x in store.tables]
+
+        return cls.build(paths, folder, lang, executor, needed)
+
+    def token_ids(self, stem: str, transformations: list = ["tok"]) -> np.ndarray:
+        """
+        Applies a set of transformations to the token ids of a document, in the same order as
+        PreprocessText.preprocess: stop, lem, alpha and lower.
+        :param stem: A string, name of the document without suffix.
+        :param transformations: A list of strings, "tok" is ignored.
+        :return: An int32 numpy array.
+        """
+        if stem not in self.documents:
+            raise KeyError(f"{stem} is not in the store")
+
+        missing = [x for x in self.TABLES if x in transformations and x not in self.tables]
+        if missing:
+            raise UnknownOption(f"The store was built without the {', '.join(missing)} tables")
+
+        i = self.documents[stem]["index"]
+        ids = np.asarray(self.tokens[self.offsets[i]:self.offsets[i + 1]])
+
+        if "stop" in transformations:
+            ids = ids[~self.stop[ids]]
+        if "lem" in transformations:
+            ids = self.lemma[ids]
+        if "alpha" in transformations:
+            ids = ids[self.alpha[ids]]
+        if "lower" in transformations:
+            ids = self.lower[ids]
+
+        return ids
+
+    def tokens_of(self, stem: str, transformations: list = ["tok"]) -> list:
+        return [self.vocab[i] for i in self.token_ids(stem, transformations).tolist()]
+
+    def ngram(self, stem: str, order: int, transformations: list = ["tok"], compact: bool = False) -> NGram:
+        transformations = transformations + ([] if "tok" in transformations else ["tok"])
+        return NGram(list(ngrams(self.tokens_of(stem, transformations), order)), order, compact, transformations)
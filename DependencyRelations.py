@@ -1,42 +1,259 @@
+import bisect
+import json
 import pathlib
+import struct
+import numpy as np
 
 from collections import Counter
+from nltk.tokenize import sent_tokenize
 from errors import *
 from errno import ENOENT
 from os import strerror
+from NGram import hash_ngrams, intersection_size
+
+# Binary .dep layout: magic, version, total relations and distinct relations, followed by the sorted
+# packed keys (uint64) and the count of every key (uint32)
+BINARY_MAGIC = b"DEPR"
+BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct("<4sHHQQ")
+
+# Separator of the texts parsed together, the tokenizer never puts a sentence across two paragraphs
+_BATCH_SEPARATOR = "\n\n"
+
+# Bits of every field of the packed keys: word, head word and deprel
+_WORD_BITS = 26
+_DEPREL_BITS = 12
 
 
 # TODO:
 #   - Add proper documentation to methods
 
-def _dep_rel_as_list(text, nlp):
+
+class DepVocabulary:
+    """
+    Shared vocabularies of words and deprel labels, used to encode the relations of every .dep file
+    of a corpus into comparable integer keys.
+    """
+    FILENAME = "dep-vocab.json"
+
+    def __init__(self, words: list = None, deprels: list = None):
+        self.words = {w: i for i, w in enumerate(words or [])}
+        self.deprels = {d: i for i, d in enumerate(deprels or [])}
+
+    def __repr__(self):
+        return "DepVocabulary with {} words and {} deprels".format(len(self.words), len(self.deprels))
+
+    @classmethod
+    def load(cls, file_path: pathlib.PurePath):
+        # Check if we have a PurePath object
+        if not isinstance(file_path, pathlib.PurePath):
+            raise NotPurePathError
+
+        if not file_path.exists():
+            return cls()
+
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["words"], data["deprels"])
+
+    def save(self, file_path: pathlib.PurePath):
+        # Check if we have a PurePath object
+        if not isinstance(file_path, pathlib.PurePath):
+            raise NotPurePathError
+
+        with open(file_path, "w", encoding="utf-8") as f:
+            json.dump({"words": list(self.words), "deprels": list(self.deprels)}, f, ensure_ascii=False)
+
+    def encode(self, dependencies: list) -> np.ndarray:
+        """
+        Packs every (word, head, deprel) triple into an uint64 key, unknown words and deprels are added.
+        :param dependencies: A list of tuples of strings.
+        :return: An uint64 numpy array with a key per relation.
+        """
+        keys = np.empty(len(dependencies), dtype=np.uint64)
+        for i, (word, head, deprel) in enumerate(dependencies):
+            w = self.words.setdefault(word, len(self.words))
+            h = self.words.setdefault(head, len(self.words))
+            d = self.deprels.setdefault(deprel, len(self.deprels))
+            keys[i] = (w << (_WORD_BITS + _DEPREL_BITS)) | (h << _DEPREL_BITS) | d
+
+        if len(self.words) > 2 ** _WORD_BITS or len(self.deprels) > 2 ** _DEPREL_BITS:
+            raise DepRelFormatError("Vocabulary too big to pack the relations")
+
+        return keys
+
+
+def is_binary_dep_file(file_path: pathlib.PurePath) -> bool:
+    with open(file_path, "rb") as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def dep_file_nbytes(file_path: pathlib.PurePath) -> int:
+    """
+    Estimated memory of a .dep file once loaded (the nbytes of his DependencyRelations) without loading it, from
+    the header of the binary files or the size and line count of the text ones.
+    :param file_path: A Path object with the location of the file.
+    :return: An int.
+    """
+    with open(file_path, "rb") as f:
+        head = f.read(_BINARY_HEADER.size)
+        if head[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+            return 12 * _BINARY_HEADER.unpack(head)[4]
+
+        # The text files start with a byte order mark
+        size, lines = len(head) - (3 if head.startswith(b"\xef\xbb\xbf") else 0), head.count(b"\n")
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            size += len(chunk)
+            lines += chunk.count(b"\n")
+
+    # A word~head~deprel relation per line, the last one without line break
+    relations = lines + 1 if size else 0
+    return size - 3 * relations + (3 * 49 + 64) * relations
+
+
+def encode_dep_folders(folders: list, vocab_path: pathlib.PurePath):
+    """
+    Rewrites every text .dep file of some folders into the binary format, with a vocabulary shared by all of them.
+    :param folders: A list of Path objects with the folders of the .dep files (e.g. source-dep and suspicious-dep).
+    :param vocab_path: A Path object with the location of the shared vocabulary, it's extended if it exists.
+    :return: The number of converted files.
+    """
+    vocab = DepVocabulary.load(vocab_path)
+    converted = 0
+
+    # The vocabulary is saved even if the run is interrupted, so the converted files stay comparable
+    try:
+        for folder in folders:
+            for path in sorted(folder.glob("*.dep")):
+                if is_binary_dep_file(path):
+                    continue
+
+                DependencyRelations.from_dep_file(path).encode(vocab).save(path, binary=True)
+                converted += 1
+    finally:
+        vocab.save(vocab_path)
+
+    return converted
+
+def _sentence_chunks(text, max_chars):
+    """
+    Private function used to split a long text into chunks of whole sentences of about max_chars characters,
+    so the parser never gets a huge document at once.
+    """
+    chunks = []
+    current = []
+    size = 0
+    for sentence in sent_tokenize(text):
+        if current and size + len(sentence) > max_chars:
+            chunks.append(" ".join(current))
+            current, size = [], 0
+        current.append(sentence)
+        size += len(sentence) + 1
+
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def _sentence_relations(sentence):
+    return [(w.text, sentence.words[w.head - 1].text if w.head > 0 else "root", w.deprel) for w in sentence.words]
+
+
+def _dep_rel_as_list(text, nlp, max_chars=None):
     dependencies = []
-    doc = nlp(text)
+    chunks = _sentence_chunks(text, max_chars) if max_chars and len(text) > max_chars else [text]
+
+    for chunk in chunks:
+        doc = nlp(chunk)
+
+        for s in doc.sentences:
+            dependencies.extend(_sentence_relations(s))
+    return dependencies
+
+
+def _dep_rel_batch(texts, nlp, max_chars=None):
+    """
+    Private function used to parse several texts with as few pipeline calls as possible. The texts (or their
+    chunks of whole sentences when longer than max_chars) are joined as paragraphs in calls of about max_chars
+    characters and every sentence goes back to his text by the offset of his first token. The Stanza 1.1
+    pipelines only take a single text, not a list of documents.
+    :param texts: A list of strings.
+    :param nlp: A Stanza pipeline.
+    :param max_chars: An int, size of the calls. Every text is parsed in the same call if not given.
+    :return: A list with the (word, head, deprel) tuples of every text.
+    """
+    pieces = []
+    for i, text in enumerate(texts):
+        chunks = _sentence_chunks(text, max_chars) if max_chars and len(text) > max_chars else [text]
+        pieces.extend((i, chunk) for chunk in chunks if chunk.strip())
+
+    calls = []
+    current, size = [], 0
+    for piece in pieces:
+        if current and max_chars and size + len(piece[1]) > max_chars:
+            calls.append(current)
+            current, size = [], 0
+        current.append(piece)
+        size += len(piece[1]) + len(_BATCH_SEPARATOR)
+
+    if current:
+        calls.append(current)
+
+    dependencies = [[] for _ in texts]
+    for call in calls:
+        starts = []
+        offset = 0
+        for _, chunk in call:
+            starts.append(offset)
+            offset += len(chunk) + len(_BATCH_SEPARATOR)
+
+        doc = nlp(_BATCH_SEPARATOR.join(chunk for _, chunk in call))
+        for s in doc.sentences:
+            owner = call[bisect.bisect_right(starts, s.tokens[0].start_char) - 1][0]
+            dependencies[owner].extend(_sentence_relations(s))
 
-    for s in doc.sentences:
-        for w in s.words:
-            dependencies.append((w.text,
-                                 s.words[w.head - 1].text if w.head > 0 else "root",
-                                 w.deprel))
     return dependencies
 
 
 class DependencyRelations:
-    def __init__(self, dependencies):
+    def __init__(self, dependencies, keys: np.ndarray = None, counts: np.ndarray = None):
+        """
+        :param dependencies: A list of (word, head, deprel) tuples, None for encoded relations.
+        :param keys: For encoded relations, a sorted uint64 numpy array with the distinct packed relations.
+        :param counts: For encoded relations, an uint32 numpy array with the number of times every key appears.
+        """
         self.__list = dependencies
+        self.__keys = keys
+        self.__counts = counts
+        self.compact = keys is not None
 
     def __repr__(self):
+        if self.compact:
+            head = "\n".join(str(x) for x in self.__keys[:5])
+            return "DependecyRelations (encoded)\nHead:\n{}\n ...".format(head)
+
         head = "\n".join(str(x) for x in self.__list[:5])
         return "DependecyRelations\nHead:\n{}\n ...".format(head)
 
     def __getitem__(self, item):
-        return self.__list[item]
+        return self.__keys[item] if self.compact else self.__list[item]
 
     def __iter__(self):
-        return iter(self.__list)
+        return iter(self.__keys if self.compact else self.__list)
+
+    def __len__(self):
+        return int(self.__counts.sum()) if self.compact else len(self.__list)
+
+    @property
+    def nbytes(self):
+        if self.compact:
+            return self.__keys.nbytes + self.__counts.nbytes
+
+        # Rough size of the tuples of strings, used by the features cache
+        return sum(sum(len(w) + 49 for w in x) + 64 for x in self.__list)
 
     @classmethod
-    def from_txt_file(cls, file_path: pathlib.PurePath, nlp):
+    def from_txt_file(cls, file_path: pathlib.PurePath, nlp, max_chars: int = None):
         # Check if we have a PurePath object
         if not isinstance(file_path, pathlib.PurePath):
             raise NotPurePathError
@@ -46,7 +263,30 @@ class DependencyRelations:
             raise FileNotFoundError(ENOENT, strerror(ENOENT), file_path)
 
         with open(file_path, "r", encoding="utf-8-sig") as f:
-            return cls(_dep_rel_as_list(f.read(), nlp))
+            return cls(_dep_rel_as_list(f.read(), nlp, max_chars))
+
+    @classmethod
+    def from_txt_files(cls, file_paths: list, nlp, max_chars: int = None) -> list:
+        """
+        Parses several documents together, the pipeline gets batches of them instead of one at a time.
+        :param file_paths: A list of Path objects with the .txt files.
+        :param nlp: A Stanza pipeline.
+        :param max_chars: An int, approximate size of every call to the pipeline, longer documents are parsed in
+        chunks of whole sentences.
+        :return: A list with the DependencyRelations object of every file.
+        """
+        texts = []
+        for file_path in file_paths:
+            if not isinstance(file_path, pathlib.PurePath):
+                raise NotPurePathError
+
+            if not (file_path.exists()):
+                raise FileNotFoundError(ENOENT, strerror(ENOENT), file_path)
+
+            with open(file_path, "r", encoding="utf-8-sig") as f:
+                texts.append(f.read())
+
+        return [cls(dependencies) for dependencies in _dep_rel_batch(texts, nlp, max_chars)]
 
     @classmethod
     def from_dep_file(cls, file_path: pathlib.PurePath):
@@ -58,23 +298,85 @@ class DependencyRelations:
         if not (file_path.exists()):
             raise FileNotFoundError(ENOENT, strerror(ENOENT), file_path)
 
+        if is_binary_dep_file(file_path):
+            with open(file_path, "rb") as f:
+                magic, version, _, count, cardinality = _BINARY_HEADER.unpack(f.read(_BINARY_HEADER.size))
+                if version > BINARY_VERSION:
+                    raise DepRelFormatError(f"{file_path} has an unsupported version ({version})")
+
+                keys = np.fromfile(f, dtype="<u8", count=cardinality)
+                counts = np.fromfile(f, dtype="<u4", count=cardinality)
+            return cls(None, keys, counts)
+
         with open(file_path, "r", encoding="utf-8-sig") as f:
             return cls([tuple(line.rstrip().split("~")) for line in f.readlines()])
 
     @classmethod
-    def from_str(cls, text_str: str, nlp):
-        return cls(_dep_rel_as_list(text_str, nlp))
+    def from_str(cls, text_str: str, nlp, max_chars: int = None):
+        return cls(_dep_rel_as_list(text_str, nlp, max_chars))
 
-    def save(self, file_path: pathlib.PurePath):
+    def encode(self, vocab: DepVocabulary):
+        """
+        :param vocab: A DepVocabulary object shared by every document that will be compared.
+        :return: A new encoded DependencyRelations object.
+        """
+        if self.compact:
+            return self
+
+        keys, counts = np.unique(vocab.encode(self.__list), return_counts=True)
+        return DependencyRelations(None, keys, counts.astype(np.uint32))
+
+    def hashes(self):
+        """
+        :return: A sorted uint64 numpy array with the distinct relations, packed keys if encoded or hashes if not.
+        """
+        return self.__keys if self.compact else hash_ngrams(self.__list)
+
+    def save(self, file_path: pathlib.PurePath, binary: bool = False):
         # Check if we have a PurePath object
         if not isinstance(file_path, pathlib.PurePath):
             raise NotPurePathError
 
+        if binary:
+            if not self.compact:
+                raise DepRelFormatError("Relations must be encoded with a DepVocabulary to be saved as binary")
+
+            with open(file_path, "wb") as f:
+                f.write(_BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, len(self), len(self.__keys)))
+                f.write(np.ascontiguousarray(self.__keys, dtype="<u8").tobytes())
+                f.write(np.ascontiguousarray(self.__counts, dtype="<u4").tobytes())
+            return
+
+        if self.compact:
+            raise DepRelFormatError("Encoded relations can only be saved as binary")
+
         with open(file_path, "w", encoding="utf-8-sig") as f:
             f.write("\n".join(["~".join(x) for x in self.__list]))
 
-    def similarity(self, dep):
-        a = Counter(self.__list)
-        b = Counter(list(dep))
+    def similarity(self, dep, multiset: bool = False):
+        """
+        Share of the relations of this object found in another one.
+        :param dep: A DependencyRelations object, encoded with the same vocabulary if this one is encoded.
+        :param multiset: A bool, if True repeated relations are counted as many times as they appear in both.
+        :return: A float between 0 and 1.
+        """
+        if self.compact != getattr(dep, "compact", False):
+            raise DepRelFormatError("Encoded and raw relations can't be compared")
+
+        if not self.compact:
+            a = Counter(self.__list)
+            b = Counter(list(dep))
+
+            if multiset:
+                return sum((a & b).values()) / sum(a.values())
+            return len(a & b) / len(a)
+
+        if not multiset:
+            return intersection_size(self.__keys, dep.__keys) / len(self.__keys)
 
-        return len(a & b) / len(a)
+        # Sorted keys, so the common ones are found with a binary search
+        idx = np.searchsorted(dep.__keys, self.__keys)
+        idx[idx == len(dep.__keys)] = 0
+        found = dep.__keys[idx] == self.__keys
+        common = np.minimum(self.__counts[found], dep.__counts[idx[found]])
+        return int(common.sum()) / int(self.__counts.sum())
@@ -0,0 +1,99 @@
+# Imports
+import pathlib
+import numpy as np
+import pandas as pd
+
+from errors import *
+from ScoresSink import ScoresSink, iter_scores
+
+# Columns of the scores that aren't features
+_NOT_FEATURES = ["src", "sus", "plagiarized"]
+
+
+def classify(model, X):
+    """
+    Runs a single predict_proba and derives the predicted class from it, as predict does.
+    :param model: A fitted classifier with predict_proba and classes_ (e.g. a DecisionTreeClassifier).
+    :param X: A 2D array or DataFrame with the features.
+    :return: A tuple with the predicted classes and the probability of the class 1.
+    """
+    proba = model.predict_proba(X)
+    classes = np.asarray(model.classes_)
+
+    prob = proba[:, list(classes).index(1)] if 1 in classes else np.zeros(len(proba))
+    return classes.take(np.argmax(proba, axis=1)), prob
+
+
+def check_features(model, columns: list):
+    features = [x for x in columns if x not in _NOT_FEATURES]
+    if len(model.feature_importances_) != len(features):
+        raise UnknownOption("Model features don't match with the scores vars number")
+
+    return features
+
+
+def flagged_pairs(model, chunk: pd.DataFrame) -> pd.DataFrame:
+    """
+    :param model: A fitted classifier.
+    :param chunk: A DataFrame with scores rows.
+    :return: A DataFrame with the src, sus and prob of the pairs predicted as plagiarized.
+    """
+    y, prob = classify(model, chunk.drop(_NOT_FEATURES, axis=1, errors="ignore"))
+    idx = np.nonzero(y == 1)[0]
+
+    return chunk.iloc[idx][["src", "sus"]].assign(prob=prob[idx])
+
+
+class DetectionSink(ScoresSink):
+    """
+    Scores sink that classifies every chunk of rows as it's written and only keeps the flagged pairs, so
+    scores and detect run as a single pipeline without the whole scores file.
+    """
+
+    def __init__(self, output: pathlib.PurePath, header: list, model, batch_rows: int = 65536):
+        super().__init__(output, header, batch_rows)
+        check_features(model, header)
+        self.model = model
+        self.flagged = 0
+        self.__f = open(output, "w", buffering=2 ** 20)
+        self.__f.write("src,sus,prob\n")
+
+    def _write_chunk(self, rows):
+        res = flagged_pairs(self.model, pd.DataFrame(rows, columns=self.header))
+        res.to_csv(self.__f, header=False, index=False)
+        self.flagged += len(res)
+
+    def close(self):
+        super().close()
+        self.__f.close()
+
+
+def detect_scores(scores: pathlib.PurePath, model, output: pathlib.PurePath, fmt: str = None,
+                  chunk_rows: int = 65536) -> int:
+    """
+    Classifies a scores file in chunks of chunk_rows rows and appends the flagged pairs to a CSV,
+    the memory used doesn't depend on the size of the scores.
+    :param scores: A Path object with the scores file.
+    :param model: A fitted classifier.
+    :param output: A Path object with the CSV of the flagged pairs (src, sus and prob).
+    :param fmt: A string, format of the scores file, inferred from the suffix when not given.
+    :param chunk_rows: An int, number of rows classified at once.
+    :return: The number of flagged pairs.
+    """
+    if not isinstance(output, pathlib.PurePath):
+        raise NotPurePathError("output arg is not PurePath object")
+
+    flagged = 0
+    with open(output, "w", buffering=2 ** 20) as f:
+        f.write("src,sus,prob\n")
+        for i, chunk in enumerate(iter_scores(scores, fmt, chunk_rows)):
+            if i == 0:
+                check_features(model, list(chunk.columns))
+            if not len(chunk):
+                continue
+
+            res = flagged_pairs(model, chunk)
+            res.to_csv(f, header=False, index=False)
+            flagged += len(res)
+
+    return flagged
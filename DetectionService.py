@@ -0,0 +1,282 @@
+# Imports
+import asyncio
+import json
+import pathlib
+import pickle
+import time
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+from errors import *
+from errno import ENOENT
+from os import strerror
+from multiprocessing import cpu_count
+from nltk.tokenize import word_tokenize
+from nltk.util import ngrams
+from BatchScoring import incidence_matrix
+from Detection import classify
+from NGram import NGram, hash_ngrams
+from PreprocessText import transform_pipelines
+from Profiling import profiled
+from tqdm import tqdm
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+            500: "Internal Server Error"}
+
+
+# Worker function, needs to be at the top to be pickled
+@profiled
+def preprocess_document(text: str, targets: list) -> list:
+    """
+    Computes the n-gram hashes of a suspicious document for every feature, the text is tokenized once.
+    :param text: A string, the content of the document.
+    :param targets: A list of tuples with the order and the transformations of every feature.
+    :return: A list with the sorted and deduplicated hashes of every feature.
+    """
+    pipelines = []
+    for _, opts in targets:
+        if opts not in pipelines:
+            pipelines.append(opts)
+
+    processed = transform_pipelines(word_tokenize(text), pipelines)
+    return [hash_ngrams(ngrams(processed[pipelines.index(opts)], order)) for order, opts in targets]
+
+
+class SourceFeature:
+    """
+    Resident incidence matrix of the source documents for one feature, the suspicious documents
+    are scored against it with a sparse matrix product.
+    """
+
+    def __init__(self, hash_arrays: list):
+        self.vocabulary = np.unique(np.concatenate(hash_arrays)) if hash_arrays else np.empty(0, dtype=np.uint64)
+        self.matrix = incidence_matrix(hash_arrays, self.vocabulary).T.tocsr()
+        self.cardinality = np.array([len(h) for h in hash_arrays], dtype=np.float64)
+
+    def jaccard(self, sus_hashes: list) -> np.ndarray:
+        """
+        :param sus_hashes: A list with the sorted and deduplicated hashes of every suspicious document.
+        :return: A numpy array of shape (len(sus_hashes), number of sources), same values as NGram.similarity.
+        """
+        # Hashes out of the vocabulary can't be shared, they only count in the cardinality
+        known = []
+        for hashes in sus_hashes:
+            idx = np.searchsorted(self.vocabulary, hashes)
+            idx[idx == len(self.vocabulary)] = 0
+            known.append(hashes[self.vocabulary[idx] == hashes] if len(self.vocabulary) else hashes[:0])
+
+        intersection = (incidence_matrix(known, self.vocabulary) @ self.matrix).toarray().astype(np.float64)
+        sus_card = np.array([len(h) for h in sus_hashes], dtype=np.float64)[:, None]
+        denominator = sus_card + self.cardinality[None, :] - intersection
+
+        return np.divide(intersection, denominator, out=np.zeros_like(intersection), where=denominator > 0)
+
+
+class DetectionService:
+    """
+    Local HTTP service keeping the source features and the model in memory. A suspicious document is sent
+    as the body of POST /detect and the flagged sources are returned as JSON. Concurrent requests are
+    gathered in batches, preprocessed in a process pool and scored together.
+    """
+
+    def __init__(self, feature_folder: pathlib.PurePath, model_path: pathlib.PurePath, workers: int = None,
+                 batch_size: int = 16, batch_wait: float = 0.005, max_body: int = 2 ** 24):
+        """
+        :param feature_folder: A Path object with the preprocessed features, only the source-*-ngram folders are used.
+        :param model_path: A Path object with the pickled classifier, trained on the scores of the same features.
+        :param workers: An int, number of preprocessing processes.
+        :param batch_size: An int, maximum number of documents scored together.
+        :param batch_wait: A float, seconds waited for more requests once the first one of a batch arrives.
+        :param max_body: An int, maximum size in bytes of a request body.
+        """
+        for path in [feature_folder, model_path]:
+            if not isinstance(path, pathlib.PurePath):
+                raise NotPurePathError("path arg is not PurePath object")
+
+            if not path.exists():
+                raise FileNotFoundError(ENOENT, strerror(ENOENT), path)
+
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_body = max_body
+        self.workers = workers or cpu_count()
+
+        with open(model_path, "rb") as f:
+            self.model = pickle.load(f)
+
+        # Same features and order as the scores columns
+        folders = {path.name.replace("source-", "", 1): path for path in feature_folder.glob("source-*-ngram")}
+        self.keys = sorted(folders)
+        if not self.keys:
+            raise TmpDirectoryError
+
+        if len(self.model.feature_importances_) != len(self.keys):
+            raise UnknownOption(f"The model uses {len(self.model.feature_importances_)} features but "
+                                f"{len(self.keys)} n-gram features were found")
+
+        # Order and transformations are taken from the folder name ({order}-{transformations}-ngram)
+        self.targets = [(int(key.split("-")[0]), key.split("-")[1:-1]) for key in self.keys]
+
+        self.sources = sorted(path.stem for path in folders[self.keys[0]].glob("*.NGram"))
+        self.features = []
+        for key in tqdm(self.keys, desc="Loading source features"):
+            hashes = [NGram.from_ngram_file(folders[key] / (stem + ".NGram")).hashes() for stem in self.sources]
+            self.features.append(SourceFeature(hashes))
+
+        self.__queue = None
+        self.__executor = None
+
+    def __repr__(self):
+        return "DetectionService with {} sources and features {}".format(len(self.sources), ", ".join(self.keys))
+
+    def detect(self, hashes: list, min_prob: float = None) -> list:
+        """
+        Scores a batch of preprocessed documents against every source.
+        :param hashes: A list with the output of preprocess_document for every document.
+        :param min_prob: A float, if given the sources with a probability >= min_prob are flagged instead of
+        the ones predicted as plagiarized.
+        :return: A list with the flagged sources of every document, as dicts with the src and his probability.
+        """
+        scores = [feature.jaccard([h[i] for h in hashes]) for i, feature in enumerate(self.features)]
+        X = np.stack([s.ravel() for s in scores], axis=1)
+
+        y, prob = classify(self.model, X)
+        prob = prob.reshape(len(hashes), -1)
+        flagged = prob >= min_prob if min_prob is not None else (y == 1).reshape(len(hashes), -1)
+
+        results = []
+        for i in range(len(hashes)):
+            idx = np.nonzero(flagged[i])[0]
+            idx = idx[np.argsort(-prob[i, idx], kind="stable")]
+            results.append([{"src": self.sources[j] + ".txt", "prob": float(prob[i, j])} for j in idx])
+
+        return results
+
+    async def __batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.__queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.__queue.get(), max(deadline - loop.time(), 0)))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                hashes = await asyncio.gather(*[loop.run_in_executor(self.__executor, preprocess_document, text,
+                                                                     self.targets) for text, _, _ in batch])
+
+                # Requests with different thresholds are scored apart
+                for min_prob in set(x for _, x, _ in batch):
+                    members = [i for i, (_, x, _) in enumerate(batch) if x == min_prob]
+                    results = await loop.run_in_executor(None, self.detect, [hashes[i] for i in members], min_prob)
+                    for i, result in zip(members, results):
+                        if not batch[i][2].done():
+                            batch[i][2].set_result(result)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def __respond(self, writer, status: int, body: dict, keep_alive: bool):
+        payload = json.dumps(body).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+                     f"Content-Type: application/json\r\n"
+                     f"Content-Length: {len(payload)}\r\n"
+                     f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + payload)
+        await writer.drain()
+
+    async def __handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                method, target, version = (request_line.decode("latin-1").split() + ["", "", ""])[:3]
+                url = urlsplit(target)
+                query = parse_qs(url.query)
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                length = int(headers.get("content-length", 0) or 0)
+
+                if length > self.max_body:
+                    await self.__respond(writer, 413, {"error": f"Body bigger than {self.max_body} bytes"}, False)
+                    break
+
+                body = await reader.readexactly(length) if length else b""
+                start = time.perf_counter()
+
+                if url.path == "/health":
+                    await self.__respond(writer, 200, {"sources": len(self.sources), "features": self.keys},
+                                         keep_alive)
+                elif url.path != "/detect":
+                    await self.__respond(writer, 404, {"error": f"{url.path} not found"}, keep_alive)
+                elif method != "POST":
+                    await self.__respond(writer, 405, {"error": "Send the document with POST"}, keep_alive)
+                else:
+                    try:
+                        min_prob = float(query["min_prob"][0]) if "min_prob" in query else None
+                        text = body.decode("utf-8-sig")
+                    except (ValueError, UnicodeDecodeError) as e:
+                        await self.__respond(writer, 400, {"error": str(e)}, keep_alive)
+                        continue
+
+                    future = asyncio.get_running_loop().create_future()
+                    await self.__queue.put((text, min_prob, future))
+                    try:
+                        flagged = await future
+                        await self.__respond(writer, 200, {"document": query.get("name", [None])[0],
+                                                           "flagged": flagged,
+                                                           "elapsed_ms": 1000 * (time.perf_counter() - start)},
+                                             keep_alive)
+                    except Exception as e:
+                        await self.__respond(writer, 500, {"error": str(e)}, False)
+                        break
+
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8080):
+        """
+        Starts the service and runs until it's cancelled.
+        :param host: A string, address to listen on.
+        :param port: An int, port to listen on.
+        :return: Nothing
+        """
+        self.__queue = asyncio.Queue()
+        with ProcessPoolExecutor(self.workers) as executor:
+            self.__executor = executor
+
+            # Start the worker processes now, not on the first request
+            await asyncio.gather(*[asyncio.get_running_loop().run_in_executor(executor, preprocess_document, "",
+                                                                              self.targets)
+                                   for _ in range(self.workers)])
+
+            batcher = asyncio.ensure_future(self.__batcher())
+            server = await asyncio.start_server(self.__handle, host, port)
+            print(f"Serving {self} on http://{host}:{port}")
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                batcher.cancel()
+
+    def run(self, host: str = "127.0.0.1", port: int = 8080):
+        try:
+            asyncio.run(self.serve(host, port))
+        except KeyboardInterrupt:
+            pass
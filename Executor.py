@@ -0,0 +1,165 @@
+# Imports
+import functools
+import os
+import multiprocessing.pool as mpp
+
+from multiprocessing import cpu_count
+from errors import *
+
+
+def available_memory() -> int:
+    """
+    :return: An int, bytes of memory available for new processes, None if it can't be known.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def worker_count(workers: int = None, memory_per_worker: int = None) -> int:
+    """
+    :param workers: An int, number of worker processes, cpu_count() + 2 by default.
+    :param memory_per_worker: An int, estimated bytes used by every worker. If given, the workers are capped so
+    all of them fit in the available memory.
+    :return: An int, number of workers to start.
+    """
+    count = workers or cpu_count() + 2
+    if count < 1:
+        raise UnknownOption(f"{count} is not a valid number of workers")
+
+    if memory_per_worker:
+        memory = available_memory()
+        if memory is not None:
+            count = max(1, min(count, memory // memory_per_worker))
+
+    return count
+
+
+def plan_chunks(costs: list, workers: int, chunks_per_worker: int = 4, max_tasks: int = None) -> list:
+    """
+    Orders the tasks longest first and groups them in chunks of about the same cost, so the long tasks start
+    first and run alone while the short ones are sent together at the end.
+    :param costs: A list with the estimated cost of every task (e.g. the size of his files).
+    :param workers: An int, number of workers.
+    :param chunks_per_worker: An int, chunks aimed for every worker.
+    :param max_tasks: An int, if given no chunk has more tasks.
+    :return: A list of lists with the indexes of the tasks of every chunk.
+    """
+    order = sorted(range(len(costs)), key=lambda i: costs[i], reverse=True)
+    target = sum(costs) / max(workers * chunks_per_worker, 1)
+
+    chunks = []
+    current, cost = [], 0
+    for i in order:
+        if current and (cost + costs[i] > target or len(current) == max_tasks):
+            chunks.append(current)
+            current, cost = [], 0
+        current.append(i)
+        cost += costs[i]
+
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _run_chunk(func, chunk):
+    # Worker side of Executor.starmap, needs to be at the top to be pickled
+    return [(i, func(*args)) for i, args in chunk]
+
+
+class Executor:
+    """
+    Process pool shared by the phases of a run. The tasks are scheduled longest first from a cost estimate
+    and sent in chunks sized from that cost, the pool is started on the first use and reused until closed.
+    """
+
+    def __init__(self, workers: int = None, memory_per_worker: int = None, initializer=None, initargs=()):
+        """
+        :param workers: An int, number of worker processes, cpu_count() + 2 by default.
+        :param memory_per_worker: An int, estimated bytes used by every worker, caps the workers to the available
+        memory when given.
+        :param initializer: A function called by every worker when it starts.
+        :param initargs: A tuple with the initializer args.
+        """
+        self.workers = worker_count(workers, memory_per_worker)
+        self.initializer = initializer
+        self.initargs = initargs
+        self.__pool = None
+
+    def __repr__(self):
+        return "Executor with {} workers ({})".format(self.workers, "running" if self.__pool else "not started")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    @property
+    def pool(self):
+        if self.__pool is None:
+            self.__pool = mpp.Pool(self.workers, initializer=self.initializer, initargs=self.initargs)
+
+        return self.__pool
+
+    def starmap(self, func, args: list, costs: list = None, ordered: bool = False, chunks_per_worker: int = 4,
+                max_chunk_tasks: int = None):
+        """
+        Runs func(*arg) for every arg in the workers.
+        :param func: A function at the top of his module, so it can be pickled.
+        :param args: A list of tuples with the args of every task.
+        :param costs: A list with the estimated cost of every task, the tasks are equally costly if not given.
+        :param ordered: A bool, if True the results are yielded in the order of args, else as they finish.
+        :param chunks_per_worker: An int, chunks aimed for every worker, fewer make bigger chunks.
+        :param max_chunk_tasks: An int, maximum tasks of a chunk. The results of a chunk are held by the worker
+        until the whole chunk is done, 1 sends every result back as soon as his task finishes.
+        :return: A generator of tuples with the index of the task in args and his result.
+        """
+        args = list(args)
+        if costs is None:
+            costs = [1] * len(args)
+        if len(costs) != len(args):
+            raise UnknownOption("A cost is needed for every task")
+
+        plan = plan_chunks(costs, self.workers, chunks_per_worker, max_chunk_tasks)
+        chunks = [[(i, args[i]) for i in chunk] for chunk in plan]
+        results = self.pool.imap_unordered(functools.partial(_run_chunk, func), chunks)
+
+        if not ordered:
+            for chunk in results:
+                yield from chunk
+            return
+
+        # Finished results wait here until the ones before them arrive
+        pending = {}
+        current = 0
+        for chunk in results:
+            pending.update(chunk)
+            while current in pending:
+                yield current, pending.pop(current)
+                current += 1
+
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+    def terminate(self):
+        if self.__pool is not None:
+            self.__pool.terminate()
+            self.__pool.join()
+            self.__pool = None
+
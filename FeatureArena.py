@@ -0,0 +1,163 @@
+# Imports
+import pathlib
+import shutil
+import numpy as np
+
+from multiprocessing import shared_memory
+from errors import *
+from NGram import NGram, intersection_size, ngram_file_cardinality
+from Profiling import stage
+
+
+def shared_memory_free() -> int:
+    """
+    :return: An int, bytes left for new shared memory segments (the free space of /dev/shm), None if it can't
+    be known.
+    """
+    try:
+        return shutil.disk_usage("/dev/shm").free
+    except OSError:
+        return None
+
+
+class FeatureArena:
+    """
+    N-gram hashes of a set of documents packed in shared memory, a segment per feature holding the offsets of
+    every document followed by his sorted hashes. It's built once by the main process and the pool workers
+    attach to it by name, so the documents are referenced by their integer id (position in the stems list).
+    """
+
+    def __init__(self, layout: dict, segments: dict, owner: bool = False):
+        """
+        Use create or attach instead.
+        :param layout: A dict with the number of documents and the segment name and hash count of every feature.
+        :param segments: A dict with the SharedMemory object of every feature.
+        :param owner: A bool, True in the process that created the segments and has to unlink them.
+        """
+        self.layout = layout
+        self.owner = owner
+        self.__segments = segments
+        self.__offsets = {}
+        self.__hashes = {}
+
+        docs = layout["docs"]
+        for key, (_, count) in layout["features"].items():
+            buffer = segments[key].buf
+            self.__offsets[key] = np.ndarray((docs + 1,), dtype=np.int64, buffer=buffer)
+            self.__hashes[key] = np.ndarray((count,), dtype=np.uint64, buffer=buffer, offset=8 * (docs + 1))
+
+    def __repr__(self):
+        return "FeatureArena with {} documents and features {} ({} bytes)".format(
+            self.layout["docs"], ", ".join(self.layout["features"]), self.nbytes)
+
+    def __len__(self):
+        return self.layout["docs"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def nbytes(self):
+        return sum(8 * (self.layout["docs"] + 1 + count) for _, count in self.layout["features"].values())
+
+    @staticmethod
+    def estimate_nbytes(folders: dict, stems: list) -> int:
+        """
+        Size of the segments create would make, from the headers of the .NGram files without loading them.
+        :param folders: A dict with the name of every feature as the key and the folder of his .NGram files as the
+        value.
+        :param stems: A list of strings with the name (without suffix) of every document.
+        :return: An int, bytes.
+        """
+        return sum(8 * (len(stems) + 1 + sum(ngram_file_cardinality(folder / (stem + ".NGram")) for stem in stems))
+                   for folder in folders.values())
+
+    @classmethod
+    def create(cls, folders: dict, stems: list):
+        """
+        Loads the .NGram files of every document into new shared memory segments, one document at a time.
+        :param folders: A dict with the name of every feature as the key and the folder of his .NGram files as the
+        value.
+        :param stems: A list of strings with the name (without suffix) of every document, his position is his id.
+        :return: A FeatureArena object, owner of the segments.
+        """
+        segments = {}
+        layout = {"docs": len(stems), "features": {}}
+        offsets = packed = None
+        try:
+            for key, folder in folders.items():
+                if not isinstance(folder, pathlib.PurePath):
+                    raise NotPurePathError("folder arg is not PurePath object")
+
+                # Sized from the headers, the documents are then copied one at a time so only one is loaded
+                paths = [folder / (stem + ".NGram") for stem in stems]
+                capacity = sum(ngram_file_cardinality(path) for path in paths)
+                segment = shared_memory.SharedMemory(create=True, size=max(8 * (len(stems) + 1 + capacity), 1))
+                segments[key] = segment
+
+                offsets = np.ndarray((len(stems) + 1,), dtype=np.int64, buffer=segment.buf)
+                packed = np.ndarray((capacity,), dtype=np.uint64, buffer=segment.buf, offset=8 * (len(stems) + 1))
+                offsets[0] = 0
+                with stage("arena load", len(stems)):
+                    for i, path in enumerate(paths):
+                        hashes = NGram.from_ngram_file(path).hashes()
+                        offsets[i + 1] = offsets[i] + len(hashes)
+                        packed[offsets[i]:offsets[i + 1]] = hashes
+
+                # Text files with repeated n-grams leave some unused space at the end
+                layout["features"][key] = (segment.name, int(offsets[-1]))
+                offsets = packed = None
+        except BaseException:
+            # The views have to be released before the segments are closed
+            offsets = packed = None
+            for segment in segments.values():
+                segment.close()
+                segment.unlink()
+            raise
+
+        return cls(layout, segments, owner=True)
+
+    @classmethod
+    def attach(cls, layout: dict):
+        """
+        :param layout: The layout attribute of the FeatureArena created by the main process.
+        :return: A FeatureArena object over the same segments.
+        """
+        segments = {key: shared_memory.SharedMemory(name=name) for key, (name, _) in layout["features"].items()}
+        return cls(layout, segments)
+
+    def hashes(self, key: str, doc: int) -> np.ndarray:
+        """
+        :param key: A string, name of the feature.
+        :param doc: An int, id of the document.
+        :return: A read only view of the sorted and deduplicated hashes of the document.
+        """
+        offsets = self.__offsets[key]
+        return self.__hashes[key][offsets[doc]:offsets[doc + 1]]
+
+    def jaccard(self, key: str, doc: int, other, other_doc: int) -> float:
+        """
+        :param key: A string, name of the feature.
+        :param doc: An int, id of the document in this arena.
+        :param other: A FeatureArena object with the other document.
+        :param other_doc: An int, id of the other document.
+        :return: A float, same value as NGram.similarity between both documents.
+        """
+        a = self.hashes(key, doc)
+        b = other.hashes(key, other_doc)
+        aintb = intersection_size(a, b)
+
+        return aintb / (len(a) + len(b) - aintb)
+
+    def close(self):
+        # The views have to be released before the segments are closed
+        self.__offsets = {}
+        self.__hashes = {}
+        for segment in self.__segments.values():
+            segment.close()
+            if self.owner:
+                segment.unlink()
+        self.__segments = {}
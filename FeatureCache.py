@@ -0,0 +1,65 @@
+# Imports
+from collections import OrderedDict
+
+
+class FeatureCache:
+    """
+    Bounded LRU cache of loaded features, the size is measured in bytes with the nbytes
+    attribute of the cached objects.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.__items = OrderedDict()
+
+    def __repr__(self):
+        return "FeatureCache with {} items ({}/{} bytes)".format(len(self.__items), self.size, self.max_bytes)
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __contains__(self, key):
+        return key in self.__items
+
+    def get(self, path, feature: str, loader):
+        """
+        Returns the cached feature or loads it when it's not cached.
+        :param path: A Path object with the location of the feature file.
+        :param feature: A string with the name of the feature.
+        :param loader: A function used to load the file on a miss.
+        :return: The loaded feature.
+        """
+        key = (str(path), feature)
+
+        if key in self.__items:
+            self.hits += 1
+            self.__items.move_to_end(key)
+            return self.__items[key]
+
+        self.misses += 1
+        value = loader(path)
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        nbytes = value.nbytes
+
+        # Features bigger than the whole cache are not kept
+        if nbytes > self.max_bytes:
+            return
+
+        if key in self.__items:
+            self.size -= self.__items.pop(key).nbytes
+
+        # Evict the least recently used
+        while self.__items and self.size + nbytes > self.max_bytes:
+            self.size -= self.__items.popitem(last=False)[1].nbytes
+
+        self.__items[key] = value
+        self.size += nbytes
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "items": len(self.__items), "bytes": self.size}
@@ -0,0 +1,73 @@
+# Imports
+import hashlib
+import json
+import pathlib
+
+from errors import *
+
+
+class Manifest:
+    """
+    Record of the documents preprocessed into an output folder: the content hash of every source .txt
+    and the parameters used, so reruns only process new or changed documents.
+    """
+    FILENAME = "manifest.json"
+    VERSION = 1
+
+    def __init__(self, folder: pathlib.PurePath):
+        if not isinstance(folder, pathlib.PurePath):
+            raise NotPurePathError("folder arg is not PurePath object")
+
+        self.folder = folder
+        self.documents = {}
+
+        path = folder / self.FILENAME
+        if path.exists():
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+
+            # Manifests from other versions are ignored, everything is regenerated
+            if data.get("version") == self.VERSION:
+                self.documents = data["documents"]
+
+    def __repr__(self):
+        return "Manifest of {} with {} documents".format(self.folder, len(self.documents))
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __contains__(self, stem):
+        return stem in self.documents
+
+    @staticmethod
+    def file_hash(path: pathlib.PurePath) -> str:
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b""):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def is_current(self, stem: str, digest: str, params: dict) -> bool:
+        """
+        :param stem: A string, name of the document without suffix.
+        :param digest: A string, content hash of the document.
+        :param params: A dict with the preprocessing parameters.
+        :return: A bool, True if the document was processed from the same content with the same parameters.
+        """
+        return self.documents.get(stem) == dict(params, hash=digest)
+
+    def update(self, stem: str, digest: str, params: dict):
+        self.documents[stem] = dict(params, hash=digest)
+
+    def remove(self, stem: str):
+        self.documents.pop(stem, None)
+
+    def save(self):
+        # Write to a temporary file first so an interrupted run doesn't leave a broken manifest
+        path = self.folder / self.FILENAME
+        tmp_path = self.folder / (self.FILENAME + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": self.VERSION, "documents": self.documents}, f, indent=1, sort_keys=True)
+
+        pathlib.Path(tmp_path).replace(path)
@@ -0,0 +1,147 @@
+# Imports
+import pathlib
+import numpy as np
+
+from errors import *
+from errno import ENOENT
+from os import strerror
+
+# Universal hashing constants, the n-gram hashes are truncated to 32 bits
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def _permutations(num_perm: int, seed: int):
+    """
+    Private function used to draw the (a, b) coefficients of the hash functions. The same
+    seed always gives the same coefficients, so signatures computed in different runs are comparable.
+    :param num_perm: An int, number of hash functions.
+    :param seed: An int, seed of the generator.
+    :return: A tuple of two uint64 numpy arrays.
+    """
+    gen = np.random.RandomState(seed)
+    a = gen.randint(1, _MERSENNE_PRIME, num_perm, dtype=np.uint64)
+    b = gen.randint(0, _MERSENNE_PRIME, num_perm, dtype=np.uint64)
+    return a, b
+
+
+class MinHash:
+    """
+    MinHash signature of a set of n-grams, used to estimate the Jaccard coefficient
+    between two documents in constant time and memory.
+    """
+    SUFFIX = ".minhash"
+
+    def __init__(self, signature: np.ndarray, seed: int = 1):
+        self.signature = signature
+        self.seed = seed
+
+    def __repr__(self):
+        return "MinHash object with {} permutations".format(len(self.signature))
+
+    def __len__(self):
+        return len(self.signature)
+
+    @classmethod
+    def from_ngram(cls, ngram, num_perm: int = 128, seed: int = 1):
+        a, b = _permutations(num_perm, seed)
+        hashes = np.asarray(ngram.hashes(), dtype=np.uint64) & _MAX_HASH
+
+        if not len(hashes):
+            return cls(np.full(num_perm, _MAX_HASH, dtype=np.uint64), seed)
+
+        # Overflow is expected, it's part of the hash function
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, a) + b) % _MERSENNE_PRIME & _MAX_HASH
+
+        return cls(permuted.min(axis=0), seed)
+
+    @classmethod
+    def from_minhash_file(cls, file_path: pathlib.PurePath):
+        # Check if we have a PurePath object
+        if not isinstance(file_path, pathlib.PurePath):
+            raise NotPurePathError
+
+        # Check if path exists, if not raise exception
+        if not (file_path.exists()):
+            raise FileNotFoundError(ENOENT, strerror(ENOENT), file_path)
+
+        with open(file_path, "rb") as f:
+            seed = int(np.load(f))
+            return cls(np.load(f), seed)
+
+    def jaccard(self, minhash):
+        """
+        Estimates the Jaccard coefficient between the two sets the signatures were computed from.
+        :param minhash: A MinHash object with the same number of permutations and seed.
+        :return: A float between 0 and 1.
+        """
+        if len(self) != len(minhash) or self.seed != minhash.seed:
+            raise MinHashMismatchError
+
+        return float(np.count_nonzero(self.signature == minhash.signature)) / len(self)
+
+    def save(self, file_path: pathlib.PurePath):
+        # Check if we have a PurePath object
+        if not isinstance(file_path, pathlib.PurePath):
+            raise NotPurePathError
+
+        with open(file_path, "wb") as f:
+            np.save(f, np.uint64(self.seed))
+            np.save(f, self.signature)
+
+
+class LSHIndex:
+    """
+    Locality sensitive hashing index over MinHash signatures. Signatures are split into bands
+    and two documents become candidates when they fall in the same bucket for some band.
+    """
+
+    def __init__(self, bands: int = 32):
+        self.bands = bands
+        self.__buckets = [{} for _ in range(bands)]
+        self.__keys = set()
+
+    def __repr__(self):
+        return "LSHIndex with {} bands over {} documents".format(self.bands, len(self.__keys))
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def __band_keys(self, minhash):
+        if len(minhash) % self.bands:
+            raise MinHashMismatchError(f"{len(minhash)} permutations can't be split in {self.bands} bands")
+
+        rows = len(minhash) // self.bands
+        sig = minhash.signature
+        return [sig[i * rows:(i + 1) * rows].tobytes() for i in range(self.bands)]
+
+    @classmethod
+    def from_minhash_folder(cls, folder: pathlib.PurePath, bands: int = 32):
+        """
+        Builds the index with every signature of a folder, the key of each document is his stem.
+        :param folder: A Path object with the folder of the preprocessed features.
+        :param bands: Number of bands the signatures are split into.
+        :return: A LSHIndex object.
+        """
+        # Check if we have a PurePath object
+        if not isinstance(folder, pathlib.PurePath):
+            raise NotPurePathError("folder arg is not PurePath object")
+
+        index = cls(bands)
+        for path in sorted(folder.glob("*" + MinHash.SUFFIX)):
+            index.insert(path.stem, MinHash.from_minhash_file(path))
+
+        return index
+
+    def insert(self, key, minhash):
+        self.__keys.add(key)
+        for bucket, band in zip(self.__buckets, self.__band_keys(minhash)):
+            bucket.setdefault(band, []).append(key)
+
+    def query(self, minhash):
+        candidates = set()
+        for bucket, band in zip(self.__buckets, self.__band_keys(minhash)):
+            candidates.update(bucket.get(band, ()))
+
+        return candidates
@@ -1,24 +1,183 @@
 # Imports
 import pathlib
+import hashlib
+import struct
+import sys
+import numpy as np
 
 from nltk.tokenize import word_tokenize
 from nltk.util import ngrams
 from errors import *
 from errno import ENOENT
 from os import strerror
-from PreprocessText import preprocess
+from PreprocessText import get_preprocessor
+
+
+# Binary .NGram layout: magic, version, order, flags, count, cardinality and the length of the
+# transformations string, followed by the string itself, padding up to 8 bytes and the hashes
+BINARY_MAGIC = b"NGRM"
+BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct("<4sHHIQQI")
+_FLAG_HASHED = 1
+
+
+def ngram_hash(ngram: tuple) -> int:
+    """
+    Stable 64 bit hash of an n-gram, it doesn't depend on PYTHONHASHSEED so it can be persisted.
+    :param ngram: A tuple of strings.
+    :return: An unsigned 64 bit int.
+    """
+    return int.from_bytes(hashlib.blake2b("~".join(ngram).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def hash_ngrams(ngram_list) -> np.ndarray:
+    """
+    Hashes a list of n-grams.
+    :param ngram_list: An iterable of tuples of strings.
+    :return: A sorted and deduplicated uint64 numpy array.
+    """
+    return np.unique(np.fromiter((ngram_hash(x) for x in ngram_list), dtype=np.uint64))
+
+
+def intersection_size(a: np.ndarray, b: np.ndarray) -> int:
+    """
+    Number of common elements between two sorted and deduplicated arrays.
+    :param a: A sorted numpy array without repeated values.
+    :param b: A sorted numpy array without repeated values.
+    :return: An int.
+    """
+    # Look up the smaller array in the bigger one
+    if len(a) > len(b):
+        a, b = b, a
+
+    if not len(a):
+        return 0
+
+    idx = np.searchsorted(b, a)
+    idx[idx == len(b)] = 0
+    return int(np.count_nonzero(b[idx] == a))
+
+
+def _binary_header_size(transformations: bytes) -> int:
+    size = _BINARY_HEADER.size + len(transformations)
+    return size + (-size % 8)
+
+
+def _read_binary_ngram(file_path: pathlib.PurePath):
+    """
+    Private function used to open a binary .NGram file, the hashes are read in a single call so nothing is parsed.
+    They're copied into memory instead of memory mapped, a map per document would keep a file descriptor open
+    for every loaded NGram and a block of them runs out of descriptors.
+    :param file_path: A Path object with the location of the file.
+    :return: A tuple with the header fields as a dict and the uint64 hashes.
+    """
+    with open(file_path, "rb") as f:
+        fields = _BINARY_HEADER.unpack(f.read(_BINARY_HEADER.size))
+        magic, version, order, flags, count, cardinality, trans_len = fields
+        transformations = f.read(trans_len)
+
+        if magic != BINARY_MAGIC or version > BINARY_VERSION:
+            raise NGramFormatError(f"{file_path} has an unsupported version ({version})")
+
+        f.seek(_binary_header_size(transformations))
+        hashes = np.fromfile(f, dtype="<u8", count=cardinality).astype(np.uint64, copy=False)
+
+    if len(hashes) != cardinality:
+        raise NGramFormatError(f"{file_path} is truncated ({len(hashes)} of {cardinality} hashes)")
+
+    header = {"order": order,
+              "count": count,
+              "transformations": transformations.decode("utf-8").split("-") if transformations else None}
+
+    return header, hashes
+
+
+def convert_ngram_folder(folder: pathlib.PurePath, transformations: list = None):
+    """
+    Rewrites every text .NGram file of a folder into the binary format. The raw tokens are lost,
+    only their hashes are kept.
+    :param folder: A Path object with the folder of the preprocessed features.
+    :param transformations: A list of strings stored in the header, if not given it's taken from the folder
+    name (source-{order}-{transformations}-ngram).
+    :return: The number of converted files.
+    """
+    # Check if we have a PurePath object
+    if not isinstance(folder, pathlib.PurePath):
+        raise NotPurePathError("folder arg is not PurePath object")
+
+    if transformations is None:
+        transformations = folder.name.split("-")[2:-1]
+
+    converted = 0
+    for path in sorted(folder.glob("*.NGram")):
+        if is_binary_ngram_file(path):
+            continue
+
+        ngram = NGram.from_ngram_file(path)
+        ngram.transformations = transformations
+        ngram.save(path, binary=True)
+        converted += 1
+
+    return converted
+
+
+def ngram_file_cardinality(file_path: pathlib.PurePath) -> int:
+    """
+    Number of hashes of a .NGram file without loading it, read from the header of the binary files. For the
+    text ones it's their number of lines, an upper bound since repeated n-grams are counted.
+    :param file_path: A Path object with the location of the file.
+    :return: An int.
+    """
+    with open(file_path, "rb") as f:
+        head = f.read(_BINARY_HEADER.size)
+        if head[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+            return _BINARY_HEADER.unpack(head)[5]
+
+        # The first line is the header and the last one has no line break
+        lines = head.count(b"\n")
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            lines += chunk.count(b"\n")
+
+    return lines
+
+
+def is_binary_ngram_file(file_path: pathlib.PurePath) -> bool:
+    with open(file_path, "rb") as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
 
 
 # TODO:
 #   - Add proper documentation to methods
 class NGram:
-    def __init__(self, ngram_list: list, order: int):
+    def __init__(self, ngram_list, order: int, compact: bool = False, transformations: list = None,
+                 count: int = None, offsets: np.ndarray = None):
+        """
+        :param ngram_list: A list of tuples of strings, when compact is True it can also be
+        an already hashed uint64 numpy array.
+        :param order: The order of the n-grams.
+        :param compact: A bool, if True only the sorted and deduplicated hashes of the n-grams are kept.
+        :param transformations: A list of strings with the transformations applied to the text, if known.
+        :param count: Total number of n-grams (repeated ones included), only needed for hashed lists.
+        :param offsets: An int64 numpy array with the start and end character offsets in the text of every n-gram,
+        in the same order as ngram_list. They're kept in memory only, the .NGram files don't store them.
+        """
         self.order = order
+        self.compact = compact
+        self.transformations = transformations
+        self.offsets = offsets
+        self.count = len(ngram_list) if count is None else count
+
+        if compact and not isinstance(ngram_list, np.ndarray):
+            ngram_list = hash_ngrams(ngram_list)
+
         self.__list = ngram_list
+        self.__hashes = ngram_list if compact else None
+        self.__set = None
 
     def __repr__(self):
         head = "\n".join(str(x) for x in self.__list[:5])
-        return "NGram object of order {}\nHead:\n{}\n ...".format(self.order, head)
+        return "NGram object of order {}{}\nHead:\n{}\n ...".format(self.order, " (compact)" if self.compact else "",
+                                                                   head)
 
     def __getitem__(self, item):
         return self.__list[item]
@@ -26,8 +185,12 @@ class NGram:
     def __iter__(self):
         return iter(self.__list)
 
+    def __len__(self):
+        return len(self.__list)
+
     @classmethod
-    def from_txt_file(cls, file_path: pathlib.PurePath, order: int, transformations: list = ["tok"]):
+    def from_txt_file(cls, file_path: pathlib.PurePath, order: int, transformations: list = ["tok"],
+                      compact: bool = False, offsets: bool = False):
         # Check if we have a PurePath object
         if not isinstance(file_path, pathlib.PurePath):
             raise NotPurePathError
@@ -41,8 +204,18 @@ class NGram:
             if "tok" not in transformations:
                 transformations.append("tok")
 
-            text = preprocess(f.read(), transformations)
-            return cls(list(ngrams(text, order)), order)
+            if not offsets:
+                text = get_preprocessor().preprocess(f.read(), transformations)
+                return cls(list(ngrams(text, order)), order, compact, transformations)
+
+            if compact:
+                raise NGramFormatError("Compact n-grams don't keep their positions")
+
+            # Every n-gram goes from the start of his first token to the end of his last one
+            text, spans = get_preprocessor().preprocess_spans(f.read(), transformations)
+            count = max(len(text) - order + 1, 0)
+            ngram_offsets = np.stack([spans[:count, 0], spans[order - 1:order - 1 + count, 1]], axis=1)
+            return cls(list(ngrams(text, order)), order, compact, transformations, offsets=ngram_offsets)
 
     @classmethod
     def from_ngram_file(cls, file_path: pathlib.PurePath):
@@ -54,25 +227,88 @@ class NGram:
         if not (file_path.exists()):
             raise FileNotFoundError(ENOENT, strerror(ENOENT), file_path)
 
+        if is_binary_ngram_file(file_path):
+            header, hashes = _read_binary_ngram(file_path)
+            return cls(hashes, header["order"], True, header["transformations"], header["count"])
+
         with open(file_path, "r", encoding="utf-8-sig") as f:
             lines = f.readlines()
-            return cls([tuple(line.rstrip().split("~")) for line in lines[1:]], int(lines[0]))
+            header = lines[0].split()
+
+            # Compact files store one hash per line
+            if header[1:] == ["hashed"]:
+                return cls(np.array([int(line) for line in lines[1:]], dtype=np.uint64), int(header[0]), True)
+
+            return cls([tuple(line.rstrip().split("~")) for line in lines[1:]], int(header[0]))
 
     @classmethod
-    def from_str(cls, text_str: str, order: int, transformations: list = ["tok"]):
+    def from_str(cls, text_str: str, order: int, transformations: list = ["tok"], compact: bool = False):
         # Force tokenization, required for ngrams
         if "tok" not in transformations:
             transformations.append("tok")
 
-        return cls(list(ngrams(word_tokenize(text_str), order)), order)
+        return cls(list(ngrams(word_tokenize(text_str), order)), order, compact, transformations)
+
+    def hashes(self):
+        """
+        :return: A sorted uint64 numpy array with the hashes of the distinct n-grams.
+        """
+        if self.__hashes is None:
+            self.__hashes = hash_ngrams(self.__list)
+
+        return self.__hashes
+
+    def position_hashes(self):
+        """
+        :return: An uint64 numpy array with the hash of every n-gram in text order, repeated ones included.
+        """
+        if self.compact:
+            raise NGramFormatError("Compact n-grams don't keep their positions")
+
+        return np.fromiter((ngram_hash(x) for x in self.__list), dtype=np.uint64, count=len(self.__list))
+
+    def as_set(self):
+        """
+        :return: A frozenset with the distinct n-grams, it's built once and kept.
+        """
+        if self.__set is None:
+            self.__set = frozenset(self.__list)
+
+        return self.__set
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory used by the object, the n-grams set included if it has been built.
+        """
+        if self.compact:
+            return self.__list.nbytes
+
+        size = sys.getsizeof(self.__list) + sum(sys.getsizeof(x) + sum(sys.getsizeof(w) for w in x)
+                                                for x in self.__list)
+        if self.__set is not None:
+            size += sys.getsizeof(self.__set)
+
+        return size
 
     def similarity(self, ngram, coef_type: str = "jaccard"):
         if coef_type not in ["jaccard", "containment"]:
             raise NGramUnknownCoefficient
 
+        # Hashed n-grams can't be compared against the raw ones, use the hashes on both sides
+        if self.compact or getattr(ngram, "compact", False):
+            a = self.hashes()
+            b = ngram.hashes() if isinstance(ngram, NGram) else hash_ngrams(ngram)
+            aintb = intersection_size(a, b)
+
+            if coef_type == "jaccard":
+                return aintb / (len(a) + len(b) - aintb)
+            else:
+                return aintb / len(a)
+
         # Add some clarity and avoid recomputing sets
-        a = set(self.__list)
-        b = set(list(ngram))
+        a = self.as_set()
+        b = ngram.as_set() if isinstance(ngram, NGram) else set(list(ngram))
         aintb = a & b
 
         if coef_type == "jaccard":
@@ -80,11 +316,31 @@ class NGram:
         else:
             return len(aintb) / len(a)
 
-    def save(self, file_path: pathlib.PurePath):
+    def save(self, file_path: pathlib.PurePath, binary: bool = False):
         # Check if we have a PurePath object
         if not isinstance(file_path, pathlib.PurePath):
             raise NotPurePathError
 
+        if binary:
+            hashes = self.hashes()
+            transformations = "-".join(self.transformations or []).encode("utf-8")
+            header = _BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, self.order, _FLAG_HASHED, self.count,
+                                         len(hashes), len(transformations))
+
+            # Write to a temporary file first, a partially written file never replaces the original one
+            tmp_path = file_path.with_name(file_path.name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(header + transformations)
+                f.write(b"\0" * (_binary_header_size(transformations) - len(header) - len(transformations)))
+                f.write(np.ascontiguousarray(hashes, dtype="<u8").tobytes())
+
+            pathlib.Path(tmp_path).replace(file_path)
+            return
+
         with open(file_path, "w", encoding="utf-8-sig") as f:
-            f.write(str(self.order) + "\n")
-            f.write("\n".join(["~".join(x) for x in self.__list]))
+            if self.compact:
+                f.write(str(self.order) + " hashed\n")
+                f.write("\n".join([str(x) for x in self.__list]))
+            else:
+                f.write(str(self.order) + "\n")
+                f.write("\n".join(["~".join(x) for x in self.__list]))
@@ -0,0 +1,111 @@
+# Imports
+import pathlib
+import pickle
+
+from collections import Counter
+from errors import *
+from errno import ENOENT
+from os import strerror
+from NGram import *
+from tqdm import tqdm
+
+
+class NGramIndex:
+    """
+    Inverted index mapping every n-gram hash of a folder of .NGram files to the
+    list of documents (posting list) where it appears.
+    """
+    # Name of the persisted index inside the indexed folder
+    FILENAME = "postings.index"
+
+    def __init__(self, postings: dict, documents: list, mtime: float = 0.0):
+        self.postings = postings
+        self.documents = documents
+        self.mtime = mtime
+
+    def __repr__(self):
+        return "NGramIndex with {} n-grams over {} documents".format(len(self.postings), len(self.documents))
+
+    def __len__(self):
+        return len(self.documents)
+
+    @classmethod
+    def from_ngram_folder(cls, folder: pathlib.PurePath):
+        """
+        Builds the index reading every .NGram file of a folder.
+        :param folder: A Path object with the folder of the preprocessed features.
+        :return: A NGramIndex object.
+        """
+        # Check if we have a PurePath object
+        if not isinstance(folder, pathlib.PurePath):
+            raise NotPurePathError("folder arg is not PurePath object")
+
+        # Check if path exists, if not raise exception
+        if not (folder.exists()):
+            raise FileNotFoundError(ENOENT, strerror(ENOENT), folder)
+
+        postings = {}
+        documents = []
+        paths = sorted(folder.glob("*.NGram"))
+
+        for doc_id, path in enumerate(tqdm(paths, desc=f"Indexing {folder.name}...")):
+            documents.append(path.stem)
+            for h in NGram.from_ngram_file(path).hashes().tolist():
+                postings.setdefault(h, []).append(doc_id)
+
+        return cls(postings, documents, max((p.stat().st_mtime for p in paths), default=0.0))
+
+    @classmethod
+    def load(cls, file_path: pathlib.PurePath):
+        # Check if we have a PurePath object
+        if not isinstance(file_path, pathlib.PurePath):
+            raise NotPurePathError
+
+        # Check if path exists, if not raise exception
+        if not (file_path.exists()):
+            raise FileNotFoundError(ENOENT, strerror(ENOENT), file_path)
+
+        with open(file_path, "rb") as f:
+            return pickle.load(f)
+
+    @classmethod
+    def for_folder(cls, folder: pathlib.PurePath):
+        """
+        Loads the persisted index of a folder, rebuilding (and saving) it when it's missing or
+        some .NGram file has been added, removed or modified since it was built.
+        :param folder: A Path object with the folder of the preprocessed features.
+        :return: A NGramIndex object.
+        """
+        index_path = folder / cls.FILENAME
+        paths = list(folder.glob("*.NGram"))
+
+        if index_path.exists():
+            index = cls.load(index_path)
+            mtime = max((p.stat().st_mtime for p in paths), default=0.0)
+            if index.mtime == mtime and sorted(index.documents) == sorted(p.stem for p in paths):
+                return index
+
+        index = cls.from_ngram_folder(folder)
+        index.save(index_path)
+        return index
+
+    def candidates(self, ngram, min_shared: int = 1):
+        """
+        Gathers the indexed documents sharing n-grams with a given one.
+        :param ngram: A NGram object.
+        :param min_shared: Minimum number of distinct shared n-grams for a document to be returned.
+        :return: A dict with the document name as the key and the number of shared n-grams as the value.
+        """
+        shared = Counter()
+        for h in ngram.hashes().tolist():
+            shared.update(self.postings.get(h, ()))
+
+        return {self.documents[doc_id]: n for doc_id, n in shared.items() if n >= min_shared}
+
+    def save(self, file_path: pathlib.PurePath):
+        # Check if we have a PurePath object
+        if not isinstance(file_path, pathlib.PurePath):
+            raise NotPurePathError
+
+        with open(file_path, "wb") as f:
+            pickle.dump(self, f)
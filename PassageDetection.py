@@ -0,0 +1,281 @@
+# Imports
+import math
+import pathlib
+import numpy as np
+import xml.etree.ElementTree as ET
+
+from errors import *
+from errno import ENOENT
+from os import strerror
+from NGram import NGram
+from Executor import Executor
+from Profiling import profiled
+import tqdm
+
+
+def seed_pairs(sus_hashes: np.ndarray, src_hashes: np.ndarray, max_freq: int = None):
+    """
+    Finds every pair of positions sharing the same n-gram, the src hashes are sorted once and used as a
+    positional index where the sus hashes are looked up.
+    :param sus_hashes: An uint64 numpy array with the hash of every n-gram of the sus document, in text order.
+    :param src_hashes: An uint64 numpy array with the hash of every n-gram of the src document, in text order.
+    :param max_freq: An int, n-grams appearing more times than this in the src document are ignored.
+    :return: A tuple with two int64 numpy arrays, the sus and src positions of every seed.
+    """
+    order = np.argsort(src_hashes, kind="stable")
+    index = src_hashes[order]
+
+    left = np.searchsorted(index, sus_hashes, side="left")
+    right = np.searchsorted(index, sus_hashes, side="right")
+    counts = right - left
+    if max_freq is not None:
+        counts[counts > max_freq] = 0
+
+    # Expand every sus position into the range of src positions of his hash
+    total = int(counts.sum())
+    sus_idx = np.repeat(np.arange(len(sus_hashes), dtype=np.int64), counts)
+    starts = np.repeat(left - (np.cumsum(counts) - counts), counts)
+    src_idx = order[starts + np.arange(total, dtype=np.int64)]
+
+    return sus_idx, src_idx
+
+
+def __split(seeds: np.ndarray, column: int, max_gap: int) -> list:
+    """
+    Private function used to split a group of seeds wherever there's a gap bigger than max_gap
+    between them in one of the documents.
+    :param seeds: An int64 numpy array with a row per seed (sus start, sus end, src start, src end).
+    :param column: An int, 0 to split along the sus document and 2 along the src one.
+    :param max_gap: An int, in characters.
+    :return: A list of numpy arrays.
+    """
+    seeds = seeds[np.argsort(seeds[:, column], kind="stable")]
+    reach = np.maximum.accumulate(seeds[:, column + 1])
+    cuts = np.nonzero(seeds[1:, column] - reach[:-1] > max_gap)[0] + 1
+
+    return np.split(seeds, cuts)
+
+
+def merge_seeds(seeds: np.ndarray, max_gap: int = 200, min_seeds: int = 3) -> list:
+    """
+    Merges the seeds close to each other in both documents into passages. The groups are split along the sus
+    and the src documents in turns until no group changes.
+    :param seeds: An int64 numpy array with a row per seed (sus start, sus end, src start, src end).
+    :param max_gap: An int, maximum distance in characters between two seeds of the same passage.
+    :param min_seeds: An int, passages made of fewer seeds are discarded.
+    :return: A list of dicts with the this_offset, this_length, source_offset and source_length of every passage.
+    """
+    groups = [seeds] if len(seeds) else []
+    column = 0
+    stable = 0
+
+    # Two splits in a row without changes, one along every document, means it's done
+    while stable < 2:
+        split = [part for group in groups for part in __split(group, column, max_gap)]
+        stable = stable + 1 if len(split) == len(groups) else 0
+        groups = [group for group in split if len(group) >= min_seeds]
+        column = 2 - column
+
+    passages = []
+    for group in sorted(groups, key=lambda x: x[:, 0].min()):
+        sus_start, src_start = int(group[:, 0].min()), int(group[:, 2].min())
+        passages.append({"this_offset": sus_start,
+                         "this_length": int(group[:, 1].max()) - sus_start,
+                         "source_offset": src_start,
+                         "source_length": int(group[:, 3].max()) - src_start})
+
+    return passages
+
+
+def locate_pair(sus_ngram: NGram, src_ngram: NGram, max_gap: int = 200, min_seeds: int = 3,
+                max_freq: int = 50) -> list:
+    """
+    Finds the passages of a sus document taken from a src document.
+    :param sus_ngram: A NGram object with offsets.
+    :param src_ngram: A NGram object with offsets, of the same order and transformations.
+    :param max_gap: An int, maximum distance in characters between two seeds of the same passage.
+    :param min_seeds: An int, passages made of fewer shared n-grams are discarded.
+    :param max_freq: An int, n-grams repeated more times than this in the src document aren't used as seeds.
+    :return: A list of dicts as returned by merge_seeds.
+    """
+    if sus_ngram.offsets is None or src_ngram.offsets is None:
+        raise NGramFormatError("The n-grams must be loaded with their offsets")
+
+    sus_idx, src_idx = seed_pairs(sus_ngram.position_hashes(), src_ngram.position_hashes(), max_freq)
+    seeds = np.concatenate([sus_ngram.offsets[sus_idx], src_ngram.offsets[src_idx]], axis=1)
+
+    return merge_seeds(seeds, max_gap, min_seeds)
+
+
+@profiled
+def locate_document(sus: pathlib.PurePath, src_files: list, order: int, transformations: list, max_gap: int,
+                    min_seeds: int, max_freq: int):
+    """
+    Worker function used to find the passages of a sus document taken from any of his candidate src documents,
+    the sus document is read once.
+    :return: A tuple with the name of the sus file and the list of detections.
+    """
+    sus_ngram = NGram.from_txt_file(sus, order, list(transformations), offsets=True)
+
+    detections = []
+    for src in src_files:
+        src_ngram = NGram.from_txt_file(src, order, list(transformations), offsets=True)
+        for passage in locate_pair(sus_ngram, src_ngram, max_gap, min_seeds, max_freq):
+            detections.append(dict(passage, source_reference=src.name))
+
+    return sus.name, detections
+
+
+def write_pan_xml(output: pathlib.PurePath, sus_name: str, detections: list):
+    """
+    Writes the detections of a sus document in the PAN format.
+    :param output: A Path object with the location of the .xml file.
+    :param sus_name: A string, name of the sus .txt file.
+    :param detections: A list of dicts as returned by locate_document.
+    :return: Nothing
+    """
+    if not isinstance(output, pathlib.PurePath):
+        raise NotPurePathError("output arg is not PurePath object")
+
+    root = ET.Element("document", reference=sus_name)
+    for detection in detections:
+        ET.SubElement(root, "feature", {"name": "detected-plagiarism",
+                                        "this_offset": str(detection["this_offset"]),
+                                        "this_length": str(detection["this_length"]),
+                                        "source_reference": detection["source_reference"],
+                                        "source_offset": str(detection["source_offset"]),
+                                        "source_length": str(detection["source_length"])})
+
+    ET.ElementTree(root).write(output, encoding="utf-8", xml_declaration=True)
+
+
+def read_pan_xml(xml_path: pathlib.PurePath, name: str = "detected-plagiarism") -> list:
+    """
+    Reads the detections (or the plagiarism cases with name="plagiarism") of a PAN .xml file.
+    :param xml_path: A Path object with the location of the .xml file.
+    :param name: A string, name of the features to read.
+    :return: A list of dicts with integer offsets and lengths.
+    """
+    if not isinstance(xml_path, pathlib.PurePath):
+        raise NotPurePathError("xml arg is not PurePath object")
+
+    if not xml_path.exists():
+        raise FileNotFoundError(ENOENT, strerror(ENOENT), xml_path)
+
+    cases = []
+    for feature in ET.parse(xml_path).getroot().findall(f"feature[@name = '{name}']"):
+        props = feature.attrib
+        cases.append({"this_offset": int(props["this_offset"]),
+                      "this_length": int(props["this_length"]),
+                      "source_reference": props["source_reference"],
+                      "source_offset": int(props["source_offset"]),
+                      "source_length": int(props["source_length"])})
+
+    return cases
+
+
+def __union_length(intervals: list) -> int:
+    length = 0
+    end = -1
+    for start, stop in sorted(intervals):
+        start = max(start, end)
+        if stop > start:
+            length += stop - start
+            end = stop
+
+    return length
+
+
+def __overlaps(a: dict, b: dict):
+    """
+    Private function used to intersect two cases of the same sus document.
+    :return: A tuple with the common (start, end) characters of the sus and the src documents, None if the
+    cases don't overlap in both of them.
+    """
+    if a["source_reference"] != b["source_reference"]:
+        return None
+
+    this = (max(a["this_offset"], b["this_offset"]),
+            min(a["this_offset"] + a["this_length"], b["this_offset"] + b["this_length"]))
+    source = (max(a["source_offset"], b["source_offset"]),
+              min(a["source_offset"] + a["source_length"], b["source_offset"] + b["source_length"]))
+
+    if this[0] >= this[1] or source[0] >= source[1]:
+        return None
+
+    return this, source
+
+
+def __coverage(cases: list, others: list) -> list:
+    """
+    Private function used to compute, for every case, the share of his characters covered by the other cases
+    and how many of them overlap it.
+    """
+    result = []
+    for case in cases:
+        overlaps = [x for x in (__overlaps(case, other) for other in others) if x is not None]
+        covered = __union_length([this for this, _ in overlaps]) + __union_length([src for _, src in overlaps])
+        result.append((covered / max(case["this_length"] + case["source_length"], 1), len(overlaps)))
+
+    return result
+
+
+def evaluate(detections: dict, truths: dict) -> dict:
+    """
+    Character level PAN measures of a set of detections.
+    :param detections: A dict with the name of every sus file as the key and his list of detections as the value.
+    :param truths: A dict with the name of every sus file as the key and his list of plagiarism cases as the value.
+    :return: A dict with the macro averaged precision and recall, the granularity and the plagdet score.
+    """
+    recall = []
+    precision = []
+    for sus in set(detections) | set(truths):
+        recall += __coverage(truths.get(sus, []), detections.get(sus, []))
+        precision += __coverage(detections.get(sus, []), truths.get(sus, []))
+
+    rec = sum(x for x, _ in recall) / len(recall) if recall else 0
+    prec = sum(x for x, _ in precision) / len(precision) if precision else 0
+    detected = [n for _, n in recall if n]
+    gran = sum(detected) / len(detected) if detected else 1
+    f1 = 2 * prec * rec / (prec + rec) if prec + rec else 0
+
+    return {"precision": prec, "recall": rec, "granularity": gran, "plagdet": f1 / math.log2(1 + gran)}
+
+
+def locate(src_folder: pathlib.PurePath, sus_folder: pathlib.PurePath, pairs, output: pathlib.PurePath,
+           order: int = 3, transformations: list = ["tok"], max_gap: int = 200, min_seeds: int = 3,
+           max_freq: int = 50, workers: int = None, worker_memory: int = None) -> dict:
+    """
+    Finds the plagiarized passages of a set of candidate pairs and writes a PAN .xml file per sus document.
+    :param src_folder: A Path object with the folder of the src .txt files.
+    :param sus_folder: A Path object with the folder of the sus .txt files.
+    :param pairs: A DataFrame with the src and sus file names of the candidate pairs (e.g. the detect output).
+    :param output: A Path object with the folder where the .xml files are written.
+    :param order: An int, order of the n-grams used as seeds.
+    :param transformations: A list of strings, transformations applied to the text before making the n-grams.
+    :param max_gap: An int, maximum distance in characters between two seeds of the same passage.
+    :param min_seeds: An int, passages made of fewer shared n-grams are discarded.
+    :param max_freq: An int, n-grams repeated more times than this in a src document aren't used as seeds.
+    :param workers: An int, number of worker processes, cpu_count() + 2 by default.
+    :param worker_memory: An int, estimated bytes used by every worker, caps the workers to the available memory.
+    :return: A dict with the name of every sus file as the key and his list of detections as the value.
+    """
+    for folder in [src_folder, sus_folder, output]:
+        if not isinstance(folder, pathlib.PurePath):
+            raise NotPurePathError("folder arg is not PurePath object")
+
+    # A task per sus document with all his candidates
+    args = [(sus_folder / sus, [src_folder / src for src in group["src"]], order, transformations, max_gap,
+             min_seeds, max_freq) for sus, group in pairs.groupby("sus")]
+
+    # Every sus document is compared with all his candidates, the ones with the most text go first
+    costs = [sum(path.stat().st_size for path in [sus] + srcs) for sus, srcs, *_ in args]
+
+    detections = {}
+    with Executor(workers, worker_memory) as executor:
+        for _, (sus_name, found) in tqdm.tqdm(executor.starmap(locate_document, args, costs), total=len(args),
+                                              desc="Locating passages"):
+            write_pan_xml(output / pathlib.Path(sus_name).with_suffix(".xml").name, sus_name, found)
+            detections[sus_name] = found
+
+    return detections
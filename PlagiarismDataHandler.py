@@ -5,10 +5,21 @@ from errno import ENOENT
 from os import strerror
 from errors import *
 from NGram import *
+from MinHash import MinHash
+from Manifest import Manifest
+from PreprocessText import transform_pipelines
+from CorpusStore import CorpusStore
+from CorpusIndex import CorpusIndex
+from DependencyRelations import DependencyRelations, DepVocabulary, encode_dep_folders
+from nltk.tokenize import word_tokenize
+from nltk.util import ngrams
 from random import sample
 from multiprocessing import cpu_count
+from contextlib import nullcontext
 
-from istarmap import *
+from Executor import Executor
+from Profiling import profiled, stage, timed_iter
+import Profiling
 import xml.etree.ElementTree as ET
 import tqdm
 import shutil
@@ -18,9 +29,114 @@ import shutil
 #   - Add proper documentation
 
 # Worker functions, needs to be at the top to be pickled
-def save_ngram_protected(path: pathlib.PurePath, output: pathlib.PurePath, order: int,
-                         transformations: list = ["tok"]):
-    NGram.from_txt_file(path, order, transformations).save(output / (path.stem + ".NGram"))
+# Corpus stores opened by the worker process
+_stores = {}
+
+
+@profiled
+def save_ngrams_protected(path: pathlib.PurePath, jobs: list, store: pathlib.PurePath = None):
+    """
+    Writes several .NGram files of the same document reading and tokenizing it only once.
+    :param path: A Path object with the location of the .txt file.
+    :param jobs: A list of tuples with the output folder and a dict with his parameters (order, transformations,
+    format and minhash), as built by PlagiarismDataHandler.gen_ngram_files.
+    :param store: A Path object with the folder of a CorpusStore, if given the tokens are taken from it
+    instead of the .txt file.
+    :return: Nothing
+    """
+    # Pipelines shared by several orders are only computed once
+    pipelines = []
+    for _, params in jobs:
+        if params["transformations"] not in pipelines:
+            pipelines.append(params["transformations"])
+
+    if store is not None:
+        with stage("store"):
+            if store not in _stores:
+                _stores[store] = CorpusStore(store)
+            processed = [_stores[store].tokens_of(path.stem, opts) for opts in pipelines]
+    else:
+        with stage("read", 1, path.stat().st_size if Profiling.is_enabled() else 0):
+            with open(path, "r", encoding="utf-8-sig") as f:
+                text = f.read()
+        with stage("tokenize", 1):
+            word_tokens = word_tokenize(text)
+        with stage("transform", 1):
+            processed = transform_pipelines(word_tokens, pipelines)
+
+    for output, params in jobs:
+        tokens = processed[pipelines.index(params["transformations"])]
+        transformations = params["transformations"] + ([] if "tok" in params["transformations"] else ["tok"])
+
+        with stage("ngrams", 1):
+            ngram = NGram(list(ngrams(tokens, params["order"])), params["order"], params["format"] == "hashed",
+                          transformations)
+        with stage("write", 1):
+            ngram.save(output / (path.stem + ".NGram"), params["format"] == "binary")
+        if Profiling.is_enabled():
+            Profiling.add("write", bytes_written=(output / (path.stem + ".NGram")).stat().st_size, calls=0)
+
+        # Signature stored next to the .NGram file
+        if params["minhash"]:
+            with stage("minhash", 1):
+                MinHash.from_ngram(ngram, params["minhash"]).save(output / (path.stem + MinHash.SUFFIX))
+
+
+# Stanza pipeline of the worker process, set by init_dep_worker
+_nlp = None
+
+
+def init_dep_worker(lang: str = "en"):
+    """
+    Pool initializer of the dependency workers, loads the Stanza pipeline once per process.
+    :param lang: A string, the Stanza language code.
+    :return: Nothing
+    """
+    global _nlp
+    # Stanza is heavy and only needed here, so it's imported in the workers
+    import stanza
+    _nlp = stanza.Pipeline(lang, processors="tokenize,pos,lemma,depparse", verbose=False)
+
+
+@profiled
+def save_deps_protected(batch: list, output: pathlib.PurePath, max_chars: int = None):
+    """
+    Writes the .dep files of a batch of documents with the worker's Stanza pipeline, the documents are parsed
+    together in calls of about max_chars characters.
+    :param batch: A list of Path objects with the .txt files.
+    :param output: A Path object with the output folder.
+    :param max_chars: An int, size of the calls to the pipeline, longer documents are parsed in chunks of whole
+    sentences.
+    :return: The list of processed paths.
+    """
+    with stage("parse", len(batch), sum(path.stat().st_size for path in batch) if Profiling.is_enabled() else 0):
+        relations = DependencyRelations.from_txt_files(batch, _nlp, max_chars)
+
+    for path, dependencies in zip(batch, relations):
+        dependencies.save(output / (path.stem + ".dep"))
+
+    return batch
+
+
+def _size_balanced_batches(paths: list, batch_chars: int):
+    """
+    Private function used to group documents into batches of about batch_chars bytes, the biggest first.
+    :param paths: A list of Path objects.
+    :param batch_chars: An int, target size of every batch.
+    :return: A list of lists of Path objects.
+    """
+    batches = []
+    current, size = [], 0
+    for path in sorted(paths, key=lambda p: p.stat().st_size, reverse=True):
+        if current and size + path.stat().st_size > batch_chars:
+            batches.append(current)
+            current, size = [], 0
+        current.append(path)
+        size += path.stat().st_size
+
+    if current:
+        batches.append(current)
+    return batches
 
 
 class PlagiarismFile:
@@ -36,6 +152,14 @@ class PlagiarismFile:
 
         self.plagiarized_refs = self.__process_xml()
 
+    @classmethod
+    def from_refs(cls, xml_path: PurePath, refs: list):
+        # Already parsed references, e.g. from a CorpusIndex
+        plagiarism_file = cls.__new__(cls)
+        plagiarism_file.xml_path = xml_path
+        plagiarism_file.plagiarized_refs = refs
+        return plagiarism_file
+
     def __process_xml(self):
         xmlroot = ET.parse(self.xml_path).getroot()
         features = xmlroot.findall("feature[@name = 'plagiarism']")
@@ -70,57 +194,79 @@ class PlagiarismDataHandler:
         if not (self.root_suspicious.exists() and self.root_suspicious.is_dir()):
             raise FileNotFoundError(ENOENT, strerror(ENOENT), root_source)
 
-        self.txt_source_paths, self.xml_source_paths = map(list, self.__get_source_paths())
-        self.txt_suspicious_paths, self.xml_suspicious_paths = map(list, self.__get_suspicious_paths())
+        # File lists and plagiarism references come from the persisted index, only changed .xml files are parsed
+        self.index = CorpusIndex.for_folders(self.root_source, self.root_suspicious)
+        self.__plagiarized = None
+        self.__non_plagiarized = None
+        self.rebuild_files()
+
+    def rebuild_files(self):
+        self.index.refresh(self.root_source)
+        self.index.refresh(self.root_suspicious)
 
-        self.plagiarized, self.non_plagiarized = self.rebuild_plagiarized()
+        self.txt_source_paths = self.index.paths(self.root_source, ".txt")
+        self.xml_source_paths = self.index.paths(self.root_source, ".xml")
+        self.txt_suspicious_paths = self.index.paths(self.root_suspicious, ".txt")
+        self.xml_suspicious_paths = self.index.paths(self.root_suspicious, ".xml")
 
-    def __get_source_paths(self):
-        txtfiles = self.root_source.glob("*.txt")
-        xmlfiles = self.root_source.glob("*.xml")
+        # Classified again on the next access
+        self.__plagiarized = None
+        self.__non_plagiarized = None
 
-        return txtfiles, xmlfiles
+    @property
+    def plagiarized(self):
+        if self.__plagiarized is None:
+            self.__plagiarized, self.__non_plagiarized = self.rebuild_plagiarized()
 
-    def __get_suspicious_paths(self):
-        txtfiles = self.root_suspicious.glob("*.txt")
-        xmlfiles = self.root_suspicious.glob("*.xml")
+        return self.__plagiarized
 
-        return txtfiles, xmlfiles
+    @property
+    def non_plagiarized(self):
+        if self.__non_plagiarized is None:
+            self.__plagiarized, self.__non_plagiarized = self.rebuild_plagiarized()
 
-    def rebuild_files(self):
-        self.txt_source_paths, self.xml_source_paths = map(list, self.__get_source_paths())
-        self.txt_suspicious_paths, self.xml_suspicious_paths = map(list, self.__get_suspicious_paths())
+        return self.__non_plagiarized
 
     def rebuild_plagiarized(self):
         plagiarized = []
         non_plagiarized = []
+        refs = self.index.plagiarized_refs(self.root_suspicious)
 
         for sus_file in self.xml_suspicious_paths:
-            ref = PlagiarismFile(sus_file)
+            txt_file = sus_file.with_suffix(".txt")
 
-            if ref.has_plagiarized_refs():
-                plagiarized.append((sus_file.with_suffix(".txt"), ref))
+            if txt_file.name in refs:
+                plagiarized.append((txt_file, PlagiarismFile.from_refs(sus_file, refs[txt_file.name])))
             else:
-                non_plagiarized.append(sus_file.with_suffix(".txt"))
+                non_plagiarized.append(txt_file)
 
         return plagiarized, non_plagiarized
 
+    def labels(self):
+        """
+        :return: A dict with the name of every plagiarized suspicious .txt file as the key and a frozenset with the
+        names of his source files as the value.
+        """
+        return self.index.labels(self.root_suspicious)
+
     def build_subset(self, output: Path, total: int, plagiarized_percent: float, make_zip: False):
         # Let's classify first the docs
         source = []
+        seen = set()
         plagiarized = []
         n = round(total * plagiarized_percent)
 
         for file in sample(self.plagiarized, n):
             plagiarized.append(file[0])
             for ref in file[1].plagiarized_refs:
-                sp = self.root_source / ref["source_file"]
-                if sp not in source:
-                    source.append(sp.with_suffix(".txt"))
+                sp = (self.root_source / ref["source_file"]).with_suffix(".txt")
+                if sp not in seen:
+                    seen.add(sp)
+                    source.append(sp)
 
         plagiarized += sample(self.non_plagiarized, total - n)
         if len(source) < total:
-            source += sample(self.txt_source_paths, total - len(source))
+            source += sample([sp for sp in self.txt_source_paths if sp not in seen], total - len(source))
 
         # Make subset folder
         output.mkdir(parents=True)
@@ -142,7 +288,30 @@ class PlagiarismDataHandler:
             shutil.make_archive(output.stem, "zip", output)
             shutil.rmtree(Path(output))
 
-    def gen_ngram_files(self, order: int, output: pathlib.PurePath, transformations: list = ["tok"]):
+    def gen_ngram_files(self, order, output: pathlib.PurePath, transformations: list = ["tok"],
+                        num_perm: int = None, compact: bool = False, binary: bool = False, force: bool = False,
+                        store: pathlib.PurePath = None, workers: int = None, worker_memory: int = None):
+        """
+        Writes the .NGram files of every source and suspicious document. Several orders and sets of transformations
+        can be given, every document is then read and tokenized once and a folder is written for every combination.
+        Each output folder keeps a manifest, so only the new or changed documents are processed and the outputs of
+        removed ones are deleted.
+        :param order: An int or a list of ints with the orders of the n-grams.
+        :param output: A Path object with the folder where the features folders are made.
+        :param transformations: A list of strings with the transformations applied before building the n-grams,
+        or a list of such lists.
+        :param num_perm: An int, if given a MinHash signature with num_perm permutations is stored too.
+        :param compact: A bool, store the hashed n-grams.
+        :param binary: A bool, store the n-grams in the binary format.
+        :param force: A bool, regenerate every document even if the manifest says it's up to date.
+        :param store: A Path object with the folder of a CorpusStore. If given, the corpus is tokenized once into the
+        store (or the existing one is reused if the documents haven't changed) and every .NGram file is derived
+        from it.
+        :param workers: An int, number of worker processes, cpu_count() + 2 by default. The same processes are
+        used for the store and for the source and suspicious documents.
+        :param worker_memory: An int, estimated bytes used by every worker, caps the workers to the available memory.
+        :return: Nothing
+        """
 
         if not isinstance(output, PurePath):
             raise NotPurePathError("output arg is not PurePath object")
@@ -150,32 +319,175 @@ class PlagiarismDataHandler:
         if not (output.exists()):
             raise FileNotFoundError(ENOENT, strerror(ENOENT), output)
 
-        # Make output dirs
-        out_source = output / f"source-{order}-{'-'.join(transformations)}-ngram"
-        out_suspicious = output / f"suspicious-{order}-{'-'.join(transformations)}-ngram"
-
-        out_source.mkdir(parents=True, exist_ok=True)
-        out_suspicious.mkdir(parents=True, exist_ok=True)
-
-        source_files = self.txt_source_paths
-        suspicious_files = self.txt_suspicious_paths
-
-        args_source = list(zip(source_files,
-                               [out_source] * len(source_files),
-                               [order] * len(source_files),
-                               [transformations] * len(source_files)))
-
-        args_suspicious = list(zip(suspicious_files,
-                                   [out_suspicious] * len(suspicious_files),
-                                   [order] * len(suspicious_files),
-                                   [transformations] * len(suspicious_files)))
+        orders = [order] if isinstance(order, int) else list(order)
+        if all(isinstance(opt, str) for opt in transformations):
+            pipelines = [list(transformations)]
+        else:
+            pipelines = [list(opts) for opts in transformations]
+
+        source_targets = []
+        suspicious_targets = []
+        for order in orders:
+            for opts in pipelines:
+                # Make output dirs
+                out_source = output / f"source-{order}-{'-'.join(opts)}-ngram"
+                out_suspicious = output / f"suspicious-{order}-{'-'.join(opts)}-ngram"
+
+                out_source.mkdir(parents=True, exist_ok=True)
+                out_suspicious.mkdir(parents=True, exist_ok=True)
+
+                # Everything that changes the content of the outputs
+                params = {"order": order,
+                          "transformations": opts,
+                          "format": "binary" if binary else "hashed" if compact else "text",
+                          "format_version": BINARY_VERSION if binary else 0,
+                          "minhash": num_perm}
+
+                source_targets.append((out_source, params))
+                suspicious_targets.append((out_suspicious, params))
+
+        with Executor(workers, worker_memory) as executor:
+            if store is not None:
+                self.build_corpus_store(store, executor=executor,
+                                        transformations=sorted({x for opts in pipelines for x in opts}))
+
+            self.__gen_ngram_folders(self.txt_source_paths, source_targets, force, "source", store, executor)
+            self.__gen_ngram_folders(self.txt_suspicious_paths, suspicious_targets, force, "suspicious", store,
+                                     executor)
+
+    def gen_dep_files(self, output: pathlib.PurePath, lang: str = "en", workers: int = None,
+                      batch_chars: int = 200000, max_chars: int = 50000, force: bool = False, binary: bool = False,
+                      worker_memory: int = None):
+        """
+        Writes the .dep files (syntactic dependency relations) of every source and suspicious document into the
+        source-dep and suspicious-dep folders. Every worker keeps one Stanza pipeline loaded for the whole run and gets
+        batches of documents of similar total size. Finished documents are recorded in a manifest, so an interrupted
+        run resumes where it stopped.
+        :param output: A Path object with the folder where the features folders are made.
+        :param lang: A string, the Stanza language code.
+        :param workers: An int, number of worker processes (each one holds a pipeline), half the cores by default.
+        :param batch_chars: An int, approximate size in bytes of the batches sent to the workers.
+        :param max_chars: An int, size of the calls to the pipeline. The documents of a batch are parsed together
+        up to it and longer ones in chunks of whole sentences.
+        :param force: A bool, regenerate every document even if the manifest says it's up to date.
+        :param binary: A bool, encode the relations with a vocabulary shared by the whole output folder
+        (dep-vocab.json) and write them in the binary format.
+        :param worker_memory: An int, estimated bytes used by every worker (mostly his pipeline), caps the workers
+        to the available memory.
+        :return: Nothing
+        """
+        if not isinstance(output, PurePath):
+            raise NotPurePathError("output arg is not PurePath object")
 
-        with mpp.Pool(cpu_count() + 2) as p:
-            r = list(tqdm.tqdm(p.istarmap(save_ngram_protected, args_source),
-                               total=len(args_source),
-                               desc="Writing source .NGram files"))
+        if not (output.exists()):
+            raise FileNotFoundError(ENOENT, strerror(ENOENT), output)
 
-        with mpp.Pool(cpu_count() + 2) as p:
-            r = list(tqdm.tqdm(p.istarmap(save_ngram_protected, args_suspicious),
-                               total=len(args_suspicious),
-                               desc="Writing suspicious .NGram files"))
+        params = {"lang": lang, "format": "binary" if binary else "text", "format_version": 1 if binary else 0}
+        manifests = {}
+        hashes = {}
+        args = []
+        total = 0
+
+        for files, kind in [(self.txt_source_paths, "source"), (self.txt_suspicious_paths, "suspicious")]:
+            folder = output / f"{kind}-dep"
+            folder.mkdir(parents=True, exist_ok=True)
+            manifest = manifests[folder] = Manifest(folder)
+            digests = {path.stem: Manifest.file_hash(path) for path in files}
+            hashes.update({path: digests[path.stem] for path in files})
+
+            # Remove the outputs of the documents that are gone
+            for stem in list(manifest.documents):
+                if stem not in digests:
+                    if (folder / (stem + ".dep")).exists():
+                        (folder / (stem + ".dep")).unlink()
+                    manifest.remove(stem)
+
+            pending = [path for path in files if force or not (folder / (path.stem + ".dep")).exists()
+                       or not manifest.is_current(path.stem, digests[path.stem], params)]
+            print(f"{len(pending)} of {len(files)} {kind} documents need to be parsed")
+
+            for batch in _size_balanced_batches(pending, batch_chars):
+                args.append((batch, folder, max_chars))
+            total += len(pending)
+
+        # The manifests are saved even if the run is interrupted, with the documents finished so far
+        try:
+            # Every worker loads a pipeline, no pool is started when everything is up to date
+            if args:
+                costs = [sum(path.stat().st_size for path in batch) for batch, _, _ in args]
+                with Executor(workers or max(1, cpu_count() // 2), worker_memory, init_dep_worker,
+                              (lang,)) as executor:
+                    with tqdm.tqdm(total=total, desc="Writing .dep files") as pbar:
+                        for i, batch in timed_iter("wait dep batches",
+                                                   executor.starmap(save_deps_protected, args, costs),
+                                                   lambda result: len(result[1])):
+                            folder = args[i][1]
+                            for path in batch:
+                                manifests[folder].update(path.stem, hashes[path], params)
+                            pbar.update(len(batch))
+        finally:
+            for manifest in manifests.values():
+                manifest.save()
+
+        # Parsed documents are encoded afterwards, files left as text by an interrupted run are encoded on the next one
+        if binary:
+            encode_dep_folders(list(manifests), output / DepVocabulary.FILENAME)
+
+    def build_corpus_store(self, folder: pathlib.PurePath, lang: str = "english", executor: Executor = None,
+                           transformations: list = None):
+        """
+        Tokenizes every source and suspicious document into a CorpusStore, an existing one is reused when
+        the documents haven't changed.
+        :param folder: A Path object with the folder of the store.
+        :param lang: A string, which language to use for the stopwords.
+        :param executor: An Executor object used to tokenize, a new one is used if not given.
+        :param transformations: A list of strings with the transformations the store is used with, only their
+        tables are built. Every table if not given.
+        :return: A CorpusStore object.
+        """
+        return CorpusStore.for_files(self.txt_source_paths + self.txt_suspicious_paths, folder, lang, executor,
+                                     transformations)
+
+    @staticmethod
+    def __gen_ngram_folders(files: list, targets: list, force: bool, desc: str, store: pathlib.PurePath = None,
+                            executor: Executor = None):
+        manifests = {folder: Manifest(folder) for folder, _ in targets}
+        with stage("hash documents", len(files)):
+            digests = {path.stem: Manifest.file_hash(path) for path in files}
+
+        # Remove the outputs of the documents that are gone
+        for folder, manifest in manifests.items():
+            for stem in list(manifest.documents):
+                if stem not in digests:
+                    for suffix in [".NGram", MinHash.SUFFIX]:
+                        if (folder / (stem + suffix)).exists():
+                            (folder / (stem + suffix)).unlink()
+                    manifest.remove(stem)
+
+        # Outputs to write for every document, missing files are written again even if the manifest is current
+        pending = []
+        for path in files:
+            jobs = [(folder, params) for folder, params in targets
+                    if force or not manifests[folder].is_current(path.stem, digests[path.stem], params)
+                    or not (folder / (path.stem + ".NGram")).exists()
+                    or params["minhash"] and not (folder / (path.stem + MinHash.SUFFIX)).exists()]
+            if jobs:
+                pending.append((path, jobs, store))
+
+        print(f"{len(pending)} of {len(files)} {desc} documents need to be processed")
+
+        # The manifests are saved even if the run is interrupted, with the documents finished so far
+        try:
+            # The longest documents are sent first so they don't end up alone at the tail
+            costs = [path.stat().st_size * len(jobs) for path, jobs, _ in pending]
+            with Executor() if executor is None else nullcontext(executor) as runner:
+                for i, _ in tqdm.tqdm(timed_iter(f"wait {desc} documents",
+                                                 runner.starmap(save_ngrams_protected, pending, costs)),
+                                      total=len(pending),
+                                      desc=f"Writing {desc} .NGram files"):
+                    path, jobs, _ = pending[i]
+                    for folder, params in jobs:
+                        manifests[folder].update(path.stem, digests[path.stem], params)
+        finally:
+            for manifest in manifests.values():
+                manifest.save()
@@ -1,13 +1,18 @@
 import argparse
 import sys
 import pickle
-import pandas as pd
-import numpy as np
 
 from PlagiarismDataHandler import PlagiarismDataHandler
 from BuildScoreCSV import writeCSV
+from PassageDetection import locate, evaluate, read_pan_xml
+from DetectionService import DetectionService
+from NGram import convert_ngram_folder
+from ScoresSink import FORMATS, read_scores
+from Detection import detect_scores
+from Sharding import parse_shard, merge_shards
+from errors import ShardError
+import Profiling
 from pathlib import Path
-from sklearn.tree import DecisionTreeClassifier
 
 
 # TODO:
@@ -28,6 +33,29 @@ def out_path(path):
         raise argparse.ArgumentParser(f"{path} is not valid")
 
 
+def order_list(value):
+    # Accepts a single order (3), a range (1-5) or a list (1,3)
+    try:
+        if "-" in value:
+            start, end = value.split("-")
+            return list(range(int(start), int(end) + 1))
+        return [int(x) for x in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a valid order")
+
+
+def shard_spec(value):
+    # Accepts the shard i of N as i/N, from 1/N to N/N
+    try:
+        return parse_shard(value)
+    except ShardError as e:
+        raise argparse.ArgumentTypeError(e.message)
+
+
+def _megabytes(value):
+    return value * 2 ** 20 if value is not None else None
+
+
 class PlagiarismUtils:
     def __init__(self):
         print("\n")
@@ -40,6 +68,10 @@ class PlagiarismUtils:
                 subset      Used to generate a subset of files from a bigger one
                 preprocess  Used to generate .dep and .NGram files
                 scores      Used to generate a CSV file with the scores of set
+                merge       Used to combine the outputs of the shards of a scores job
+                convert     Used to rewrite text .NGram files into the binary format
+                locate      Used to find the plagiarized passages of the detected pairs
+                serve       Used to start a local HTTP service that checks single documents
             """
         )
         # Add subcommand arg
@@ -54,6 +86,29 @@ class PlagiarismUtils:
 
         # Call subcommand routine
         getattr(self, args.command)()
+        Profiling.report(args.command)
+
+    def _parse(self, parser):
+        # Options shared by every subcommand
+        parser.add_argument("--profile", type=Path, nargs="?", const=Path("profile"), default=None,
+                            metavar="FOLDER", help="Measure every stage (main process and workers) and write the "
+                                                   "summary into FOLDER (./profile by default)")
+        parser.add_argument("--cprofile", action="store_true",
+                            help="With --profile, also write cProfile dumps of the main process and the workers")
+
+        args = parser.parse_args(sys.argv[2:])
+        if args.profile is not None:
+            Profiling.enable(args.profile, args.cprofile)
+
+        return args
+
+    def _add_workers(self, parser):
+        # Options of the subcommands running a process pool
+        parser.add_argument("--workers", type=int, default=None,
+                            help="Worker processes, the number of cores + 2 by default")
+        parser.add_argument("--worker-memory", type=int, default=None, metavar="MB",
+                            help="Estimated memory used by every worker, fewer workers are started if they "
+                                 "don't fit in the available memory")
 
     def subset(self):
         parser = argparse.ArgumentParser(
@@ -69,7 +124,7 @@ class PlagiarismUtils:
         parser.add_argument("--zip", action="store_true")
 
         # Parse args
-        args = parser.parse_args(sys.argv[2:])
+        args = self._parse(parser)
 
         handler = PlagiarismDataHandler(args.src_files, args.sus_files)
         handler.build_subset(args.output_name, args.total, args.prop, args.zip)
@@ -77,30 +132,64 @@ class PlagiarismUtils:
     def preprocess(self):
         parser = argparse.ArgumentParser(
             description="Generate preprocessed features (ngrams and syntactic dependency relations) used to detection",
-            usage="""preprocess [src_files] [sus_files] [output_folder] [order] [opts (tok, lem, lower, alpha)]"""
+            usage="""preprocess [src_files] [sus_files] [output_folder] [order (3, 1-5 or 1,3)] [opts (tok, lem, lower, alpha)]
+            [--pipeline OPTS ...] [--store STORE_FOLDER] [--dep [--dep-lang LANG] [--dep-workers N]]
+            [--minhash NUM_PERM] [--compact] [--binary] [--force] [--workers N] [--worker-memory MB]"""
         )
 
         # Add args
         parser.add_argument("src_files", type=dir_path)
         parser.add_argument("sus_files", type=dir_path)
         parser.add_argument("output", type=dir_path)
-        parser.add_argument("order", type=int, default=3)
+        parser.add_argument("order", type=order_list, default=[3])
         parser.add_argument("opts", nargs="*")
+        parser.add_argument("--pipeline", action="append", default=[], metavar="OPTS",
+                            help="Extra set of comma separated transformations (e.g. tok,lem,lower), "
+                                 "every document is tokenized once for all of them")
+        parser.add_argument("--minhash", type=int, default=None, metavar="NUM_PERM",
+                            help="Also store a MinHash signature with NUM_PERM permutations next to every .NGram file")
+        parser.add_argument("--compact", action="store_true",
+                            help="Store the n-grams as sorted 64 bit hashes instead of the raw tokens")
+        parser.add_argument("--binary", action="store_true",
+                            help="Write the .NGram files in the binary format (a header and the raw hashes, read "
+                                 "without parsing), and the .dep files encoded with a shared vocabulary when used "
+                                 "with --dep")
+        parser.add_argument("--force", action="store_true",
+                            help="Regenerate every document, not only the new or changed ones")
+        parser.add_argument("--store", type=Path, default=None, metavar="STORE_FOLDER",
+                            help="Tokenize the corpus once into a token id store and derive the n-grams from it")
+        parser.add_argument("--dep", action="store_true",
+                            help="Also generate the .dep files (syntactic dependency relations) with Stanza")
+        parser.add_argument("--dep-lang", default="en", help="Stanza language code used with --dep")
+        parser.add_argument("--dep-workers", type=int, default=None,
+                            help="Worker processes used with --dep, each one loads a Stanza pipeline")
+        self._add_workers(parser)
 
         # Parse args
-        args = parser.parse_args(sys.argv[2:])
+        args = self._parse(parser)
 
         handler = PlagiarismDataHandler(args.src_files, args.sus_files)
         
-        if args.opts:
-            handler.gen_ngram_files(args.order, args.output, args.opts)
-        else:
+        pipelines = ([args.opts] if args.opts else []) + [opts.split(",") for opts in args.pipeline]
+
+        if pipelines:
+            handler.gen_ngram_files(args.order, args.output, pipelines, args.minhash, args.compact, args.binary,
+                                    args.force, args.store, args.workers, _megabytes(args.worker_memory))
+
+        if args.dep:
+            handler.gen_dep_files(args.output, args.dep_lang, args.dep_workers, force=args.force, binary=args.binary,
+                                  worker_memory=_megabytes(args.worker_memory))
+
+        if not (pipelines or args.dep):
             raise argparse.ArgumentParser(f"A set of transformations need to be specified")
 
     def scores(self):
         parser = argparse.ArgumentParser(
             description="Generate .csv file with the similarity scores for every preprocessed feature",
-            usage="""scores [src_files] [sus_files] [feature_files_folder] [output] [--train]"""
+            usage="""scores [src_files] [sus_files] [feature_files_folder] [output] [--train] [--min-shared N]
+            [--approximate [--bands B]] [--cache-size MB] [--backend {pool,sparse,tiled}] [--block-size N]
+            [--min-jaccard T] [--top-k K [--rank-by FEATURE]] [--format {csv,parquet,arrow}] [--detect MODEL]
+            [--shard i/N] [--no-arena] [--memory-budget MB] [--dep] [--workers N] [--worker-memory MB]"""
         )
 
         # Add args
@@ -109,16 +198,115 @@ class PlagiarismUtils:
         parser.add_argument("feature_files", type=dir_path)
         parser.add_argument("output", type=out_path)
         parser.add_argument("--train", action="store_true")
+        parser.add_argument("--min-shared", type=int, default=None,
+                            help="Only score the pairs sharing at least N n-grams (uses an inverted index)")
+        parser.add_argument("--approximate", action="store_true",
+                            help="Estimate the scores from the MinHash signatures, only LSH candidates are exact")
+        parser.add_argument("--bands", type=int, default=32, help="Number of LSH bands used with --approximate")
+        parser.add_argument("--cache-size", type=int, default=256,
+                            help="Size in MB of the features cache of every worker")
+        parser.add_argument("--backend", choices=["pool", "sparse", "tiled"], default="pool",
+                            help="Score pair by pair (pool), by blocks with sparse matrix products (sparse) or by "
+                                 "tiles that fit --memory-budget (tiled)")
+        parser.add_argument("--block-size", type=int, default=512,
+                            help="Files per block of the pair space: the sparse backend scores a block at a time, "
+                                 "--shard deals the blocks between the shards and the tiled backend tiles every "
+                                 "block of a shard")
+        parser.add_argument("--min-jaccard", type=float, default=None, metavar="T",
+                            help="Only score the pairs with a jaccard >= T in some feature (exact similarity join)")
+        parser.add_argument("--top-k", type=int, default=None, metavar="K",
+                            help="Only write the K sources with the highest score of every suspicious file")
+        parser.add_argument("--rank-by", default=None, metavar="FEATURE",
+                            help="Feature used to rank the sources with --top-k, the first one by default")
+        parser.add_argument("--format", choices=FORMATS, default=None,
+                            help="Output format, inferred from the output suffix by default")
+        parser.add_argument("--detect", type=dir_path, default=None, metavar="MODEL",
+                            help="Classify the pairs as they're scored and write only the flagged ones (as detect "
+                                 "does) instead of the scores")
+        parser.add_argument("--shard", type=shard_spec, default=None, metavar="i/N",
+                            help="Only score the shard i (1 to N) of the pairs, split in blocks of --block-size "
+                                 "files, and write a shard manifest next to the output. See merge")
+        parser.add_argument("--no-arena", action="store_true",
+                            help="Let every pool worker load his own copy of the features instead of sharing "
+                                 "them through shared memory. It's also done when they don't fit in /dev/shm")
+        parser.add_argument("--memory-budget", type=int, default=None, metavar="MB",
+                            help="Memory held at once by all the workers with --backend tiled, half of the "
+                                 "available memory by default")
+        parser.add_argument("--dep", action="store_true",
+                            help="Also score the dependency relations (preprocessed with --dep), as the share of "
+                                 "the relations of the suspicious file found in the source")
+        self._add_workers(parser)
 
         # Parse args
-        args = parser.parse_args(sys.argv[2:])
+        args = self._parse(parser)
+
+        model = None
+        if args.detect is not None:
+            with open(args.detect, "rb") as f:
+                model = pickle.load(f)
 
         # Write a the CSV
         writeCSV(args.feature_files,
                  list(args.src_files.glob("*.txt")),
                  list(args.sus_files.glob("*.txt")),
                  args.output,
-                 is_training=args.train)
+                 is_training=args.train,
+                 min_shared=args.min_shared,
+                 approximate=args.approximate,
+                 bands=args.bands,
+                 cache_size=args.cache_size * 2 ** 20,
+                 backend=args.backend,
+                 block_size=args.block_size,
+                 min_jaccard=args.min_jaccard,
+                 top_k=args.top_k,
+                 rank_by=args.rank_by,
+                 fmt=args.format,
+                 model=model,
+                 shard=args.shard,
+                 arena=not args.no_arena,
+                 workers=args.workers,
+                 worker_memory=_megabytes(args.worker_memory),
+                 memory_budget=_megabytes(args.memory_budget),
+                 dep=args.dep)
+
+    def merge(self):
+        parser = argparse.ArgumentParser(
+            description="Check that every shard of a scores job is there and intact and combine them",
+            usage="""merge [shard_outputs ...] [output] [--top-k K [--rank-by FEATURE]]
+            [--format {csv,parquet,arrow}]"""
+        )
+
+        # Add args
+        parser.add_argument("shards", type=dir_path, nargs="+")
+        parser.add_argument("output", type=out_path)
+        parser.add_argument("--top-k", type=int, default=None, metavar="K",
+                            help="Only keep the K sources with the highest score of every suspicious file, the "
+                                 "--top-k of the scores job by default")
+        parser.add_argument("--rank-by", default=None, metavar="FEATURE",
+                            help="Feature used to rank the sources with --top-k, the one of the job by default")
+        parser.add_argument("--format", choices=FORMATS, default=None,
+                            help="Output format, inferred from the output suffix by default")
+
+        # Parse args
+        args = self._parse(parser)
+
+        rows = merge_shards(args.shards, args.output, args.format, args.top_k, args.rank_by)
+        print(f"{len(args.shards)} shards merged, {rows} rows written to {args.output}")
+
+    def convert(self):
+        parser = argparse.ArgumentParser(
+            description="Rewrite the text .NGram files of a preprocessed folder into the binary format",
+            usage="""convert [feature_files_folder]"""
+        )
+
+        # Add args
+        parser.add_argument("feature_files", type=dir_path)
+
+        # Parse args
+        args = self._parse(parser)
+
+        for folder in sorted(args.feature_files.glob("*-ngram")):
+            print(f"{folder.name}: {convert_ngram_folder(folder)} files converted")
 
     def detect(self):
         parser = argparse.ArgumentParser(
@@ -129,27 +317,83 @@ class PlagiarismUtils:
         parser.add_argument("scores", type=dir_path)
         parser.add_argument("model", type=dir_path)
         parser.add_argument("output", type=out_path)
+        parser.add_argument("--chunk-rows", type=int, default=65536,
+                            help="Number of scores rows read and classified at once")
+        parser.add_argument("--format", choices=FORMATS, default=None,
+                            help="Scores format, inferred from the scores suffix by default")
 
         # Parse args
-        args = parser.parse_args(sys.argv[2:])
+        args = self._parse(parser)
 
-        # Load model and make it predict
+        # Load model and make it predict, the scores are streamed in chunks
         with open(args.model, "rb") as f:
             tree = pickle.load(f)
-        data = pd.read_csv(args.scores, header=0)
 
-        X = data.drop(["src", "sus", "plagiarized"], axis=1, errors="ignore")
+        flagged = detect_scores(args.scores, tree, args.output, args.format, args.chunk_rows)
+        print(f"{flagged} plagiarized pairs written to {args.output}")
+
+    def locate(self):
+        parser = argparse.ArgumentParser(
+            description="Find the plagiarized passages of a set of candidate pairs, written in the PAN .xml format",
+            usage="""locate [src_files] [sus_files] [pairs] [output_folder] [--order N] [--opts OPTS ...]
+            [--max-gap CHARS] [--min-seeds N] [--max-freq N] [--evaluate] [--workers N] [--worker-memory MB]"""
+        )
+
+        # Add args
+        parser.add_argument("src_files", type=dir_path)
+        parser.add_argument("sus_files", type=dir_path)
+        parser.add_argument("pairs", type=dir_path, help="Scores or detect output with the src and sus columns")
+        parser.add_argument("output", type=dir_path)
+        parser.add_argument("--order", type=int, default=3, help="Order of the n-grams used as seeds")
+        parser.add_argument("--opts", nargs="*", default=["tok"], help="Transformations applied before the n-grams")
+        parser.add_argument("--max-gap", type=int, default=200,
+                            help="Maximum distance in characters between two seeds of the same passage")
+        parser.add_argument("--min-seeds", type=int, default=3, help="Minimum number of shared n-grams of a passage")
+        parser.add_argument("--max-freq", type=int, default=50,
+                            help="N-grams repeated more times in a source document aren't used as seeds")
+        parser.add_argument("--evaluate", action="store_true",
+                            help="Compare the passages with the .xml files of the suspicious documents")
+        self._add_workers(parser)
 
-        if len(tree.feature_importances_) != len(X.columns):
-            raise argparse.ArgumentParser(f"Model features don't match with the .csv vars number")
+        # Parse args
+        args = self._parse(parser)
+
+        pairs = read_scores(args.pairs)
+        detections = locate(args.src_files, args.sus_files, pairs, args.output, args.order, args.opts,
+                            args.max_gap, args.min_seeds, args.max_freq, args.workers,
+                            _megabytes(args.worker_memory))
 
-        y = tree.predict(X)
-        idx = np.where(y == 1)
+        if args.evaluate:
+            truths = {xml.with_suffix(".txt").name: read_pan_xml(xml, "plagiarism")
+                      for xml in args.sus_files.glob("*.xml")}
+            for name, value in evaluate(detections, truths).items():
+                print(f"{name}: {value:.4f}")
 
-        res = data.iloc[idx][["src", "sus"]]
-        res["prob"] = tree.predict_proba(X)[idx][:, 1]
+    def serve(self):
+        parser = argparse.ArgumentParser(
+            description="Start a local HTTP service with the source features and the model loaded in memory. "
+                        "POST a suspicious document to /detect to get the flagged sources",
+            usage="""serve [feature_files_folder] [model] [--host HOST] [--port PORT] [--workers N]
+            [--batch-size N] [--batch-wait MS]"""
+        )
+
+        # Add args
+        parser.add_argument("feature_files", type=dir_path)
+        parser.add_argument("model", type=dir_path, nargs="?", default=Path("models/tree_classifier.model"))
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8080)
+        parser.add_argument("--workers", type=int, default=None,
+                            help="Preprocessing processes, one per core by default")
+        parser.add_argument("--batch-size", type=int, default=16, help="Maximum number of documents scored together")
+        parser.add_argument("--batch-wait", type=float, default=5,
+                            help="Milliseconds waited for more requests before scoring a batch")
+
+        # Parse args
+        args = self._parse(parser)
 
-        res.to_csv(args.output, index=False)
+        service = DetectionService(args.feature_files, args.model, args.workers, args.batch_size,
+                                   args.batch_wait / 1000)
+        service.run(args.host, args.port)
 
 
 # Entry point
@@ -1,8 +1,200 @@
+import numpy as np
+
+from functools import lru_cache
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
 from nltk.stem import WordNetLemmatizer
 from errors import UnknownOption
 
+# Order in which the transformations are always applied
+_STEPS = ["stop", "lem", "alpha", "lower"]
+
+# Preprocessors of the current process by language
+_preprocessors = {}
+
+
+def _check_transformations(transformations: list):
+    for opt in transformations:
+        if opt not in ["stop", "tok", "lem", "lower", "alpha"]:
+            raise UnknownOption(f"{opt} is not a known transformation")
+
+
+def token_spans(text: str, word_tokens: list) -> np.ndarray:
+    """
+    Function used to find the characters of the text covered by every token, the tokens are searched in order.
+    :param text: A string, the text that was tokenized.
+    :param word_tokens: A list of strings, the tokens of the text as returned by word_tokenize.
+    :return: An int64 numpy array with the start and end offsets of every token, tokens not found in the text
+    are given an empty span at the current position.
+    """
+    spans = np.empty((len(word_tokens), 2), dtype=np.int64)
+    pos = 0
+    for i, w in enumerate(word_tokens):
+        start = text.find(w, pos)
+
+        # The double quotes are rewritten as `` and '' by the tokenizer
+        if start < 0 and w in ["``", "''"]:
+            w = '"'
+            start = text.find(w, pos)
+
+        if start < 0:
+            spans[i] = pos, pos
+        else:
+            pos = start + len(w)
+            spans[i] = start, pos
+
+    return spans
+
+
+class Preprocessor:
+    """
+    Reusable preprocessor, the stopwords and the lemmatizer are loaded once and the lemma of every
+    distinct token is memoized in a bounded cache.
+    """
+
+    def __init__(self, lang: str = "english", cache_size: int = 2 ** 18):
+        self.lang = lang
+        self.cache_size = cache_size
+        self.__stop_words = None
+        self.__lemmatize = None
+
+    def __repr__(self):
+        return "Preprocessor for {} ({})".format(self.lang, self.lemma_cache_info())
+
+    @property
+    def stop_words(self):
+        if self.__stop_words is None:
+            self.__stop_words = frozenset(stopwords.words(self.lang))
+
+        return self.__stop_words
+
+    def lemmatize(self, word: str) -> str:
+        if self.__lemmatize is None:
+            self.__lemmatize = lru_cache(maxsize=self.cache_size)(WordNetLemmatizer().lemmatize)
+
+        return self.__lemmatize(word)
+
+    def lemma_cache_info(self):
+        return self.__lemmatize.cache_info() if self.__lemmatize is not None else None
+
+    def process_tokens(self, word_tokens: list, transformations: list) -> list:
+        """
+        Applies the transformations to a list of tokens in a single pass, in the order stop, lem, alpha and lower.
+        :param word_tokens: A list of strings.
+        :param transformations: A list of strings, "tok" is ignored.
+        :return: A new list of strings.
+        """
+        return [w for _, w in self.__iter_tokens(word_tokens, transformations)]
+
+    def __iter_tokens(self, word_tokens: list, transformations: list):
+        # Yields the position of every kept token along with the token itself
+        _check_transformations(transformations)
+
+        stop = "stop" in transformations
+        lem = "lem" in transformations
+        alpha = "alpha" in transformations
+        lower = "lower" in transformations
+        stop_words = self.stop_words if stop else None
+
+        for i, w in enumerate(word_tokens):
+            if stop and w in stop_words:
+                continue
+            if lem:
+                w = self.lemmatize(w)
+            if alpha and not w.isalpha():
+                continue
+            if lower:
+                w = w.lower()
+            yield i, w
+
+    def process_pipelines(self, word_tokens: list, pipelines: list) -> list:
+        """
+        Applies several sets of transformations to the same tokens. The intermediate results are shared,
+        e.g. ["lem"] and ["lem", "lower"] lemmatize the tokens only once.
+        :param word_tokens: A list of strings, the tokenized text.
+        :param pipelines: A list of lists of transformations ("tok" is ignored).
+        :return: A list with the processed tokens of every pipeline.
+        """
+        # Processed tokens by the steps applied so far
+        done = {(): word_tokens}
+        results = []
+        for transformations in pipelines:
+            _check_transformations(transformations)
+            steps = tuple(step for step in _STEPS if step in transformations)
+
+            # Start from the longest prefix already computed
+            start = max(i for i in range(len(steps) + 1) if steps[:i] in done)
+            if steps not in done:
+                done[steps] = self.process_tokens(done[steps[:start]], list(steps[start:]))
+
+            results.append(done[steps])
+
+        return results
+
+    def preprocess(self, text: str, transformations: list = ["token"]):
+        """
+        Same as the preprocess function.
+        :param text: A string which will be processed.
+        :param transformations: A list of strings containing the transformations to apply.
+        :return: A list of processed tokens or a processed string
+        """
+        _check_transformations(transformations)
+
+        word_tokens = self.process_tokens(word_tokenize(text), transformations)
+
+        # Return tokenized
+        if "tok" in transformations:
+            return word_tokens
+        else:
+            return " ".join(word_tokens)
+
+    def preprocess_spans(self, text: str, transformations: list = ["tok"]):
+        """
+        Same as preprocess with tokenization, but the characters of the text covered by every token are kept.
+        :param text: A string which will be processed.
+        :param transformations: A list of strings containing the transformations to apply, "tok" is implied.
+        :return: A tuple with the list of processed tokens and an int64 numpy array with their start and end offsets.
+        """
+        word_tokens = word_tokenize(text)
+        spans = token_spans(text, word_tokens)
+        kept = list(self.__iter_tokens(word_tokens, transformations))
+
+        return [w for _, w in kept], spans[[i for i, _ in kept]].reshape(-1, 2)
+
+    def preprocess_many(self, texts, transformations: list = ["tok"]):
+        """
+        Generator version of preprocess for a batch of texts.
+        :param texts: An iterable of strings.
+        :param transformations: A list of strings containing the transformations to apply.
+        :return: A generator with the processed tokens or string of every text.
+        """
+        for text in texts:
+            yield self.preprocess(text, transformations)
+
+
+def get_preprocessor(lang: str = "english") -> Preprocessor:
+    """
+    Function used to get the Preprocessor of the current process, it's made on the first call.
+    :param lang: A string, which language to use.
+    :return: A Preprocessor object.
+    """
+    if lang not in _preprocessors:
+        _preprocessors[lang] = Preprocessor(lang)
+
+    return _preprocessors[lang]
+
+
+def transform_pipelines(word_tokens: list, pipelines: list, lang: str = "english"):
+    """
+    Function used to apply several sets of transformations to the same tokens. The intermediate results are
+    shared, e.g. ["lem"] and ["lem", "lower"] lemmatize the tokens only once.
+    :param word_tokens: A list of strings, the tokenized text.
+    :param pipelines: A list of lists of transformations, as in preprocess ("tok" is ignored here).
+    :param lang: A string, which language to use (important for lemmanization)
+    :return: A list with the processed tokens of every pipeline.
+    """
+    return get_preprocessor(lang).process_pipelines(word_tokens, pipelines)
+
 
 def preprocess(text: str, transformations: list = ["token"], lang: str = "english"):
     """
@@ -13,32 +205,4 @@ def preprocess(text: str, transformations: list = ["token"], lang: str = "englis
     :param lang: A string, which language to use (important for lemmanization)
     :return: A list of processed tokens or a processed string
     """
-
-    for opt in transformations:
-        if opt not in ["stop", "tok", "lem", "lower", "alpha"]:
-            raise UnknownOption(f"{opt} is not a known transformation")
-
-    word_tokens = word_tokenize(text)
-    # Remove stop words
-    if "stop" in transformations:
-        stop_words = set(stopwords.words(lang))
-        word_tokens = [w for w in word_tokens if w not in stop_words]
-
-    # Lemmatization of words
-    if "lem" in transformations:
-        lemmatizer = WordNetLemmatizer()
-        word_tokens = [lemmatizer.lemmatize(w) for w in word_tokens]
-
-    # Remove non-alphanumeric words
-    if "alpha" in transformations:
-        word_tokens = [w for w in word_tokens if w.isalpha()]
-
-    # Tranform to lower
-    if "lower" in transformations:
-        word_tokens = [w.lower() for w in word_tokens]
-
-    # Return tokenized
-    if "tok" in transformations:
-        return word_tokens
-    else:
-        return " ".join(word_tokens)
+    return get_preprocessor(lang).preprocess(text, transformations)
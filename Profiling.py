@@ -0,0 +1,229 @@
+# Imports
+import cProfile
+import functools
+import json
+import os
+import pathlib
+import pstats
+import resource
+import sys
+import time
+
+from contextlib import contextmanager
+
+# Set by enable, the worker processes inherit them through the environment
+ENV_DIR = "PLAGIARISM_PROFILE_DIR"
+ENV_CPROFILE = "PLAGIARISM_PROFILE_CPROFILE"
+
+_FIELDS = ["calls", "wall", "cpu", "items", "bytes_read", "bytes_written"]
+
+# Measures of the current process, reset when a forked worker uses them for the first time
+_stats = {}
+_pid = os.getpid()
+_profiler = None
+_main_profiler = None
+
+
+def is_enabled() -> bool:
+    return ENV_DIR in os.environ
+
+
+def __own_stats() -> dict:
+    global _stats, _pid, _profiler
+    if os.getpid() != _pid:
+        _stats, _pid, _profiler = {}, os.getpid(), None
+
+    return _stats
+
+
+def add(name: str, items: int = 0, bytes_read: int = 0, bytes_written: int = 0, wall: float = 0.0,
+        cpu: float = 0.0, calls: int = 1):
+    """
+    Adds measures to a stage of the current process, nothing is done if profiling is disabled.
+    :param name: A string, name of the stage.
+    :return: Nothing
+    """
+    if not is_enabled():
+        return
+
+    stage = __own_stats().setdefault(name, dict.fromkeys(_FIELDS, 0))
+    for field, value in zip(_FIELDS, [calls, wall, cpu, items, bytes_read, bytes_written]):
+        stage[field] += value
+
+
+@contextmanager
+def stage(name: str, items: int = 0, bytes_read: int = 0, bytes_written: int = 0):
+    """
+    Context manager measuring the wall and CPU time of a stage.
+    """
+    if not is_enabled():
+        yield
+        return
+
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        add(name, items, bytes_read, bytes_written, time.perf_counter() - start_wall,
+            time.process_time() - start_cpu)
+
+
+def timed_iter(name: str, iterable, items_of=None):
+    """
+    Wraps an iterator (e.g. the results of a pool) measuring the time spent waiting for every item.
+    :param name: A string, name of the stage.
+    :param iterable: An iterable.
+    :param items_of: A function returning the number of items of every element, 1 by default.
+    :return: A generator with the same elements.
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                value = next(iterator)
+            except StopIteration:
+                return
+        add(name, items_of(value) if items_of is not None else 1, calls=0)
+        yield value
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+def profiled(func):
+    """
+    Decorator of the worker functions. With profiling enabled, the call is measured as a stage named after the
+    function and the measures of the worker are saved to the profile folder after every call.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_enabled():
+            return func(*args, **kwargs)
+
+        global _profiler
+        __own_stats()
+        if os.environ.get(ENV_CPROFILE) and _profiler is None:
+            _profiler = cProfile.Profile()
+
+        if _profiler is not None:
+            _profiler.enable()
+        try:
+            # Every call is a task of the pool
+            with stage(func.__name__.strip("_"), 1):
+                return func(*args, **kwargs)
+        finally:
+            if _profiler is not None:
+                _profiler.disable()
+            __dump_worker()
+
+    return wrapper
+
+
+def __dump_worker():
+    folder = pathlib.Path(os.environ[ENV_DIR])
+    tmp_path = folder / f"worker-{os.getpid()}.json.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"pid": os.getpid(), "peak_rss_mb": _peak_rss_mb(), "stages": _stats}, f)
+    tmp_path.replace(folder / f"worker-{os.getpid()}.json")
+
+    if _profiler is not None:
+        _profiler.dump_stats(str(folder / f"worker-{os.getpid()}.pstats"))
+
+
+def enable(folder: pathlib.PurePath, cprofile: bool = False):
+    """
+    Enables profiling for this process and the ones it starts, the outputs of a previous run in folder are removed.
+    :param folder: A Path object with the folder where the measures are written.
+    :param cprofile: A bool, also run cProfile in the main process and in every worker.
+    :return: Nothing
+    """
+    global _main_profiler
+    folder = pathlib.Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    for path in list(folder.glob("worker-*.json")) + list(folder.glob("*.pstats")):
+        path.unlink()
+
+    os.environ[ENV_DIR] = str(folder.resolve())
+    if cprofile:
+        os.environ[ENV_CPROFILE] = "1"
+        _main_profiler = cProfile.Profile()
+        _main_profiler.enable()
+
+    __own_stats().clear()
+    add("total", calls=0)
+    _stats["total"]["start"] = (time.perf_counter(), time.process_time())
+
+
+def __table(rows: list):
+    header = f"{'stage':<28}{'process':>9}{'calls':>9}{'wall (s)':>11}{'cpu (s)':>10}{'items':>10}" \
+             f"{'items/s':>11}{'MB read':>10}{'MB written':>12}"
+    lines = [header, "-" * len(header)]
+    for row in rows:
+        lines.append(f"{row['stage']:<28}{row['process']:>9}{row['calls']:>9}{row['wall']:>11.2f}"
+                     f"{row['cpu']:>10.2f}{row['items']:>10}{row['items_per_s']:>11.1f}"
+                     f"{row['bytes_read'] / 2 ** 20:>10.1f}{row['bytes_written'] / 2 ** 20:>12.1f}")
+    return "\n".join(lines)
+
+
+def report(command: str = None) -> dict:
+    """
+    Aggregates the measures of the main process and of every worker, prints a summary table and writes it as
+    profile.json (and the merged pstats dumps with cProfile) into the profile folder.
+    :param command: A string, name of the profiled command.
+    :return: A dict with the summary, None if profiling is disabled.
+    """
+    if not is_enabled():
+        return None
+
+    folder = pathlib.Path(os.environ[ENV_DIR])
+    main = __own_stats()
+    start_wall, start_cpu = main["total"].pop("start")
+    main["total"]["wall"] = time.perf_counter() - start_wall
+    main["total"]["cpu"] = time.process_time() - start_cpu
+
+    # Workers are summed by stage, their wall time is busy time so it can exceed the total
+    workers = [json.loads(path.read_text()) for path in sorted(folder.glob("worker-*.json"))]
+    workers = [w for w in workers if w["pid"] != os.getpid()]
+    merged = {}
+    for worker in workers:
+        for name, values in worker["stages"].items():
+            stage_stats = merged.setdefault(name, dict.fromkeys(_FIELDS, 0))
+            for field in _FIELDS:
+                stage_stats[field] += values[field]
+
+    rows = []
+    for process, stages in [("main", main), ("workers", merged)]:
+        for name, values in stages.items():
+            rows.append(dict(values, stage=name, process=process,
+                             items_per_s=values["items"] / max(values["wall"], 1e-9)))
+
+    summary = {"command": command,
+               "rows": rows,
+               "main_peak_rss_mb": _peak_rss_mb(),
+               "workers": [{"pid": w["pid"], "peak_rss_mb": w["peak_rss_mb"]} for w in workers]}
+
+    print("\n" + __table(rows))
+    rss = [w["peak_rss_mb"] for w in workers]
+    print(f"Peak RSS: main {summary['main_peak_rss_mb']:.1f} MB" +
+          (f", workers max {max(rss):.1f} MB / mean {sum(rss) / len(rss):.1f} MB over {len(rss)}" if rss else ""))
+
+    with open(folder / "profile.json", "w") as f:
+        json.dump(summary, f, indent=1)
+
+    # cProfile dumps, the workers are merged into a single one
+    if _main_profiler is not None:
+        _main_profiler.disable()
+        _main_profiler.dump_stats(str(folder / "main.pstats"))
+
+        dumps = [str(path) for path in sorted(folder.glob("worker-*.pstats"))]
+        if dumps:
+            stats = pstats.Stats(*dumps)
+            stats.dump_stats(str(folder / "workers.pstats"))
+            print("\nHottest functions of the workers:")
+            stats.sort_stats("cumulative").print_stats(15)
+
+    print(f"Profile written to {folder}")
+    return summary
@@ -0,0 +1,191 @@
+# Imports
+import pathlib
+import pandas as pd
+
+from errors import *
+
+# Parquet and Arrow IPC outputs are optional
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+FORMATS = ["csv", "parquet", "arrow"]
+_SUFFIXES = {".parquet": "parquet", ".pq": "parquet", ".arrow": "arrow", ".feather": "arrow", ".ipc": "arrow"}
+
+
+def infer_format(path: pathlib.PurePath) -> str:
+    """
+    Guess the scores format from the file suffix, CSV is used for unknown suffixes.
+    :param path: A Path object.
+    :return: A string from FORMATS.
+    """
+    return _SUFFIXES.get(path.suffix.lower(), "csv")
+
+
+def _require_pyarrow(fmt):
+    if pa is None:
+        raise MissingDependencyError(f"pyarrow is needed to read or write {fmt} scores")
+
+
+class ScoresSink:
+    """
+    Base class of the scores writers, rows are lists of values in header order and they're
+    written in chunks of at least batch_rows rows.
+    """
+
+    def __init__(self, output: pathlib.PurePath, header: list, batch_rows: int = 65536):
+        if not isinstance(output, pathlib.PurePath):
+            raise NotPurePathError("output arg is not PurePath object")
+
+        self.output = output
+        self.header = header
+        self.batch_rows = batch_rows
+        self.rows_written = 0
+        self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write_rows(self, rows: list):
+        self._buffer.extend(rows)
+        if len(self._buffer) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._write_chunk(self._buffer)
+            self.rows_written += len(self._buffer)
+            self._buffer = []
+
+    def close(self):
+        self.flush()
+
+    def _write_chunk(self, rows):
+        raise NotImplementedError
+
+    def _columns(self, rows):
+        return {name: [row[i] for row in rows] for i, name in enumerate(self.header)}
+
+
+class CSVSink(ScoresSink):
+    def __init__(self, output: pathlib.PurePath, header: list, batch_rows: int = 65536):
+        super().__init__(output, header, batch_rows)
+        self.__f = open(output, "w", buffering=2 ** 20)
+        self.__f.write(",".join(header) + "\n")
+
+    def _write_chunk(self, rows):
+        self.__f.write("".join(",".join([str(x) for x in row]) + "\n" for row in rows))
+
+    def close(self):
+        super().close()
+        self.__f.close()
+
+
+class ParquetSink(ScoresSink):
+    def __init__(self, output: pathlib.PurePath, header: list, batch_rows: int = 65536):
+        _require_pyarrow("parquet")
+        super().__init__(output, header, batch_rows)
+        self.__writer = None
+
+    def _write_chunk(self, rows):
+        table = pa.Table.from_pydict(self._columns(rows))
+        if self.__writer is None:
+            self.__writer = pq.ParquetWriter(str(self.output), table.schema)
+        self.__writer.write_table(table)
+
+    def close(self):
+        super().close()
+        # Write an empty file with the header when there were no rows
+        if self.__writer is None:
+            pq.write_table(pa.Table.from_pydict({name: [] for name in self.header}), str(self.output))
+        else:
+            self.__writer.close()
+
+
+class ArrowSink(ScoresSink):
+    def __init__(self, output: pathlib.PurePath, header: list, batch_rows: int = 65536):
+        _require_pyarrow("arrow")
+        super().__init__(output, header, batch_rows)
+        self.__sink = None
+        self.__writer = None
+
+    def _write_chunk(self, rows):
+        batch = pa.RecordBatch.from_pydict(self._columns(rows))
+        if self.__writer is None:
+            self.__sink = pa.OSFile(str(self.output), "wb")
+            self.__writer = pa.ipc.new_file(self.__sink, batch.schema)
+        self.__writer.write_batch(batch)
+
+    def close(self):
+        super().close()
+        if self.__writer is None:
+            self._write_chunk([])
+        self.__writer.close()
+        self.__sink.close()
+
+
+def open_sink(output: pathlib.PurePath, header: list, fmt: str = None, batch_rows: int = 65536) -> ScoresSink:
+    """
+    Opens the writer of a scores file.
+    :param output: A Path object with the location of the file.
+    :param header: A list of strings with the columns.
+    :param fmt: A string from FORMATS, inferred from the suffix of output when not given.
+    :param batch_rows: An int, number of buffered rows before writing them.
+    :return: A ScoresSink object.
+    """
+    fmt = fmt or infer_format(output)
+    if fmt not in FORMATS:
+        raise UnknownOption(f"{fmt} is not a known scores format")
+
+    return {"csv": CSVSink, "parquet": ParquetSink, "arrow": ArrowSink}[fmt](output, header, batch_rows)
+
+
+def read_scores(path: pathlib.PurePath, fmt: str = None) -> pd.DataFrame:
+    """
+    Reads a whole scores file written by a ScoresSink.
+    :param path: A Path object with the location of the file.
+    :param fmt: A string from FORMATS, inferred from the suffix of path when not given.
+    :return: A DataFrame.
+    """
+    fmt = fmt or infer_format(path)
+    if fmt == "csv":
+        return pd.read_csv(path, header=0, float_precision="round_trip")
+
+    _require_pyarrow(fmt)
+    if fmt == "parquet":
+        return pq.read_table(str(path)).to_pandas()
+
+    with pa.memory_map(str(path), "r") as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def iter_scores(path: pathlib.PurePath, fmt: str = None, chunk_rows: int = 65536):
+    """
+    Reads a scores file written by a ScoresSink in chunks, only one of them is in memory at a time.
+    :param path: A Path object with the location of the file.
+    :param fmt: A string from FORMATS, inferred from the suffix of path when not given.
+    :param chunk_rows: An int, number of rows of every chunk. The Parquet and Arrow files are read by
+    row groups and record batches, as they were written.
+    :return: A generator of DataFrames.
+    """
+    fmt = fmt or infer_format(path)
+    if fmt == "csv":
+        yield from pd.read_csv(path, header=0, chunksize=chunk_rows, float_precision="round_trip")
+        return
+
+    _require_pyarrow(fmt)
+    if fmt == "parquet":
+        parquet = pq.ParquetFile(str(path))
+        for i in range(parquet.num_row_groups):
+            yield parquet.read_row_group(i).to_pandas()
+        return
+
+    with pa.memory_map(str(path), "r") as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i).to_pandas()
@@ -0,0 +1,211 @@
+# Imports
+import hashlib
+import heapq
+import json
+import pathlib
+
+from errors import *
+from Manifest import Manifest
+from ScoresSink import open_sink, iter_scores, infer_format
+
+
+def parse_shard(value: str) -> tuple:
+    """
+    :param value: A string "i/N", the shard i (from 1 to N) of N.
+    :return: A tuple with the 0 based index of the shard and the number of shards.
+    """
+    try:
+        index, count = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise ShardError(f"{value} is not a valid shard, use i/N")
+
+    if not 1 <= index <= count:
+        raise ShardError(f"{value} is not a valid shard, i must be between 1 and N")
+
+    return index - 1, count
+
+
+def shard_blocks(src_files: list, sus_files: list, block_size: int, shard: tuple = None) -> list:
+    """
+    Splits the (sus block x src block) pair space and keeps the blocks of a shard. The files are sorted by name
+    and the blocks dealt round robin, so every host computes the same partition from the same folders.
+    :param src_files: A list of Path objects with the source files.
+    :param sus_files: A list of Path objects with the sus files.
+    :param block_size: An int, number of files per block.
+    :param shard: A tuple as returned by parse_shard, every block is kept when not given.
+    :return: A list of tuples with the sus files and the src files of every block.
+    """
+    src_files = sorted(src_files, key=lambda path: path.name)
+    sus_files = sorted(sus_files, key=lambda path: path.name)
+    sus_blocks = [sus_files[i:i + block_size] for i in range(0, len(sus_files), block_size)]
+    src_blocks = [src_files[i:i + block_size] for i in range(0, len(src_files), block_size)]
+
+    blocks = [(sus_block, src_block) for sus_block in sus_blocks for src_block in src_blocks]
+    if shard is None:
+        return blocks
+
+    index, count = shard
+    return [block for i, block in enumerate(blocks) if i % count == index]
+
+
+def job_fingerprint(src_files: list, sus_files: list, header: list, params: dict) -> str:
+    """
+    :return: A string, hash of the files, columns and parameters of a scores job. Every shard of the job has
+    the same one.
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps({"src": sorted(path.name for path in src_files),
+                              "sus": sorted(path.name for path in sus_files),
+                              "header": header,
+                              "params": params}, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ShardManifest:
+    """
+    Record written next to the output of a scores shard: the shard, the job it belongs to, the number
+    of rows and the checksum of the output, so merge can check the shards are complete and intact.
+    """
+    SUFFIX = ".shard.json"
+    VERSION = 1
+
+    def __init__(self, output: pathlib.PurePath, index: int, count: int, job: str, header: list, params: dict,
+                 rows: int = 0, checksum: str = None, fmt: str = None):
+        if not isinstance(output, pathlib.PurePath):
+            raise NotPurePathError("output arg is not PurePath object")
+
+        self.output = output
+        self.index = index
+        self.count = count
+        self.job = job
+        self.header = header
+        self.params = params
+        self.rows = rows
+        self.checksum = checksum
+        self.fmt = fmt or infer_format(output)
+
+    def __repr__(self):
+        return "ShardManifest of {} ({}/{}) with {} rows".format(self.output, self.index + 1, self.count, self.rows)
+
+    @classmethod
+    def path_of(cls, output: pathlib.PurePath) -> pathlib.Path:
+        return pathlib.Path(str(output) + cls.SUFFIX)
+
+    @classmethod
+    def load(cls, output: pathlib.PurePath):
+        """
+        :param output: A Path object with the output of a shard.
+        :return: A ShardManifest object.
+        """
+        path = cls.path_of(output)
+        if not path.exists():
+            raise ShardError(f"{output} has no shard manifest ({path.name})")
+
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        if data.get("version") != cls.VERSION:
+            raise ShardError(f"{path} was written by another version")
+
+        return cls(pathlib.Path(output), data["index"], data["count"], data["job"], data["header"], data["params"],
+                   data["rows"], data["checksum"], data["format"])
+
+    def save(self):
+        # The checksum is taken once the output is closed
+        self.checksum = Manifest.file_hash(self.output)
+
+        path = self.path_of(self.output)
+        tmp_path = pathlib.Path(str(path) + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": self.VERSION, "index": self.index, "count": self.count, "job": self.job,
+                       "header": self.header, "params": self.params, "rows": self.rows, "checksum": self.checksum,
+                       "format": self.fmt}, f, indent=1)
+
+        tmp_path.replace(path)
+
+    def verify(self):
+        if not pathlib.Path(self.output).exists():
+            raise ShardError(f"{self.output} is missing")
+
+        if Manifest.file_hash(self.output) != self.checksum:
+            raise ShardError(f"{self.output} doesn't match the checksum of his manifest")
+
+
+def check_shards(outputs: list) -> list:
+    """
+    Checks that the outputs are every shard of the same job, once, and intact.
+    :param outputs: A list of Path objects with the outputs of the shards.
+    :return: A list with the ShardManifest of every shard, in shard order.
+    """
+    if not outputs:
+        raise ShardError("No shards given")
+
+    manifests = [ShardManifest.load(output) for output in outputs]
+    first = manifests[0]
+    for manifest in manifests:
+        if manifest.job != first.job or manifest.count != first.count:
+            raise ShardError(f"{manifest.output} belongs to another scores job")
+
+    indexes = sorted(manifest.index for manifest in manifests)
+    if indexes != list(range(first.count)):
+        missing = sorted(set(range(first.count)) - set(indexes))
+        repeated = sorted(set(i for i in indexes if indexes.count(i) > 1))
+        raise ShardError(f"Expected {first.count} shards, missing {[i + 1 for i in missing]}"
+                         f" and repeated {[i + 1 for i in repeated]}")
+
+    for manifest in manifests:
+        manifest.verify()
+
+    return sorted(manifests, key=lambda manifest: manifest.index)
+
+
+def merge_shards(outputs: list, output: pathlib.PurePath, fmt: str = None, top_k: int = None,
+                 rank_by: str = None, chunk_rows: int = 65536) -> int:
+    """
+    Combines the outputs of every shard of a scores job into the final scores file. The shards of a job with
+    top_k (or when top_k is given) are merged keeping the top_k sources of every sus file, the rest are
+    concatenated in chunks.
+    :param outputs: A list of Path objects with the outputs of the shards.
+    :param output: A Path object with the merged scores file.
+    :param fmt: A string, format of the merged file, inferred from the output suffix when not given.
+    :param top_k: An int, sources kept for every sus file, the one of the job by default.
+    :param rank_by: A string, column used to rank the sources, the one of the job by default.
+    :param chunk_rows: An int, number of rows read at once from every shard.
+    :return: The number of rows written.
+    """
+    if not isinstance(output, pathlib.PurePath):
+        raise NotPurePathError("output arg is not PurePath object")
+
+    manifests = check_shards(outputs)
+    header = manifests[0].header
+    top_k = top_k if top_k is not None else manifests[0].params.get("top_k")
+    rank_by = rank_by or manifests[0].params.get("rank_by") or header[2]
+    if top_k is not None and rank_by not in header:
+        raise UnknownOption(f"{rank_by} is not a known feature")
+
+    with open_sink(output, header, fmt) as sink:
+        if top_k is None:
+            for manifest in manifests:
+                for chunk in iter_scores(manifest.output, manifest.fmt, chunk_rows):
+                    sink.write_rows(chunk[header].values.tolist())
+        else:
+            # Every shard keeps at most top_k sources of every sus file in each of his blocks
+            rank = header.index(rank_by)
+            best = {}
+            seen = 0
+            for manifest in manifests:
+                for chunk in iter_scores(manifest.output, manifest.fmt, chunk_rows):
+                    for row in chunk[header].values.tolist():
+                        # Ties keep the first rows, as top_k does in writeCSV
+                        heap = best.setdefault(row[1], [])
+                        item = (row[rank], -seen, row)
+                        seen += 1
+                        if len(heap) < top_k:
+                            heapq.heappush(heap, item)
+                        elif item[:1] > heap[0][:1]:
+                            heapq.heapreplace(heap, item)
+
+            for sus in sorted(best):
+                sink.write_rows([row for _, _, row in sorted(best[sus], reverse=True)])
+
+    return sink.rows_written
@@ -0,0 +1,95 @@
+# Imports
+import math
+import numpy as np
+
+from NGram import intersection_size
+
+
+def _overlap(threshold: float, size: int) -> int:
+    """
+    Private function used to get the minimum overlap a set of a given size needs with any other one to
+    reach the threshold, rounded down on float noise so the prefixes are never too short.
+    """
+    return max(1, math.ceil(threshold * size - 1e-9))
+
+
+def _rank_sets(sets: list):
+    """
+    Private function used to rewrite every set as the sorted ranks of his elements, where the rarest
+    element in the whole collection gets the lowest rank.
+    :param sets: A list of sorted and deduplicated uint64 numpy arrays.
+    :return: A list of sorted int64 numpy arrays.
+    """
+    if not sets or not sum(len(s) for s in sets):
+        return [np.empty(0, dtype=np.int64) for _ in sets]
+
+    vocabulary, counts = np.unique(np.concatenate(sets), return_counts=True)
+    rank = np.empty(len(vocabulary), dtype=np.int64)
+    rank[np.lexsort((vocabulary, counts))] = np.arange(len(vocabulary))
+
+    return [np.sort(rank[np.searchsorted(vocabulary, s)]) for s in sets]
+
+
+def similarity_join(sus_sets: dict, src_sets: dict, threshold: float):
+    """
+    Exact similarity join (PPJoin) between two collections of n-gram hashes. The elements are ordered by
+    rarity, the candidates are generated from the prefixes and pruned with the length and positional
+    filters, and the survivors are verified.
+    :param sus_sets: A dict with the name of every sus document as the key and his n-gram hashes as the value.
+    :param src_sets: A dict with the name of every src document as the key and his n-gram hashes as the value.
+    :param threshold: A float between 0 (excluded) and 1, minimum jaccard of the returned pairs.
+    :return: A list of tuples (sus name, src name, jaccard) with every pair whose jaccard is >= threshold.
+    """
+    if not 0 < threshold <= 1:
+        raise ValueError("threshold must be in (0, 1]")
+
+    sus_names, src_names = list(sus_sets), list(src_sets)
+    raw = [np.asarray(sus_sets[n], dtype=np.uint64) for n in sus_names] + \
+          [np.asarray(src_sets[n], dtype=np.uint64) for n in src_names]
+    ranked = _rank_sets(raw)
+    sus_ranked, src_ranked = ranked[:len(sus_names)], ranked[len(sus_names):]
+
+    # Index the prefixes of the src sets: rank -> [(src id, position)]
+    index = {}
+    for src_id, x in enumerate(src_ranked):
+        if not len(x):
+            continue
+        for pos, token in enumerate(x[:len(x) - _overlap(threshold, len(x)) + 1].tolist()):
+            index.setdefault(token, []).append((src_id, pos))
+
+    results = []
+    for sus_id, y in enumerate(sus_ranked):
+        size_y = len(y)
+        if not size_y:
+            continue
+
+        min_size, max_size = threshold * size_y - 1e-9, size_y / threshold + 1e-9
+        overlaps = {}
+        pruned = set()
+
+        for i, token in enumerate(y[:size_y - _overlap(threshold, size_y) + 1].tolist()):
+            for src_id, j in index.get(token, ()):
+                size_x = len(src_ranked[src_id])
+
+                # Length filter
+                if src_id in pruned or not min_size <= size_x <= max_size:
+                    continue
+
+                # Positional filter
+                alpha = math.ceil(threshold / (1 + threshold) * (size_x + size_y) - 1e-9)
+                upper_bound = 1 + min(size_x - j - 1, size_y - i - 1)
+                if overlaps.get(src_id, 0) + upper_bound >= alpha:
+                    overlaps[src_id] = overlaps.get(src_id, 0) + 1
+                else:
+                    pruned.add(src_id)
+                    overlaps.pop(src_id, None)
+
+        # Verification
+        for src_id in overlaps:
+            x = raw[len(sus_names) + src_id]
+            inter = intersection_size(raw[sus_id], x)
+            jaccard = inter / (size_y + len(x) - inter)
+            if jaccard >= threshold:
+                results.append((sus_names[sus_id], src_names[src_id], jaccard))
+
+    return results
@@ -0,0 +1,212 @@
+"""
+End to end benchmark of the PlagiarismUtils stages (subset, preprocess, scores and detect) over synthetic corpora
+of several sizes. Every stage runs in a fresh process through the command line, so the wall and CPU times and the
+peak RSS (of the main process and of his workers) belong to that stage only. The results are written as JSON and
+can be compared with a previous run.
+
+Usage: python benchmarks/bench_pipeline.py [--scales 50,200] [--words N] [--rate R] [--repeat N] [--order N]
+       [--opts tok ...] [--work FOLDER] [--output results.json] [--compare previous.json]
+"""
+import argparse
+import json
+import os
+import pickle
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+STAGES = ["subset", "preprocess", "scores", "detect"]
+_PREFIX = "BENCH "
+
+
+def _max_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+def run_stage(argv):
+    """
+    Runs a PlagiarismUtils command in this process and prints his measures as the last line.
+    """
+    from PlagiarismUtils import PlagiarismUtils
+
+    sys.argv = ["PlagiarismUtils.py"] + argv
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    PlagiarismUtils()
+    wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    print(_PREFIX + json.dumps({"wall_s": wall,
+                                "cpu_s": cpu + children.ru_utime + children.ru_stime,
+                                "peak_rss_mb": _max_rss_mb(resource.RUSAGE_SELF),
+                                "workers_peak_rss_mb": _max_rss_mb(resource.RUSAGE_CHILDREN)}))
+
+
+def measure(argv, repeat, prepare=None):
+    """
+    Runs a stage in a new process repeat times, the fastest run is kept.
+    :param argv: A list of strings, the PlagiarismUtils command and his arguments.
+    :param prepare: A function called before every run, used to clean the outputs of the previous one.
+    :return: A dict with the measures.
+    """
+    best = None
+    for _ in range(repeat):
+        if prepare is not None:
+            prepare()
+
+        result = subprocess.run([sys.executable, __file__, "--run-stage"] + argv, cwd=ROOT, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True)
+        lines = [line for line in result.stdout.splitlines() if line.startswith(_PREFIX)]
+        if result.returncode or not lines:
+            raise SystemExit(f"{' '.join(argv)} failed:\n{result.stdout}")
+
+        measures = json.loads(lines[-1][len(_PREFIX):])
+        if best is None or measures["wall_s"] < best["wall_s"]:
+            best = measures
+
+    return best
+
+
+def train_model(scores, path):
+    # The detect stage needs a model trained on the same features, it's not timed
+    import pandas as pd
+    from sklearn.tree import DecisionTreeClassifier
+
+    data = pd.read_csv(scores)
+    tree = DecisionTreeClassifier(max_depth=5, random_state=0)
+    tree.fit(data.drop(["src", "sus", "plagiarized"], axis=1), data["plagiarized"])
+    with open(path, "wb") as f:
+        pickle.dump(tree, f)
+
+
+def bench_scale(scale, args, work):
+    from synthetic_corpus import SyntheticCorpus
+
+    corpus = work / f"corpus-{scale}"
+    src, sus = corpus / "source-document", corpus / "suspicious-document"
+    features, subset = work / f"features-{scale}", work / f"subset-{scale}"
+    scores, model, detected = work / f"scores-{scale}.csv", work / f"model-{scale}.pkl", work / f"detect-{scale}.csv"
+
+    SyntheticCorpus(seed=args.seed).generate(corpus, scale, scale, args.words, args.rate)
+
+    def clean(*paths):
+        def prepare():
+            for path in paths:
+                if path.is_dir():
+                    shutil.rmtree(path)
+                elif path.exists():
+                    path.unlink()
+            if features in paths:
+                features.mkdir()
+        return prepare
+
+    total = max(scale // 2, 1)
+    stages = {
+        "subset": (["subset", str(src), str(sus), str(total), str(args.rate), str(subset)], clean(subset),
+                   total),
+        "preprocess": (["preprocess", str(src), str(sus), str(features), str(args.order)] + args.opts,
+                       clean(features), 2 * scale),
+        "scores": (["scores", str(src), str(sus), str(features), str(scores), "--train"], clean(scores),
+                   scale * scale),
+        "detect": (["detect", str(scores), str(model), str(detected)], clean(detected), scale * scale),
+    }
+
+    results = []
+    for stage in STAGES:
+        if stage == "detect":
+            train_model(scores, model)
+
+        argv, prepare, items = stages[stage]
+        measures = measure(argv, args.repeat, prepare)
+        results.append(dict(measures, scale=scale, stage=stage, items=items,
+                            throughput=items / max(measures["wall_s"], 1e-9)))
+        print(f"{scale:>8}{stage:>12}{measures['wall_s']:>10.2f}{measures['cpu_s']:>10.2f}"
+              f"{results[-1]['throughput']:>14.1f}{measures['peak_rss_mb']:>12.1f}"
+              f"{measures['workers_peak_rss_mb']:>12.1f}")
+
+    return results
+
+
+def compare(results, previous):
+    """
+    Prints the wall time ratio of every stage against a previous run, below 1 is faster.
+    """
+    before = {(x["scale"], x["stage"]): x for x in previous["results"]}
+    print(f"\nAgainst {previous['meta'].get('commit', '?')[:10]} ({previous['meta'].get('date', '?')})")
+    print(f"{'scale':>8}{'stage':>12}{'before (s)':>12}{'now (s)':>12}{'ratio':>8}{'rss ratio':>11}")
+    for x in results:
+        old = before.get((x["scale"], x["stage"]))
+        if old is None:
+            continue
+        print(f"{x['scale']:>8}{x['stage']:>12}{old['wall_s']:>12.2f}{x['wall_s']:>12.2f}"
+              f"{x['wall_s'] / max(old['wall_s'], 1e-9):>8.2f}"
+              f"{x['peak_rss_mb'] / max(old['peak_rss_mb'], 1e-9):>11.2f}")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--run-stage":
+        run_stage(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark the PlagiarismUtils stages on synthetic corpora")
+    parser.add_argument("--scales", default="50,200", help="Comma separated number of source (and suspicious) docs")
+    parser.add_argument("--words", type=int, default=2000, help="Words per document")
+    parser.add_argument("--rate", type=float, default=0.5, help="Share of suspicious documents with plagiarism")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of every stage, the fastest one is kept")
+    parser.add_argument("--order", type=int, default=3)
+    parser.add_argument("--opts", nargs="*", default=["tok"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work", type=Path, default=None, help="Folder for the corpora, a temporary one by default")
+    parser.add_argument("--output", type=Path, default=None, help="JSON results, benchmarks/results/ by default")
+    parser.add_argument("--compare", type=Path, default=None, help="JSON results of a previous run")
+    args = parser.parse_args()
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except OSError:
+        commit = ""
+
+    meta = {"commit": commit,
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {key: str(value) for key, value in vars(args).items()}}
+
+    work = args.work or Path(tempfile.mkdtemp(prefix="plagiarism-bench-"))
+    work.mkdir(parents=True, exist_ok=True)
+
+    print(f"{'scale':>8}{'stage':>12}{'wall (s)':>10}{'cpu (s)':>10}{'items/s':>14}{'rss (MB)':>12}{'workers':>12}")
+    results = []
+    try:
+        for scale in [int(x) for x in args.scales.split(",")]:
+            results += bench_scale(scale, args, work)
+    finally:
+        if args.work is None:
+            shutil.rmtree(work, ignore_errors=True)
+
+    output = args.output or ROOT / "benchmarks" / "results" / f"{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+    print(f"Results written to {output}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Per document cost of PreprocessText: the original implementation (resources rebuilt on every call and a full
+list pass per transformation) against the reusable Preprocessor. The outputs are checked to be identical.
+
+Usage: python benchmarks/bench_preprocess.py [txt_folder] [--opts stop lem alpha lower] [--repeat N]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from nltk.corpus import stopwords
+from nltk.tokenize import word_tokenize
+from nltk.stem import WordNetLemmatizer
+from PreprocessText import Preprocessor
+
+
+def reference_preprocess(text, transformations, lang="english"):
+    # The preprocess function as it was before Preprocessor
+    word_tokens = word_tokenize(text)
+    if "stop" in transformations:
+        stop_words = set(stopwords.words(lang))
+        word_tokens = [w for w in word_tokens if w not in stop_words]
+    if "lem" in transformations:
+        lemmatizer = WordNetLemmatizer()
+        word_tokens = [lemmatizer.lemmatize(w) for w in word_tokens]
+    if "alpha" in transformations:
+        word_tokens = [w for w in word_tokens if w.isalpha()]
+    if "lower" in transformations:
+        word_tokens = [w.lower() for w in word_tokens]
+    return word_tokens if "tok" in transformations else " ".join(word_tokens)
+
+
+def timed(func, texts, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [func(text) for text in texts]
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+def main():
+    root = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description="Benchmark PreprocessText")
+    parser.add_argument("folder", type=Path, nargs="?", default=root / "corpus_sample" / "source-document")
+    parser.add_argument("--opts", nargs="*", default=["stop", "lem", "alpha", "lower"])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    transformations = ["tok"] + args.opts
+    texts = [path.read_text(encoding="utf-8-sig") for path in sorted(args.folder.glob("*.txt"))]
+    tokens = sum(len(word_tokenize(text)) for text in texts)
+
+    preprocessor = Preprocessor()
+    # Warm up the NLTK resources so both sides are measured without the first load
+    reference_preprocess("warm up", transformations)
+    preprocessor.preprocess("warm up", transformations)
+
+    ref_time, ref_results = timed(lambda text: reference_preprocess(text, transformations), texts, args.repeat)
+    new_time, new_results = timed(lambda text: preprocessor.preprocess(text, transformations), texts, args.repeat)
+
+    if ref_results != new_results:
+        raise SystemExit("Preprocessor output differs from the reference implementation")
+
+    print(f"{len(texts)} documents, {tokens} tokens, transformations: {' '.join(transformations)}")
+    print(f"{'':<12}{'total (s)':>12}{'ms/doc':>12}{'tokens/s':>14}")
+    for name, elapsed in [("reference", ref_time), ("Preprocessor", new_time)]:
+        print(f"{name:<12}{elapsed:>12.3f}{1000 * elapsed / max(len(texts), 1):>12.2f}"
+              f"{tokens / max(elapsed, 1e-9):>14.0f}")
+    print(f"Speedup: {ref_time / max(new_time, 1e-9):.2f}x, lemma cache: {preprocessor.lemma_cache_info()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Generator of synthetic PAN-style corpora: source and suspicious .txt documents made of pseudo-words with a Zipf
+distribution, where a share of the suspicious documents has passages copied (and optionally obfuscated) from the
+sources. Every document gets his PAN .xml file, the plagiarism cases of the suspicious ones included, so the
+corpus can go through subset, preprocess, scores (--train) and locate --evaluate like the real one.
+
+Usage: python benchmarks/synthetic_corpus.py output_folder [--sources N] [--suspicious N] [--words N]
+       [--rate R] [--cases N] [--case-words N] [--obfuscation R] [--seed S]
+"""
+import argparse
+import random
+from pathlib import Path
+
+_SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "de", "pa", "shi", "gor", "an", "el", "ub", "ter"]
+_SOURCE_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<document reference="{name}">
+  <feature name="about" title="Synthetic document {index}" lang="en" />
+</document>
+"""
+_CASE_XML = ('  <feature name="plagiarism" type="artificial" obfuscation="{obfuscation}" this_language="en" '
+             'this_offset="{this_offset}" this_length="{this_length}" source_reference="{source_reference}" '
+             'source_language="en" source_offset="{source_offset}" source_length="{source_length}" />\n')
+
+
+class SyntheticCorpus:
+    def __init__(self, vocabulary_size: int = 20000, seed: int = 0):
+        self.random = random.Random(seed)
+        words = set()
+        while len(words) < vocabulary_size:
+            words.add("".join(self.random.choices(_SYLLABLES, k=self.random.randint(1, 4))))
+
+        # Zipf weights, the first words are the most frequent ones
+        self.words = sorted(words)
+        self.random.shuffle(self.words)
+        self.weights = [1 / rank for rank in range(1, vocabulary_size + 1)]
+
+    def sentence(self):
+        words = self.random.choices(self.words, self.weights, k=self.random.randint(6, 25))
+        return words[0].capitalize() + " " + " ".join(words[1:]) + self.random.choice([".", ".", ".", "?", "!"])
+
+    def text(self, num_words: int):
+        sentences = []
+        while num_words > 0:
+            sentences.append(self.sentence())
+            num_words -= sentences[-1].count(" ") + 1
+        return " ".join(sentences)
+
+    def obfuscate(self, passage: str, rate: float):
+        # Replace a share of the words, the punctuation is kept
+        words = passage.split(" ")
+        for i in range(len(words)):
+            if self.random.random() < rate:
+                words[i] = self.random.choice(self.words) + ("." if words[i].endswith(".") else "")
+        return " ".join(words)
+
+    def passage(self, text: str, num_words: int):
+        # A passage of whole words starting at a random word of the text
+        starts = [0] + [i + 1 for i, c in enumerate(text) if c == " "]
+        first = self.random.randrange(max(len(starts) - num_words, 1))
+        end = starts[first + num_words] - 1 if first + num_words < len(starts) else len(text)
+        return starts[first], end
+
+    def generate(self, output: Path, sources: int = 100, suspicious: int = 100, words: int = 2000,
+                 rate: float = 0.5, cases: int = 3, case_words: int = 150, obfuscation: float = 0.0):
+        """
+        Writes output/source-document and output/suspicious-document.
+        :return: A dict with the number of documents and plagiarism cases written.
+        """
+        source_folder = output / "source-document"
+        suspicious_folder = output / "suspicious-document"
+        source_folder.mkdir(parents=True, exist_ok=True)
+        suspicious_folder.mkdir(parents=True, exist_ok=True)
+
+        source_texts = []
+        for i in range(sources):
+            name = f"source-document{i:05d}.txt"
+            source_texts.append((name, self.text(words)))
+            (source_folder / name).write_text(source_texts[-1][1], encoding="utf-8")
+            (source_folder / name).with_suffix(".xml").write_text(_SOURCE_XML.format(name=name, index=i),
+                                                                  encoding="utf-8")
+
+        total_cases = 0
+        for i in range(suspicious):
+            name = f"suspicious-document{i:05d}.txt"
+            parts = [self.text(words // (cases + 1))]
+            offset = len(parts[0])
+            features = []
+
+            if self.random.random() < rate:
+                for _ in range(cases):
+                    source_name, source_text = self.random.choice(source_texts)
+                    start, end = self.passage(source_text, case_words)
+                    copied = self.obfuscate(source_text[start:end], obfuscation) if obfuscation else \
+                        source_text[start:end]
+
+                    features.append(_CASE_XML.format(obfuscation="random" if obfuscation else "none",
+                                                     this_offset=offset + 1, this_length=len(copied),
+                                                     source_reference=source_name, source_offset=start,
+                                                     source_length=end - start))
+                    parts += [copied, self.text(words // (cases + 1))]
+                    offset += len(copied) + len(parts[-1]) + 2
+                total_cases += cases
+
+            (suspicious_folder / name).write_text(" ".join(parts), encoding="utf-8")
+            (suspicious_folder / name).with_suffix(".xml").write_text(
+                f'<?xml version="1.0" encoding="UTF-8"?>\n<document reference="{name}">\n{"".join(features)}'
+                f'</document>\n', encoding="utf-8")
+
+        return {"sources": sources, "suspicious": suspicious, "cases": total_cases}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic PAN-style corpus")
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--sources", type=int, default=100)
+    parser.add_argument("--suspicious", type=int, default=100)
+    parser.add_argument("--words", type=int, default=2000, help="Words per document")
+    parser.add_argument("--rate", type=float, default=0.5, help="Share of suspicious documents with plagiarism")
+    parser.add_argument("--cases", type=int, default=3, help="Plagiarism cases per plagiarized document")
+    parser.add_argument("--case-words", type=int, default=150, help="Words per plagiarism case")
+    parser.add_argument("--obfuscation", type=float, default=0.0, help="Share of replaced words in every case")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = SyntheticCorpus(seed=args.seed)
+    print(corpus.generate(args.output, args.sources, args.suspicious, args.words, args.rate, args.cases,
+                          args.case_words, args.obfuscation))
+
+
+if __name__ == "__main__":
+    main()
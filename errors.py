@@ -24,15 +24,50 @@ class DepRelNoInput(Error):
         super().__init__(self.message)
 
 
-class TmpDirectoryError:
+class TmpDirectoryError(Error):
     # Exception raised when no input is passed to NGram object
     def __init__(self, message="Tmp folder is not correctly built"):
         self.message = message
         super().__init__(self.message)
 
 
-class UnknownOption:
+class UnknownOption(Error):
     # Exception raised when no input is passed to NGram object
     def __init__(self, message="Unknown option"):
         self.message = message
         super().__init__(self.message)
+
+
+class MinHashMismatchError(Error):
+    # Exception raised when two MinHash signatures can't be compared
+    def __init__(self, message="MinHash signatures have different number of permutations or seed"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class NGramFormatError(Error):
+    # Exception raised when a .NGram file can't be read
+    def __init__(self, message="Unknown .NGram file format"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class MissingDependencyError(Error):
+    # Exception raised when an optional dependency is needed but not installed
+    def __init__(self, message="An optional dependency is not installed"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class DepRelFormatError(Error):
+    # Exception raised when dependency relations can't be read, saved or compared
+    def __init__(self, message="Unknown .dep format"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ShardError(Error):
+    # Exception raised when the shards of a scores job can't be merged
+    def __init__(self, message="Incomplete or inconsistent scores shards"):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,71 @@
+import re
+import types
+
+import DependencyRelations
+import PlagiarismDataHandler
+from DependencyRelations import DependencyRelations as DepRel, _dep_rel_as_list, _dep_rel_batch
+
+
+class FakeNlp:
+    """
+    Stand-in for a Stanza pipeline: paragraphs are split on blank lines, sentences on periods and words on
+    whitespace. Every word depends on the previous one of his sentence.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, text):
+        self.calls.append(text)
+        sentences = []
+        for match in re.finditer(r"[^.\n]+\.?", text):
+            tokens = [types.SimpleNamespace(text=m.group(), start_char=match.start() + m.start())
+                      for m in re.finditer(r"\S+", match.group())]
+            if not tokens:
+                continue
+            words = [types.SimpleNamespace(text=t.text, head=i, deprel="root" if i == 0 else "dep")
+                     for i, t in enumerate(tokens)]
+            sentences.append(types.SimpleNamespace(tokens=tokens, words=words))
+
+        return types.SimpleNamespace(sentences=sentences)
+
+
+TEXTS = ["The cat sat. It slept.", "", "A dog barked loudly.\n\nThen it ran away.", "One more short text."]
+
+
+def test_batch_matches_one_call_per_text():
+    nlp = FakeNlp()
+    batched = _dep_rel_batch(TEXTS, nlp)
+
+    assert len(nlp.calls) == 1
+    assert batched == [_dep_rel_as_list(text, FakeNlp()) for text in TEXTS]
+
+
+def test_batch_calls_are_capped_by_max_chars(monkeypatch):
+    monkeypatch.setattr(DependencyRelations, "sent_tokenize", lambda text: re.findall(r"[^.]+\.", text))
+    texts = ["Alpha beta gamma. Delta epsilon.", "Zeta eta.", "Theta iota kappa lambda. Mu nu xi."]
+    nlp = FakeNlp()
+    batched = _dep_rel_batch(texts, nlp, max_chars=20)
+
+    assert 1 < len(nlp.calls) < sum(len(text) for text in texts)
+    assert [len(dependencies) for dependencies in batched] == [5, 2, 7]
+    assert batched == [_dep_rel_as_list(text, FakeNlp()) for text in texts]
+
+
+def test_save_deps_protected_writes_every_file(tmp_path, monkeypatch):
+    paths = []
+    for i, text in enumerate(TEXTS):
+        path = tmp_path / f"doc{i}.txt"
+        path.write_text(text, encoding="utf-8")
+        paths.append(path)
+
+    nlp = FakeNlp()
+    monkeypatch.setattr(PlagiarismDataHandler, "_nlp", nlp)
+    output = tmp_path / "dep"
+    output.mkdir()
+
+    assert PlagiarismDataHandler.save_deps_protected(paths, output, max_chars=1000) == paths
+    assert len(nlp.calls) == 1
+    for path in paths:
+        expected = DepRel.from_txt_file(path, FakeNlp())
+        assert list(DepRel.from_dep_file(output / (path.stem + ".dep"))) == list(expected)